@@ -0,0 +1,213 @@
+import logging
+import threading
+import Queue
+
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.db import connection
+from django.db.models import get_model
+from django.utils.importlib import import_module
+
+from properties_cache.conf import get_setting
+
+
+__all__ = ('get_backend', 'SyncBackend', 'ThreadBackend', 'QueueBackend',
+           'LocalQueue', 'Worker', 'run_job')
+
+
+logger = logging.getLogger('properties_cache')
+
+BACKENDS = {}
+
+
+def import_class(path):
+    module, attr = path.rsplit('.', 1)
+    return getattr(import_module(module), attr)
+
+
+def get_backend(setting='BACKEND'):
+    """Return instance of backend configured with
+    PROPERTIES_CACHE_BACKEND (or other given) setting"""
+    path = get_setting(setting)
+    if path not in BACKENDS:
+        BACKENDS[path] = import_class(path)()
+    return BACKENDS[path]
+
+
+def run_job(job):
+    """Recompute properties of instances described by job, which is tuple
+    (app label, model name, list of primary keys, list of properties)"""
+    from properties_cache.listeners import refresh_properties, load_items
+
+    app_label, model_name, pks, props = job
+    model = get_model(app_label, model_name)
+
+    items = load_items(model, pks, props)
+    logger.debug("Running job for %d instances of %r", len(items), model)
+    refresh_properties(items.values(), props)
+
+    return len(items)
+
+
+class SyncBackend(object):
+    """Recompute properties in current process when they are changed"""
+
+    def refresh(self, items, props):
+        from properties_cache.listeners import refresh_properties
+        refresh_properties(items, props)
+
+
+class ThreadBackend(object):
+    """Recompute properties in pool of threads of current process, so
+    caller doesn't wait for them. Properties which are being recomputed
+    already aren't scheduled again."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.pool = None
+
+    def refresh(self, items, props):
+        jobs = {}
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(get_setting('WORKERS'))
+
+            for item in items:
+                opts = item._meta
+                for prop in props:
+                    key = (opts.app_label, opts.object_name, item.pk, prop)
+                    if key not in self.pending:
+                        self.pending.add(key)
+                        jobs.setdefault((opts.app_label, opts.object_name,
+                                         prop), []).append(item.pk)
+
+        for (app_label, model_name, prop), pks in jobs.iteritems():
+            self.pool.apply_async(self.run_job,
+                                  [(app_label, model_name, pks, [prop])])
+
+    def run_job(self, job):
+        app_label, model_name, pks, props = job
+        try:
+            run_job(job)
+        except Exception:
+            logger.exception("Refresh of %r failed", job)
+        finally:
+            # every thread has its own connection
+            connection.close()
+            with self.lock:
+                self.pending.difference_update([(app_label, model_name,
+                                                 pk, props[0]) for pk in pks])
+
+
+class LocalQueue(object):
+    """In-process queue of jobs, doesn't need any broker. Jobs are visible
+    only to process which queued them, so they're run by its own worker
+    thread (see QueueBackend)."""
+    shared = False
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def put(self, job):
+        self.queue.put(job)
+
+    def get_batch(self, size, timeout=None):
+        """Return up to `size` of jobs, waits `timeout` seconds for
+        the first one (forever if timeout is None)"""
+        jobs = []
+        try:
+            jobs.append(self.queue.get(timeout is None or timeout > 0,
+                                       timeout))
+            while len(jobs) < size:
+                jobs.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return jobs
+
+
+class QueueBackend(object):
+    """Push jobs to recompute properties to the queue configured with
+    PROPERTIES_CACHE_QUEUE setting, jobs are processed by Worker. Jobs of
+    queue which isn't shared between processes (e.g. LocalQueue) are run
+    by daemon thread of current process unless PROPERTIES_CACHE_LOCAL_WORKER
+    setting is False, shared queues are drained by properties_cache_worker
+    command."""
+
+    def __init__(self):
+        self.queue = import_class(get_setting('QUEUE'))()
+        if not getattr(self.queue, 'shared', True) and \
+                get_setting('LOCAL_WORKER'):
+            thread = threading.Thread(target=self.run_worker,
+                                      name='properties_cache.worker')
+            thread.daemon = True
+            thread.start()
+
+    def run_worker(self):
+        worker = Worker(self.queue, pool='inline')
+        while True:
+            jobs = self.queue.get_batch(worker.workers)
+            try:
+                worker.process(jobs)
+            except Exception:
+                logger.exception("Jobs %r failed", jobs)
+            finally:
+                # don't keep transaction open while waiting for jobs
+                connection.close()
+
+    def refresh(self, items, props):
+        pks = {}
+        for item in items:
+            pks.setdefault(item._meta, []).append(item.pk)
+
+        for opts, model_pks in pks.iteritems():
+            self.queue.put((opts.app_label, opts.object_name,
+                            model_pks, list(props)))
+
+
+class Worker(object):
+    """Drain queue and run jobs in pool of threads or processes,
+    pool is one of 'thread', 'process' or 'inline' (run jobs
+    in current thread)"""
+
+    def __init__(self, queue, pool='thread', workers=None):
+        self.queue = queue
+        self.workers = workers or get_setting('WORKERS')
+        self.pool = None
+
+        if pool == 'thread':
+            self.pool = ThreadPool(self.workers)
+        elif pool == 'process':
+            # forked processes shouldn't share database connection
+            connection.close()
+            self.pool = Pool(self.workers)
+        elif pool != 'inline':
+            raise ValueError(u"Unknown pool `%s`" % pool)
+
+    def process(self, jobs):
+        if self.pool is None:
+            return sum(map(run_job, jobs))
+        return sum(self.pool.map(run_job, jobs))
+
+    def drain(self, timeout=0):
+        """Run all jobs available in the queue and return count of
+        updated instances"""
+        count = 0
+        while True:
+            jobs = self.queue.get_batch(self.workers, timeout)
+            if not jobs:
+                return count
+            count += self.process(jobs)
+
+    def run(self):
+        """Run jobs as soon as they are available in the queue"""
+        while True:
+            self.process(self.queue.get_batch(self.workers))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
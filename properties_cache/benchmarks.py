@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+"""Benchmarks of properties cache.
+
+    python benchmarks.py
+        run micro benchmarks and print results
+
+    python benchmarks.py suite --rows 1000 --rows 100000 --fan-out 1 \\
+                               --fan-out 1000 --output results.json
+        run benchmark suite for every combination of count of rows and
+        fan-out and write results as JSON
+
+    python benchmarks.py suite --compare results.json
+        run benchmark suite and compare results with previous ones,
+        exits with status 1 if some of benchmarks became slower or need
+        more memory
+"""
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+from StringIO import StringIO
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'properties_cache',
+            'properties_cache.tests',
+        ],
+        ROOT_URLCONF='',
+        DEBUG=True,
+        SITE_ID=1,
+    )
+
+import django
+
+from django.db import connection, reset_queries, transaction
+from django.utils import simplejson
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+
+
+PAGE_SIZES = (10, 100, 500, 1000)
+FAN_OUTS = (1, 10, 100, 1000)
+
+# default sizes of fixtures of benchmark suite
+SUITE_ROWS = (1000,)
+SUITE_FAN_OUTS = (1, 100)
+
+# count of rows inserted by one statement when fixtures are built
+FIXTURES_CHUNK_SIZE = 10000
+
+# count of instances read by `read_page` benchmark
+READ_PAGE_SIZE = 1000
+
+# imports models in fresh interpreter and prints time of import,
+# settings are configured by import of this module
+STARTUP_CODE = """
+import time
+import benchmarks
+started = time.time()
+import properties_cache.tests.models
+print(time.time() - started)
+"""
+
+# benchmarks slower than previous results by this ratio are regressions,
+# differences shorter than REGRESSION_MIN_TIME seconds are just noise
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_TIME = 0.01
+# growths of peak memory smaller than this are noise too, in kilobytes
+REGRESSION_MIN_MEMORY = 1024
+
+
+def create_objects(count):
+    """Create `count` of PCTestChildModel instances with their parents
+    and return root instance"""
+    from properties_cache.tests.models import PCRootModel, PCTestModel, \
+                                              PCTestChildModel
+
+    root = PCRootModel.objects.create(name='bench-root')
+    parent = PCTestModel.objects.create(name='bench-parent', parent=root)
+
+    for i in range(count):
+        PCTestChildModel.objects.create(name='bench-%d' % i,
+                                        test_model=parent)
+
+    return root
+
+
+def bench_fill_properties_cache(page_sizes=PAGE_SIZES):
+    """Measure time and count of queries of fill_properties_cache
+    against page size"""
+    from properties_cache.managers import fill_properties_cache
+    from properties_cache.tests.models import PCTestChildModel
+
+    create_objects(max(page_sizes))
+
+    results = []
+    for size in page_sizes:
+        objs = list(PCTestChildModel.objects.all()[:size])
+
+        reset_queries()
+        started = time.time()
+        fill_properties_cache(PCTestChildModel, objs)
+        elapsed = time.time() - started
+
+        results.append((size, len(connection.queries), elapsed))
+
+    return results
+
+
+def bench_update_fan_out(fan_outs=FAN_OUTS):
+    """Measure time and count of queries of parent save against count
+    of dependent items"""
+    results = []
+    for fan_out in fan_outs:
+        root = create_objects(fan_out)
+        root.name = 'bench-root-changed'
+
+        reset_queries()
+        started = time.time()
+        root.save()
+        elapsed = time.time() - started
+
+        results.append((fan_out, len(connection.queries), elapsed))
+
+    return results
+
+
+def bench_storage(count=1000):
+    """Compare rows per property and one row per instance storages:
+    time and queries of writing and reading properties of all instances"""
+    from properties_cache.managers import fill_properties_cache
+    from properties_cache.listeners import refresh_properties
+    from properties_cache.models import PropertyCache, PropertyCacheRow
+    from properties_cache.tests.models import PCTestChildModel
+
+    config = PCTestChildModel.PropertiesCache
+    props = config.cached_properties
+    create_objects(count)
+    objs = list(PCTestChildModel.objects.select_related(
+                                        'test_model__parent')[:count])
+
+    results = []
+    for storage in ('rows', 'wide'):
+        PropertyCache.objects.all().delete()
+        PropertyCacheRow.objects.all().delete()
+
+        config.storage = storage
+        try:
+            reset_queries()
+            started = time.time()
+            refresh_properties(objs, props)
+            write = (len(connection.queries), time.time() - started)
+
+            reset_queries()
+            started = time.time()
+            fill_properties_cache(PCTestChildModel, objs)
+            read = (len(connection.queries), time.time() - started)
+        finally:
+            del config.storage
+
+        results.append((storage, ) + write + read)
+
+    return results
+
+
+def bench_startup(rounds=5):
+    """Measure time of import of models with cached properties by fresh
+    interpreter and time and count of queries of loading content types
+    of all of them"""
+    from properties_cache.content_types import get_content_type, \
+                                               clear_content_types
+    from properties_cache.listeners import REGISTERED
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    imports = []
+    for i in range(rounds):
+        process = subprocess.Popen([sys.executable, '-c', STARTUP_CODE],
+                                   cwd=cwd, env=env, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        imports.append(float(output.split()[-1]))
+
+    clear_content_types()
+    reset_queries()
+    started = time.time()
+    for model in REGISTERED:
+        get_content_type(model)
+    elapsed = time.time() - started
+
+    return min(imports), len(REGISTERED), len(connection.queries), elapsed
+
+
+def bench_codecs(rounds=10000):
+    """Measure encode/decode throughput and size of values stored by
+    CompactValueField against PickledObjectField"""
+    from picklefield.fields import dbsafe_encode, dbsafe_decode
+    from properties_cache.serializers import encode, decode
+
+    samples = [
+        ('url', u'bench-root/bench-parent/bench-child-1'),
+        ('int', 12345),
+        ('dict', {'title': u'Title', 'count': 10, 'tags': [u'a', u'b']}),
+        ('html', u'<li><a href="/bench/">Item</a></li>' * 100),
+    ]
+
+    results = []
+    for name, value in samples:
+        row = [name]
+        for dumps, loads in ((dbsafe_encode, dbsafe_decode),
+                             (encode, decode)):
+            # database returns values of text columns as unicode
+            encoded = unicode(dumps(value))
+
+            started = time.time()
+            for i in xrange(rounds):
+                dumps(value)
+            encode_rate = rounds / (time.time() - started)
+
+            started = time.time()
+            for i in xrange(rounds):
+                loads(encoded)
+            decode_rate = rounds / (time.time() - started)
+
+            row.extend([len(encoded), encode_rate, decode_rate])
+        results.append(row)
+
+    return results
+
+
+def _insert(model, columns, rows):
+    """Insert rows into table of model without sending any signals"""
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(model._meta.db_table),
+                ", ".join([qn(column) for column in columns]),
+                ", ".join(["%s"] * len(columns)))
+
+    cursor = connection.cursor()
+    for offset in xrange(0, len(rows), FIXTURES_CHUNK_SIZE):
+        cursor.executemany(sql, rows[offset:offset + FIXTURES_CHUNK_SIZE])
+    transaction.commit_unless_managed()
+
+
+def build_fixtures(rows, fan_out):
+    """Build hierarchy of `rows` of PCTestChildModel instances, every
+    PCRootModel has one PCTestModel with `fan_out` of children. Instances
+    are inserted without signals, so properties cache is empty."""
+    from properties_cache.tests.models import PCRootModel, PCTestModel, \
+                                              PCTestChildModel
+
+    parents = max(rows // fan_out, 1)
+    _insert(PCRootModel, ['id', 'name'],
+            [(i, 'root-%d' % i) for i in xrange(1, parents + 1)])
+    _insert(PCTestModel, ['id', 'name', 'parent_id'],
+            [(i, 'parent-%d' % i, i) for i in xrange(1, parents + 1)])
+    _insert(PCTestChildModel, ['id', 'name', 'test_model_id'],
+            [(i, 'child-%d' % i, (i - 1) // fan_out + 1)
+                                            for i in xrange(1, rows + 1)])
+
+
+def peak_memory():
+    """Return peak resident memory of process in kilobytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # it's in bytes on Mac OS X
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def measure_memory(fnc):
+    """Return growth of peak memory of process while running fnc in forked
+    child, so peak of this process reached by previous benchmarks doesn't
+    hide it. Changes of database made by child are rolled back. Return
+    None if processes can't be forked."""
+    if not hasattr(os, 'fork'):
+        return None
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        status = 1
+        try:
+            # peak memory of forked child starts at its current memory
+            memory = peak_memory()
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                fnc()
+            finally:
+                transaction.rollback()
+            os.write(write_fd, str(peak_memory() - memory))
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    stream = os.fdopen(read_fd)
+    try:
+        output = stream.read()
+    finally:
+        stream.close()
+    os.waitpid(pid, 0)
+    return output and int(output) or None
+
+
+def measure(fnc):
+    """Return wall time, count of queries and growth of peak memory
+    while running fnc, memory is measured by separate run of fnc
+    (see measure_memory)"""
+    memory = measure_memory(fnc)
+
+    reset_queries()
+    started = time.time()
+    fnc()
+    return {
+        'time': time.time() - started,
+        'queries': len(connection.queries),
+        'peak_memory_kb': memory,
+    }
+
+
+def run_suite(rows, fan_out):
+    """Build fixtures and measure hot paths of properties cache: rebuild
+    of whole cache, reads with properties, save of single instance, save
+    of parent with `fan_out` of dependent instances, single and bulk
+    deletes. Return dictionary {benchmark: results}."""
+    from django.core.management import call_command
+    from properties_cache.tests.models import PCRootModel, PCTestModel, \
+                                              PCTestChildModel
+
+    build_fixtures(rows, fan_out)
+
+    def rebuild():
+        call_command('rebuild_properties_cache', chunk_size=1000,
+                     stdout=StringIO())
+
+    def read_page():
+        list(PCTestChildModel.objects.properties()[:READ_PAGE_SIZE])
+
+    def read_all():
+        for obj in PCTestChildModel.objects.properties().iterator():
+            pass
+
+    def save_single():
+        obj = PCTestChildModel.objects.order_by('-pk')[0]
+        obj.name = 'child-changed'
+        obj.save()
+
+    def save_parent():
+        root = PCRootModel.objects.get(pk=1)
+        root.name = 'root-changed'
+        root.save()
+
+    def delete_single():
+        PCTestChildModel.objects.order_by('-pk')[0].delete()
+
+    def delete_bulk():
+        PCTestChildModel.objects.filter(test_model=PCTestModel.objects\
+                                                        .get(pk=1)).delete()
+
+    results = {}
+    for name, fnc in (('rebuild', rebuild),
+                      ('read_page', read_page),
+                      ('read_all', read_all),
+                      ('save_single', save_single),
+                      ('save_parent', save_parent),
+                      ('delete_single', delete_single),
+                      ('delete_bulk', delete_bulk)):
+        results[name] = measure(fnc)
+    return results
+
+
+def format_memory(memory):
+    return memory is None and '-' or str(memory)
+
+
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    """Return list of (key, benchmark, old time, new time, old queries,
+    new queries, old memory, new memory, is regression) of benchmarks
+    found in both results"""
+    compared = []
+    for key in sorted(new['results']):
+        for name in sorted(new['results'][key]):
+            try:
+                before = old['results'][key][name]
+            except KeyError:
+                continue
+            after = new['results'][key][name]
+
+            slowdown = after['time'] - before['time']
+            regression = after['queries'] > before['queries'] or (
+                            slowdown > before['time'] * threshold and \
+                            slowdown > REGRESSION_MIN_TIME)
+
+            # memory isn't known if it wasn't measured
+            old_memory = before.get('peak_memory_kb')
+            new_memory = after.get('peak_memory_kb')
+            if old_memory is not None and new_memory is not None:
+                growth = new_memory - old_memory
+                regression = regression or (
+                            growth > old_memory * threshold and \
+                            growth > REGRESSION_MIN_MEMORY)
+
+            compared.append((key, name, before['time'], after['time'],
+                             before['queries'], after['queries'],
+                             old_memory, new_memory, regression))
+    return compared
+
+
+def setup_environment():
+    parent = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+    )
+    sys.path.insert(0, parent)
+    setup_test_environment()
+
+
+def runsuite(rows=SUITE_ROWS, fan_outs=SUITE_FAN_OUTS, output=None,
+             compare=None, threshold=REGRESSION_THRESHOLD):
+    setup_environment()
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': settings.DATABASE_ENGINE,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': {},
+    }
+
+    print("%-24s %-14s %10s %10s %12s" % ('fixtures', 'benchmark',
+                                    'time (ms)', 'queries', 'memory (KB)'))
+    try:
+        for count in rows:
+            for fan_out in fan_outs:
+                old_name = settings.DATABASE_NAME
+                connection.creation.create_test_db(verbosity=0)
+                try:
+                    suite = run_suite(count, fan_out)
+                finally:
+                    connection.creation.destroy_test_db(old_name,
+                                                        verbosity=0)
+
+                key = 'rows=%d,fan_out=%d' % (count, fan_out)
+                results['results'][key] = suite
+                for name in sorted(suite):
+                    print("%-24s %-14s %10.2f %10d %12s" % (key, name,
+                                suite[name]['time'] * 1000,
+                                suite[name]['queries'],
+                                format_memory(suite[name]['peak_memory_kb'])))
+    finally:
+        teardown_test_environment()
+
+    if output:
+        stream = open(output, 'w')
+        try:
+            simplejson.dump(results, stream, indent=2, sort_keys=True)
+        finally:
+            stream.close()
+
+    if not compare:
+        return True
+
+    stream = open(compare)
+    try:
+        old = simplejson.load(stream)
+    finally:
+        stream.close()
+
+    print("")
+    print("%-24s %-14s %10s %10s %8s %8s %10s %10s" % ('fixtures',
+                'benchmark', 'old (ms)', 'new (ms)', 'old q', 'new q',
+                'old KB', 'new KB'))
+    passed = True
+    for key, name, old_time, new_time, old_queries, new_queries, \
+                old_memory, new_memory, regression in compare_results(
+                                                old, results, threshold):
+        print("%-24s %-14s %10.2f %10.2f %8d %8d %10s %10s%s" % (key, name,
+                    old_time * 1000, new_time * 1000, old_queries,
+                    new_queries, format_memory(old_memory),
+                    format_memory(new_memory),
+                    regression and '  REGRESSION' or ''))
+        passed = passed and not regression
+    return passed
+
+
+def runbenchmarks():
+    setup_environment()
+
+    old_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        print("fill_properties_cache:")
+        print("%10s %10s %12s" % ('page size', 'queries', 'time (ms)'))
+        for size, queries, elapsed in bench_fill_properties_cache():
+            print("%10d %10d %12.2f" % (size, queries, elapsed * 1000))
+
+        print("")
+        print("parent save with dependent items:")
+        print("%10s %10s %12s" % ('fan-out', 'queries', 'time (ms)'))
+        for fan_out, queries, elapsed in bench_update_fan_out():
+            print("%10d %10d %12.2f" % (fan_out, queries, elapsed * 1000))
+
+        print("")
+        print("storage (write queries, time ms, read queries, time ms):")
+        for storage, wq, wt, rq, rt in bench_storage():
+            print("%6s %6d %10.2f %6d %10.2f" % (storage, wq, wt * 1000,
+                                                 rq, rt * 1000))
+
+        print("")
+        print("startup (import time ms, models, content type queries, "
+              "time ms):")
+        imported, models, queries, elapsed = bench_startup()
+        print("%10.2f %6d %6d %10.2f" % (imported * 1000, models, queries,
+                                         elapsed * 1000))
+
+        print("")
+        print("values: pickle vs compact (size, encodes/s, decodes/s):")
+        for row in bench_codecs():
+            print("%6s %6d %10.0f %10.0f | %6d %10.0f %10.0f" % tuple(row))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [suite] [options]")
+    parser.add_option('--rows', action='append', type='int', default=[],
+        help='Count of PCTestChildModel instances (use multiple --rows '
+             'to run suite with several sizes).')
+    parser.add_option('--fan-out', action='append', type='int',
+        dest='fan_outs', default=[],
+        help='Count of instances depending on one parent (use multiple '
+             '--fan-out to run suite with several fan-outs).')
+    parser.add_option('--output', default=None,
+        help='Write results of suite to this JSON file.')
+    parser.add_option('--compare', default=None,
+        help='Compare results of suite with results in this JSON file.')
+    parser.add_option('--threshold', default=REGRESSION_THRESHOLD,
+        type='float', help='Ratio of slowdown reported as regression.')
+    options, args = parser.parse_args(argv)
+
+    if args != ['suite']:
+        runbenchmarks()
+        return 0
+
+    passed = runsuite(rows=options.rows or SUITE_ROWS,
+                      fan_outs=options.fan_outs or SUITE_FAN_OUTS,
+                      output=options.output, compare=options.compare,
+                      threshold=options.threshold)
+    return passed and 0 or 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,210 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import get_cache
+
+from properties_cache.conf import get_setting
+from properties_cache.storage import VERSIONS
+
+
+__all__ = ('LRUCache', 'identity_map', 'get_identity_map',
+           'clear_identity_maps', 'get_many', 'set_many', 'invalidate')
+
+
+LOCAL_CACHE = {}
+
+_identity = threading.local()
+
+
+class LRUCache(object):
+    """Bounded in-process cache with time to live of entries,
+    least recently used entries are evicted first"""
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is None:
+                    continue
+
+                expires, value = entry
+                if expires is not None and expires < now:
+                    continue
+
+                # move entry to the end as most recently used
+                self.entries[key] = entry
+                found[key] = value
+        return found
+
+    def set_many(self, data):
+        expires = self.ttl and time.time() + self.ttl or None
+        with self.lock:
+            for key, value in data.iteritems():
+                self.entries.pop(key, None)
+                self.entries[key] = (expires, value)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class identity_map(object):
+    """Context manager keeping properties loaded inside of it in memory
+    as {(content type id, pk): {name: value}}, so properties of same
+    instance are loaded once. Nested blocks use map of outer block."""
+
+    def __enter__(self):
+        maps = _identity.__dict__.setdefault('maps', [])
+        maps.append(maps[-1] if maps else {})
+        return maps[-1]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        maps = getattr(_identity, 'maps', None)
+        if maps:
+            maps.pop()
+
+
+def get_identity_map():
+    """Return identity map of current block or None"""
+    maps = getattr(_identity, 'maps', None)
+    if not maps:
+        return None
+    return maps[-1]
+
+
+def clear_identity_maps():
+    """Drop identity maps of current thread, e.g. when request ends"""
+    _identity.maps = []
+
+
+def get_local_cache():
+    """Return in-process cache configured with PROPERTIES_CACHE_LOCAL_SIZE
+    and PROPERTIES_CACHE_LOCAL_TTL settings or None if it's disabled"""
+    size, ttl = get_setting('LOCAL_SIZE'), get_setting('LOCAL_TTL')
+    if not size:
+        return None
+
+    if (size, ttl) not in LOCAL_CACHE:
+        LOCAL_CACHE.clear()
+        LOCAL_CACHE[(size, ttl)] = LRUCache(size, ttl)
+    return LOCAL_CACHE[(size, ttl)]
+
+
+def get_shared_cache():
+    """Return Django cache backend configured with PROPERTIES_CACHE_CACHE
+    setting or None if it's disabled"""
+    backend = get_setting('CACHE')
+    if not backend:
+        return None
+    return get_cache(backend)
+
+
+def cache_key(content_type, object_pk):
+    return 'properties_cache:%d:%s' % (content_type.pk, object_pk)
+
+
+def get_many(content_type, pks):
+    """Return cached properties of instances found in identity map and
+    cache tiers as dictionary {pk: {name: value}}"""
+    identity = get_identity_map()
+    cached = {}
+    if identity is not None:
+        for pk in pks:
+            props = identity.get((content_type.pk, pk))
+            if props is not None:
+                cached[pk] = props
+        pks = [pk for pk in pks if pk not in cached]
+
+    local, shared = get_local_cache(), get_shared_cache()
+    if (local is None and shared is None) or not pks:
+        return cached
+
+    keys = dict([(cache_key(content_type, pk), pk) for pk in pks])
+
+    found = local is not None and local.get_many(keys) or {}
+    missing = [key for key in keys if key not in found]
+
+    if shared is not None and missing:
+        shared_found = shared.get_many(missing)
+        if local is not None and shared_found:
+            local.set_many(shared_found)
+        found.update(shared_found)
+
+    found = dict([(keys[key], props) for key, props in found.iteritems()])
+    if identity is not None:
+        for pk, props in found.iteritems():
+            identity[(content_type.pk, pk)] = props
+
+    cached.update(found)
+    return cached
+
+
+def set_many(content_type, cached, tiers=True):
+    """Put properties of instances, given as dictionary
+    {pk: {name: value}}, to identity map and cache tiers, only to identity
+    map if `tiers` is False"""
+    identity = get_identity_map()
+    if identity is not None:
+        for pk, props in cached.iteritems():
+            identity[(content_type.pk, pk)] = props
+
+    local, shared = get_local_cache(), get_shared_cache()
+    if not tiers or (local is None and shared is None):
+        return
+
+    data = dict([(cache_key(content_type, pk), props)
+                                    for pk, props in cached.iteritems()])
+    if local is not None:
+        local.set_many(data)
+    if shared is not None:
+        shared.set_many(data, get_setting('CACHE_TIMEOUT'))
+
+
+def invalidate(content_type, pks, values=None):
+    """Remove cached properties of instances from cache tiers, entries of
+    identity map are updated with new values {(pk, name): value} if they
+    are given and removed otherwise"""
+    identity = get_identity_map()
+    if identity is not None:
+        if values is None:
+            for pk in pks:
+                identity.pop((content_type.pk, pk), None)
+        else:
+            for (pk, name), value in values.iteritems():
+                props = identity.get((content_type.pk, pk))
+                # versions of properties aren't known here
+                if props is not None and VERSIONS in props:
+                    del identity[(content_type.pk, pk)]
+                elif props is not None:
+                    props[name] = value
+
+    local, shared = get_local_cache(), get_shared_cache()
+    if local is None and shared is None:
+        return
+
+    keys = [cache_key(content_type, pk) for pk in pks]
+    if local is not None:
+        local.delete_many(keys)
+    if shared is not None:
+        shared.delete_many(keys)
@@ -0,0 +1,54 @@
+from django.conf import settings
+
+
+__all__ = ('get_setting',)
+
+
+DEFAULTS = {
+    # class of backend which recomputes properties cache
+    'BACKEND': 'properties_cache.backends.SyncBackend',
+    # class of backend which recomputes expired properties with
+    # `refresh_ahead` policy while their stale values are read
+    'REFRESH_BACKEND': 'properties_cache.backends.ThreadBackend',
+    # class of queue used by QueueBackend
+    'QUEUE': 'properties_cache.backends.LocalQueue',
+    # count of workers in pool draining the queue
+    'WORKERS': 4,
+    # run jobs of queue which isn't shared between processes
+    # (e.g. LocalQueue) by daemon thread of process which queued them
+    'LOCAL_WORKER': True,
+    # max count of instances in in-process cache of properties,
+    # in-process cache is disabled if it's 0
+    'LOCAL_SIZE': 0,
+    # time to live of instances in in-process cache, in seconds
+    'LOCAL_TTL': 60,
+    # Django cache backend for properties, disabled if it's None
+    'CACHE': None,
+    # timeout of properties in Django cache, in seconds
+    'CACHE_TIMEOUT': None,
+    # alias of database properties are read from (e.g. replica),
+    # chosen by database routers if it's None
+    'READ_DB': None,
+    # alias of database properties are written to,
+    # chosen by database routers if it's None
+    'WRITE_DB': None,
+    # time for which thread reads properties from database it wrote them
+    # to (till end of request at most), in seconds
+    'STICKY_TIMEOUT': 5,
+    # time after which locks of properties being recomputed expire,
+    # in seconds
+    'LOCK_TIMEOUT': 30,
+    # codec of values which aren't scalars: pickle is the fastest,
+    # json and msgpack store smaller values of plain types
+    'CODEC': 'pickle',
+    # values longer than this are compressed, disabled if it's None
+    'COMPRESS_MIN_LENGTH': 1024,
+    # classes of collectors of metrics, e.g.
+    # properties_cache.metrics.MemoryCollector
+    'METRICS': (),
+}
+
+
+def get_setting(name):
+    """Return value of PROPERTIES_CACHE_<name> setting or its default"""
+    return getattr(settings, 'PROPERTIES_CACHE_%s' % name, DEFAULTS[name])
@@ -0,0 +1,76 @@
+from django.contrib.contenttypes.models import ContentType
+
+
+__all__ = ('register_model', 'get_content_type', 'get_model',
+           'load_content_types', 'clear_content_types')
+
+
+# models which content types are loaded at once when the first
+# of them is needed, registered when their signals are wired
+MODELS = []
+
+# content types of models and models of content type ids,
+# shared by read and write paths
+CONTENT_TYPES = {}
+CONTENT_TYPE_MODELS = {}
+
+
+def _get_concrete(model):
+    # content types of proxy models are content types of concrete models
+    while model._meta.proxy:
+        model = model._meta.proxy_for_model
+    return model
+
+
+def register_model(model):
+    """Load content type of model with content types of other
+    registered models"""
+    if model not in MODELS:
+        MODELS.append(model)
+
+
+def load_content_types(models):
+    """Load content types of models with one query, content types which
+    don't exist yet are created"""
+    missing = {}
+    for model in models:
+        if model not in CONTENT_TYPES:
+            opts = _get_concrete(model)._meta
+            missing.setdefault((opts.app_label, opts.object_name.lower()),
+                               []).append(model)
+    if not missing:
+        return
+
+    app_labels = set([app_label for app_label, name in missing])
+    for content_type in ContentType.objects.filter(app_label__in=app_labels):
+        for model in missing.pop((content_type.app_label,
+                                  content_type.model), ()):
+            CONTENT_TYPES[model] = content_type
+            CONTENT_TYPE_MODELS[content_type.pk] = _get_concrete(model)
+
+    for models in missing.values():
+        for model in models:
+            content_type = ContentType.objects.get_for_model(model)
+            CONTENT_TYPES[model] = content_type
+            CONTENT_TYPE_MODELS[content_type.pk] = _get_concrete(model)
+
+
+def get_content_type(model):
+    """Return content type of model, content types of all registered
+    models are loaded with it"""
+    if model not in CONTENT_TYPES:
+        load_content_types(MODELS + [model])
+    return CONTENT_TYPES[model]
+
+
+def get_model(content_type):
+    """Return model of content type without populating app cache"""
+    model = CONTENT_TYPE_MODELS.get(content_type.pk)
+    if model is None:
+        model = content_type.model_class()
+    return model
+
+
+def clear_content_types():
+    CONTENT_TYPES.clear()
+    CONTENT_TYPE_MODELS.clear()
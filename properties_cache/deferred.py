@@ -0,0 +1,155 @@
+import logging
+import threading
+
+from functools import wraps
+
+from django.db import transaction
+
+
+__all__ = ('deferred_updates', 'is_deferred', 'mark_dirty')
+
+
+logger = logging.getLogger('properties_cache')
+
+_state = threading.local()
+
+
+def _get_stack():
+    if not hasattr(_state, 'stack'):
+        _state.stack = []
+    return _state.stack
+
+
+def _base_model(model):
+    # instances loaded with defer()/only() have generated
+    # subclass of model, so use original model instead
+    if getattr(model, '_deferred', False):
+        return model._meta.proxy_for_model
+    return model
+
+
+class DirtySet(object):
+    """Set of (model, pk, property) entries which should be recomputed,
+    duplicated entries are collapsed"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return sum([len(props) for pks in self.entries.itervalues()
+                               for props in pks.itervalues()])
+
+    def add(self, model, pk, props):
+        self.entries.setdefault(_base_model(model), {})\
+                    .setdefault(pk, set()).update(props)
+
+    def update(self, other):
+        for model, pks in other.entries.iteritems():
+            for pk, props in pks.iteritems():
+                self.add(model, pk, props)
+
+    def flush(self):
+        """Recompute properties of all instances which still exist
+        and remove properties cache of deleted ones"""
+        from properties_cache.backends import get_backend
+        from properties_cache.listeners import delete_properties, load_items
+        from properties_cache.content_types import get_content_type
+
+        entries, self.entries = self.entries, {}
+
+        for model, pks in entries.iteritems():
+            logger.debug("Flushing deferred update of %d instances "
+                         "of %r", len(pks), model)
+
+            # relations of all properties are loaded with instances
+            dirty_props = set()
+            for pk_props in pks.itervalues():
+                dirty_props.update(pk_props)
+            items = load_items(model, pks.keys(), dirty_props)
+
+            missing = [pk for pk in pks if pk not in items]
+            if missing:
+                names = set()
+                for pk in missing:
+                    names.update(pks[pk])
+                delete_properties(get_content_type(model), missing, names)
+
+            # group instances by set of properties to recompute
+            groups = {}
+            for pk, item in items.iteritems():
+                groups.setdefault(frozenset(pks[pk]), []).append(item)
+
+            for props, group in groups.iteritems():
+                get_backend().refresh(group, props)
+
+
+class DeferredUpdates(object):
+    """Acts as either a decorator, or a context manager. Runs code block in
+    transaction (see django.db.transaction.commit_on_success) and collects
+    properties to update instead of recomputing them on every signal.
+    Collected properties are recomputed once when transaction is committed
+    and dropped on rollback. Blocks inside of managed transaction (e.g.
+    nested blocks) run in savepoint instead, so they don't commit it, and
+    their properties are merged into dirty set of outer block."""
+
+    def __init__(self, using=None):
+        self.using = using
+
+    def __enter__(self):
+        self.managed = transaction.is_managed(using=self.using)
+        if self.managed:
+            self.sid = transaction.savepoint(using=self.using)
+        else:
+            self.transaction = transaction.commit_on_success(using=self.using)
+            self.transaction.__enter__()
+        _get_stack().append(DirtySet())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = _get_stack()
+        dirty = stack.pop()
+
+        if not self.managed:
+            # rollback or commit, dirty set is dropped if commit failed
+            self.transaction.__exit__(exc_type, exc_value, traceback)
+        elif exc_type is not None:
+            transaction.savepoint_rollback(self.sid, using=self.using)
+        else:
+            transaction.savepoint_commit(self.sid, using=self.using)
+
+        if exc_type is not None:
+            logger.debug("Dropping deferred update of %d properties "
+                         "because of rollback", len(dirty))
+            return
+
+        # properties of block inside of transaction which isn't deferred
+        # are written in that transaction, so they're rolled back with it
+        if stack:
+            stack[-1].update(dirty)
+        else:
+            dirty.flush()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return inner
+
+
+def deferred_updates(using=None):
+    """Defer updates of properties cache till the end of transaction,
+    can be used as `@deferred_updates`, `@deferred_updates(using)` or
+    `with deferred_updates():`"""
+    if callable(using):
+        return DeferredUpdates()(using)
+    return DeferredUpdates(using)
+
+
+def is_deferred():
+    """Return True if updates of properties cache are deferred"""
+    return bool(_get_stack())
+
+
+def mark_dirty(model, pk, props):
+    """Add properties of instance to the current dirty set"""
+    _get_stack()[-1].add(model, pk, props)
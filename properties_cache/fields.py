@@ -0,0 +1,73 @@
+from django.db import models
+
+from picklefield.fields import dbsafe_decode, PickledObject, _ObjectWrapper
+
+from properties_cache.serializers import encode, decode, is_encoded
+
+
+__all__ = ('CompactValueField', 'EncodedValue')
+
+
+class EncodedValue(unicode):
+    """Value encoded by CompactValueField already, it's assigned to fields
+    and written to database as is"""
+
+
+class CompactValueField(models.Field):
+    """Field which stores any python object in compact text form (see
+    properties_cache.serializers). Scalars are stored as text, other
+    values with JSON, msgpack or pickle, large values are compressed.
+    Values written by PickledObjectField are read as well."""
+
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', False)
+        super(CompactValueField, self).__init__(*args, **kwargs)
+
+    def get_internal_type(self):
+        return 'TextField'
+
+    def to_python(self, value):
+        if isinstance(value, EncodedValue):
+            return value
+        if is_encoded(value):
+            return decode(value)
+
+        if isinstance(value, basestring):
+            # other strings are read from rows written by PickledObjectField,
+            # storages assign strings computed by properties as EncodedValue
+            try:
+                value = dbsafe_decode(value)
+            except Exception:
+                return value
+            if isinstance(value, _ObjectWrapper):
+                return value._obj
+
+        return value
+
+    def get_db_prep_value(self, value, connection=None, prepared=False):
+        # values pickled with PickledObjectField are stored as is
+        if isinstance(value, (EncodedValue, PickledObject)):
+            return value
+        return encode(value)
+
+    def get_db_prep_lookup(self, lookup_type, value, connection=None,
+                           prepared=False):
+        if lookup_type not in ['exact', 'in', 'isnull']:
+            raise TypeError('Lookup type %s is not supported.' % lookup_type)
+        return super(CompactValueField, self).get_db_prep_lookup(
+                lookup_type, value, connection=connection, prepared=prepared)
+
+    def value_to_string(self, obj):
+        return self.get_db_prep_value(self._get_val_from_obj(obj))
+
+
+# South support
+try:
+    from south.modelsinspector import add_introspection_rules
+except ImportError:
+    pass
+else:
+    add_introspection_rules([],
+                            [r"^properties_cache\.fields\.CompactValueField"])
@@ -0,0 +1,268 @@
+from operator import or_
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import ForeignKey
+from django.db.models.query import QuerySet
+
+
+__all__ = ('Edge', 'DependencyGraph', 'find_path')
+
+
+# max count of foreign keys between dependent and source model
+# followed to discover relation of dependents to source instances
+PATH_DEPTH = 3
+
+
+def find_path(model, target, depth=PATH_DEPTH):
+    """Return list of names of foreign keys leading from model to target
+    model or None if there is no such path or the shortest one isn't
+    unique"""
+    paths = [(model, [])]
+    for i in range(depth):
+        found, following = [], []
+        for current, path in paths:
+            for field in current._meta.fields:
+                if not isinstance(field, ForeignKey):
+                    continue
+                if field.rel.to is target:
+                    found.append(path + [field.name])
+                else:
+                    following.append((field.rel.to, path + [field.name]))
+
+        if found:
+            return len(found) == 1 and found[0] or None
+        paths = following
+    return None
+
+
+class Edge(object):
+    """Dependency of cached properties of `dependent` model on `source`
+    model, all update functions declared for same pair of models are
+    merged into one edge. `fields` is set of fields of source model which
+    properties depend on or None if they depend on any field.
+    `related` is set of relations of dependent model loaded with
+    `select_related` when properties are recomputed."""
+
+    def __init__(self, source, dependent):
+        self.source = source
+        self.dependent = dependent
+        self.functions = []
+        self.props = []
+        self.fields = set()
+        self.related = set()
+
+    def __repr__(self):
+        return "<Edge %s -> %s %s>" % (self.source.__name__,
+                                       self.dependent.__name__,
+                                       repr(self.props))
+
+    @property
+    def name(self):
+        """Names of update functions of edge"""
+        return '+'.join([fnc.__name__ for fnc in self.functions])
+
+    @property
+    def path(self):
+        """Foreign keys leading from dependent to source model, source
+        instances are attached to dependents found by fan-out through it"""
+        if not hasattr(self, '_path'):
+            self._path = None
+            if self.dependent is not self.source:
+                self._path = find_path(self.dependent, self.source)
+        return self._path
+
+    def add(self, fnc, props, fields=None, related=None):
+        self.functions.append(fnc)
+        if related:
+            self.related.update(related)
+        for prop in props:
+            if prop not in self.props:
+                self.props.append(prop)
+
+        if fields is None:
+            self.fields = None
+        elif self.fields is not None:
+            self.fields.update(fields)
+
+    def is_affected(self, changed):
+        """Return True if change of given fields of source instance
+        affects properties, changed is None if changed fields are unknown"""
+        if changed is None or self.fields is None:
+            return True
+        return bool(self.fields & changed)
+
+    def get_related(self):
+        """Return relations which should be loaded with dependents,
+        relation to source model itself is replaced by source instances"""
+        related = set(self.related)
+        if self.path and len(self.path) > 1:
+            related.add('__'.join(self.path[:-1]))
+        return sorted(related)
+
+    def fan_out(self, instances, load_related=False):
+        """Return list of dependent items affected by change of instances,
+        querysets returned by update functions are merged into one query.
+        If `load_related` is True, relations needed by properties are
+        loaded with the query and changed instances are attached to items,
+        so they aren't queried again for every item."""
+        querysets, results = [], []
+        for instance in instances:
+            for fnc in self.functions:
+                result = fnc(instance)
+                if isinstance(result, QuerySet) and \
+                        result.model is self.dependent and \
+                        result.query.can_filter():
+                    querysets.append(result)
+                elif result:
+                    results.append(result)
+
+        if querysets:
+            queryset = reduce(or_, querysets)
+            related = load_related and self.get_related()
+            if related:
+                queryset = queryset.select_related(*related)
+            results.append(queryset)
+
+        items, seen = [], set()
+        for result in results:
+            for item in result:
+                if item.pk not in seen:
+                    seen.add(item.pk)
+                    items.append(item)
+
+        if load_related and self.path:
+            self.attach(items, instances)
+        return items
+
+    def attach(self, items, instances):
+        """Set source instances as related objects of items, so they're
+        shared by all items instead of being loaded for every one of them"""
+        instances = dict([(instance.pk, instance) for instance in instances])
+        for item in items:
+            obj = item
+            for name in self.path[:-1]:
+                obj = getattr(obj, name)
+                if obj is None:
+                    break
+            else:
+                field = obj._meta.get_field(self.path[-1])
+                instance = instances.get(getattr(obj, field.attname))
+                if instance is not None:
+                    setattr(obj, field.get_cache_name(), instance)
+
+
+class DependencyGraph(object):
+    """Graph of dependencies between models compiled from PropertiesCache
+    configurations"""
+
+    def __init__(self):
+        self.edges = []
+        self.plans = {}
+        self.tracked = {}
+
+    def add(self, source, dependent, fnc, props, fields=None, related=None):
+        for edge in self.edges:
+            if edge.source is source and edge.dependent is dependent:
+                break
+        else:
+            edge = Edge(source, dependent)
+            self.edges.append(edge)
+
+        edge.add(fnc, props, fields, related)
+        self.plans = {}
+        self.tracked = {}
+
+    def get_edges(self, source=None):
+        if source is None:
+            return list(self.edges)
+        return [edge for edge in self.edges if edge.source is source]
+
+    def get_sources(self):
+        sources = []
+        for edge in self.edges:
+            if edge.source not in sources:
+                sources.append(edge.source)
+        return sources
+
+    def get_tracked_fields(self, source):
+        """Return list of fields of source model which changes should be
+        tracked to skip updates of dependent properties"""
+        fields = set()
+        for edge in self.get_edges(source):
+            if edge.fields is not None:
+                fields.update(edge.fields)
+        return sorted(fields)
+
+    def get_tracked_attnames(self, source):
+        """Return list of (field name, attribute name) of tracked fields
+        of source model, it's computed once, since it's read whenever
+        instance of source model is loaded"""
+        if source not in self.tracked:
+            opts = source._meta
+            self.tracked[source] = [(name, opts.get_field(name).attname)
+                                for name in self.get_tracked_fields(source)]
+        return self.tracked[source]
+
+    def get_related(self, dependent, props=None):
+        """Return relations of dependent model which its properties
+        depend on, so they're loaded with `select_related` when instances
+        are computed from scratch. If `props` are given, only relations
+        of edges of these properties are returned."""
+        related = set()
+        for edge in self.edges:
+            if edge.dependent is not dependent:
+                continue
+            if props is not None and not set(edge.props) & set(props):
+                continue
+            related.update(edge.related)
+            if edge.path:
+                related.add('__'.join(edge.path))
+        return sorted(related)
+
+    def check_cycles(self):
+        """Raise ImproperlyConfigured if properties of some model depend
+        on themselves through other models"""
+        visited = set()
+
+        def visit(model, path):
+            if model in path:
+                cycle = path[path.index(model):] + [model]
+                raise ImproperlyConfigured(u"Cyclic dependency of "\
+                        u"cached properties: %s" % u" -> ".join(
+                                    [m.__name__ for m in cycle]))
+            if model in visited:
+                return
+
+            for edge in self.get_edges(model):
+                # update of own properties isn't a cycle
+                if edge.dependent is not model:
+                    visit(edge.dependent, path + [model])
+            visited.add(model)
+
+        for source in self.get_sources():
+            visit(source, [])
+
+    def plan(self, source):
+        """Return list of edges which should be followed when instance of
+        source model is changed, ordered by distance from source"""
+        if source not in self.plans:
+            plan, queue, seen = [], [source], set([source])
+            while queue:
+                model = queue.pop(0)
+                for edge in self.get_edges(model):
+                    # own properties of intermediate models aren't changed
+                    if edge.dependent is model and model is not source:
+                        continue
+
+                    plan.append(edge)
+                    if edge.dependent not in seen:
+                        seen.add(edge.dependent)
+                        queue.append(edge.dependent)
+            self.plans[source] = plan
+        return self.plans[source]
+
+    def compile(self):
+        self.check_cycles()
+        for source in self.get_sources():
+            self.plan(source)
+        return self
@@ -1,38 +1,161 @@
 import logging
-import copy
-
-from django.db.models.signals import pre_delete, post_save
-from django.db.models import get_models
-
-from django.contrib.contenttypes.models import ContentType
+import threading
+import time
 
+from contextlib import contextmanager
 
-__all__ = ('setup_signals', 'get_installed_methods', 'update_properties_set')
-
-
-LOGGING_FORMAT = "properties_cache(%(levelname)s): %(asctime)-15s "\
-                 "%(filename)s:%(lineno)s %(message)s"
-logging.basicConfig(format=LOGGING_FORMAT)
+from django.db.models.signals import pre_delete, post_save, post_init, \
+                                     class_prepared
+from django.db.models import get_models
+from django.db.models.loading import cache as app_cache
+
+from properties_cache import cache, content_types, metrics
+from properties_cache.backends import get_backend
+from properties_cache.content_types import get_content_type, get_model
+from properties_cache.deferred import is_deferred, mark_dirty
+from properties_cache.graph import DependencyGraph
+from properties_cache.locks import get_locks, lock_key
+from properties_cache.policies import check_policies, get_eager_properties
+from properties_cache.storage import get_storage, next_version
+
+
+__all__ = ('setup_signals', 'setup_lazy_signals', 'register_model',
+           'get_installed_methods', 'get_dependency_graph',
+           'update_properties_set',
+           'compute_properties', 'refresh_properties', 'store_properties',
+           'load_items',
+           'delete_properties', 'propagate_changes', 'skip_handlers')
+
+
+logger = logging.getLogger('properties_cache')
+
+GRAPH = DependencyGraph()
+
+# models which PropertiesCache configurations are added to GRAPH
+REGISTERED = set()
+
+# instances which changes are already propagated in bulk,
+# see skip_handlers
+_handled = threading.local()
+
+
+def store_properties(content_type, values, version=None):
+    """Write properties cache of instances of one content type in bulk,
+    values is dictionary {(object_pk, property name): value}. Version
+    should be taken with `next_version` before values are computed."""
+    if not values:
+        return
+
+    get_storage(get_model(content_type)).store(content_type, values,
+                                               version)
+    cache.invalidate(content_type,
+                     set([object_pk for object_pk, name in values]), values)
+
+
+def compute_properties(items, props):
+    """Compute properties of items and return them as dictionary
+    {model: {(object_pk, property name): value}}"""
+    collectors = metrics.get_collectors()
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    values, timings = {}, {}
+    for item in items:
+        for target_prop in props:
+            if collectors:
+                started = time.time()
+
+            value = getattr(item, target_prop, None)
+            if callable(value):
+                value = value()
+
+            if collectors:
+                timing = timings.setdefault((item.__class__, target_prop),
+                                            [0, 0])
+                timing[0] += 1
+                timing[1] += time.time() - started
+            if debug:
+                logger.debug(" >> Updating item %r and property "
+                             "`%s`='%s'", item, target_prop, value)
+            values.setdefault(item.__class__, {})[
+                                    (item.pk, target_prop)] = value
+
+    for (model, prop), (count, total) in timings.iteritems():
+        metrics.record(collectors, metrics.RECOMPUTE, model, prop,
+                       total, count)
+
+    return values
+
+
+def load_items(model, pks, props):
+    """Return instances of model with given primary keys as dictionary
+    {pk: instance}, relations which properties depend on are loaded with
+    them (see DependencyGraph.get_related)"""
+    queryset = model._default_manager.all()
+    related = GRAPH.get_related(model, props)
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset.in_bulk(list(pks))
+
+
+def refresh_properties(items, props):
+    """Compute properties of items and write them in bulk. Every property
+    is recomputed by one thread or process at once, others only ask
+    the holder of its lock to recompute it once more."""
+    locks = get_locks()
+    while items:
+        pairs = {}
+        for item in items:
+            content_type = get_content_type(item.__class__)
+            for prop in props:
+                pairs[lock_key(content_type, item.pk, prop)] = (item, prop)
+
+        acquired = locks.acquire(pairs.keys())
+        if not acquired:
+            return
 
-HANDLERS_PROPERTIES = {}
-INSTALLED_METHODS = []
+        try:
+            grouped = {}
+            for key in acquired:
+                item, prop = pairs[key]
+                grouped.setdefault(item, []).append(prop)
+
+            # compute all values first and write them in bulk
+            version = next_version()
+            values = {}
+            for item, item_props in grouped.iteritems():
+                for model, model_values in compute_properties([item],
+                                                item_props).iteritems():
+                    values.setdefault(model, {}).update(model_values)
+
+            for model, model_values in values.iteritems():
+                store_properties(get_content_type(model), model_values,
+                                 version)
+        finally:
+            reruns = locks.release(acquired)
+
+        # properties changed while they were computed
+        # are computed again from fresh instances
+        items, props, pks = [], set(), {}
+        for key in reruns:
+            item, prop = pairs[key]
+            pks.setdefault(item.__class__, set()).add(item.pk)
+            props.add(prop)
+        for model, model_pks in pks.iteritems():
+            items.extend(load_items(model, model_pks, props).values())
+        props = list(props)
+
+
+def delete_properties(content_type, pks, names):
+    """Remove properties cache of instances of one content type"""
+    get_storage(get_model(content_type)).delete(content_type, pks, names)
+    cache.invalidate(content_type, pks)
 
 
 class UpdatePropertiesHandlerBase(object):
     def __new__(cls, sender, instance, *args, **kwargs):
-        from properties_cache.models import PropertyCache
-        item_type = ContentType.objects.get_for_model(instance.__class__)
-
-        logging.debug("Updating properties in %(instance)s (%(model)s) "\
-                        "with %(func)s and props: %(props)s" % {
-        'func': repr(cls.config['fnc']),
-        'props': repr(cls.config['props']),
-        'instance': instance,
-        'model': sender,
-        })
-
-        #TODO: it's wrong, need to be rewritten
-        object_pk = instance.pk
+        logger.debug("Updating properties in %s (%r) with %r and "
+                     "props: %r", instance, sender, cls.config['fnc'],
+                     cls.config['props'])
 
         # get bunch of target items to update
         items_to_update = cls.config['fnc'](instance)
@@ -40,55 +163,22 @@ class UpdatePropertiesHandlerBase(object):
         # interrupt properties update if no
         # related items available
         if not items_to_update:
-            logging.debug("Interruption of updating of items "\
-                          "because of no items to update")
+            logger.debug("Interruption of updating of items "
+                         "because of no items to update")
             return
 
-        # update list of items
-        for item in items_to_update:
-            for target_prop in cls.config['props']:
-                # here we'll remove property in case
-                # if listener called not post_save signal
-                if kwargs['signal'] != post_save:
-                    PropertyCache.objects.filter(
-                                        content_type=item_type,
-                                        object_pk=object_pk,
-                                        name=target_prop).delete()
-                    logging.debug("DELETE object %s with "\
-                            "PK=%s" % (repr(instance), str(instance.pk)))
-                    continue
-
-                value = getattr(item, target_prop, None)
-                if callable(value):
-                    value = value()
-
-                logging.debug(" >> Updating item %(item)s and "\
-                              "property `%(property)s`='%(value)s" % {
-                                'item': repr(item),
-                                'property': target_prop,
-                                'value': value,
-                                })
-                property, created = PropertyCache.objects.get_or_create(
-                                    content_type=item_type,
-                                    object_pk=object_pk,
-                                    name=target_prop,
-                                    defaults={
-                                    'name': target_prop,
-                                    'content_type': item_type,
-                                    'object_pk': object_pk,
-                                    'value': value,
-                                    })
-                # update only if not created
-                if not created:
-                    property.value = value
-                    property.save()
+        process_items(items_to_update, cls.config['props'],
+                      kwargs['signal'])
 
 
 def update_properties_set(fnc, props):
     """This decorator should update a set of properties which provided
     by list of methods in PropertiesCache class."""
 
-    UpdatePropertiesHandler = copy.deepcopy(UpdatePropertiesHandlerBase)
+    # every handler needs its own class, otherwise
+    # all of them would share configuration of the last one
+    UpdatePropertiesHandler = type('UpdatePropertiesHandler',
+                                   (UpdatePropertiesHandlerBase,), {})
 
     UpdatePropertiesHandler.config = {
     'fnc': fnc,
@@ -110,6 +200,8 @@ def setup_self_handler(model, properties):
     UpdateSelfHandler.config = {
     'model': model,
     'properties': properties,
+    'fields': getattr(model.PropertiesCache, 'fields', None),
+    'select_related': getattr(model.PropertiesCache, 'select_related', None),
     }
 
     return UpdateSelfHandler
@@ -130,60 +222,264 @@ def check_config(config):
                         u" which should be updated")
 
 
-def setup_signals(base_class):
-    """Setup signals based from PropertiesCache configuration in any model"""
-
-    # go trough all models and find out PropertiesCache configs
-    for model in get_models():
-        logging.debug("Initializing PropertiesCache for %s" % repr(model))
-        if hasattr(model, 'PropertiesCache'):
-            if not hasattr(model.PropertiesCache, 'cached_properties'):
-                continue
-
-            # parse configuration and setup signals
-            config = model.PropertiesCache
-            config.update_self = setup_self_handler(model,
-                                        config.cached_properties)
-
-            # iterate over PropertiesCache class
-            # and get all update handler functions
-            for attr, val in config.__dict__.iteritems():
-                # if attribute is method
-                is_func = lambda aval: isinstance(aval, type(lambda: 0)) or \
-                                       isinstance(aval, object)
-
-                if not is_func(val) or (is_func(val) and \
-                                        not hasattr(val, 'config')):
-                    continue
-
-                upd_func = val
-                upd_config = val.config
-
-                check_config(upd_config)
+def process_items(items, props, signal):
+    """Recompute or remove properties of items depending on signal"""
+    # defer recomputation or removal till the end of transaction
+    if is_deferred():
+        for item in items:
+            mark_dirty(item.__class__, item.pk, props)
+        return
+
+    if signal != post_save:
+        pks = {}
+        for item in items:
+            pks.setdefault(item.__class__, []).append(item.pk)
+        for model, model_pks in pks.iteritems():
+            delete_properties(get_content_type(model), model_pks, props)
+        return
+
+    get_backend().refresh(items, props)
+
+
+def _get_field_values(instance, fields):
+    """Return values of fields given as list of (name, attname)"""
+    data = instance.__dict__
+    # deferred fields which aren't loaded are skipped
+    return dict([(name, data[attname]) for name, attname in fields
+                 if attname in data])
+
+
+def take_snapshot(sender, instance, **kwargs):
+    """Remember values of fields which properties depend on"""
+    fields = GRAPH.get_tracked_attnames(sender)
+    if fields:
+        instance._pcache_snapshot = _get_field_values(instance, fields)
+
+
+def update_snapshot(sender, instance, update_fields=None):
+    """Remember values of saved fields"""
+    fields = GRAPH.get_tracked_attnames(sender)
+    if update_fields is not None:
+        fields = [(name, attname) for name, attname in fields
+                  if name in update_fields]
+    if fields:
+        instance.__dict__.setdefault('_pcache_snapshot', {}).update(
+                                    _get_field_values(instance, fields))
+
+
+def get_changed_fields(sender, instance, signal, created=False,
+                       update_fields=None, **kwargs):
+    """Return set of tracked fields changed since instance was loaded
+    or None if they are unknown"""
+    snapshot = instance.__dict__.get('_pcache_snapshot')
+    if signal != post_save or created or snapshot is None:
+        return None
+
+    values = _get_field_values(instance, GRAPH.get_tracked_attnames(sender))
+    changed = set([name for name in values
+                   if name not in snapshot or values[name] != snapshot[name]])
+
+    if update_fields is not None:
+        changed &= set(update_fields)
+    return changed
+
+
+def propagate_changes(source, sources, signal, changed=None,
+                      loaded=False):
+    """Follow all edges of dependency graph starting at source model for
+    changed instances of it and recompute or remove properties of their
+    dependents. Fan-out of every edge is done with one query for all
+    instances. If `loaded` is True, instances are fresh from database and
+    they are used as items of own properties without querying them again."""
+    collectors = metrics.get_collectors()
+    instances = {source: list(sources)}
+    collected = []
+
+    graph = get_dependency_graph()
+    for edge in graph.plan(source):
+        sources = instances.get(edge.source)
+        if not sources:
+            continue
+
+        # skip edges which don't depend on changed fields
+        if edge.source is source and not edge.is_affected(changed):
+            logger.debug("Skipping %r, changed fields: %r", edge, changed)
+            continue
+
+        # properties with policies are recomputed when they're read,
+        # but dependents are still needed by following edges
+        edge_props = edge.props
+        if signal == post_save:
+            edge_props = get_eager_properties(edge.dependent, edge_props)
+        if not edge_props and not [e for e in graph.get_edges(edge.dependent)
+                              if e.dependent is not edge.dependent]:
+            continue
+
+        if loaded and edge.source is source and edge.dependent is source:
+            items = sources
+        else:
+            items = edge.fan_out(sources, signal == post_save)
+            if collectors:
+                metrics.record(collectors, metrics.FAN_OUT, edge.dependent,
+                               edge.name, len(items))
+        logger.debug("Found %d items of %r depending on %r", len(items),
+                     edge.dependent, edge.source)
+        if not items:
+            continue
+
+        if edge.dependent is not edge.source:
+            instances.setdefault(edge.dependent, []).extend(items)
+        if not edge_props:
+            continue
+
+        # merge items and properties per dependent model
+        for dependent, dependent_items, props in collected:
+            if dependent is edge.dependent:
+                break
+        else:
+            dependent_items, props = {}, []
+            collected.append((edge.dependent, dependent_items, props))
+
+        for item in items:
+            dependent_items.setdefault(item.pk, item)
+        props.extend([p for p in edge_props if p not in props])
+
+    for dependent, dependent_items, props in collected:
+        process_items(dependent_items.values(), props, signal)
+
+
+@contextmanager
+def skip_handlers(model, pks):
+    """Don't handle signals of instances of model with given primary keys,
+    used while their changes are propagated in bulk"""
+    handled = _handled.__dict__.setdefault('pks', {})
+    model_pks = handled.setdefault(model, set())
+    pks = set(pks) - model_pks
+    model_pks.update(pks)
+    try:
+        yield
+    finally:
+        model_pks.difference_update(pks)
+
+
+def is_handled(model, pk):
+    return pk in _handled.__dict__.get('pks', {}).get(model, ())
+
+
+class UpdateDependentsHandlerBase(object):
+    """Handler of signals of source model, follows all edges of
+    dependency graph starting at this model"""
+    def __new__(cls, sender, instance, signal, *args, **kwargs):
+        if is_handled(cls.source, instance.pk):
+            return
 
-                target_model = upd_config['model']
-                target_props = upd_config['properties']
+        changed = get_changed_fields(cls.source, instance, signal, **kwargs)
+        if signal == post_save:
+            update_snapshot(cls.source, instance,
+                            kwargs.get('update_fields'))
 
-                # connect additional model
-                pair = (model, target_model, target_props)
+        collectors = metrics.get_collectors()
+        if not collectors:
+            propagate_changes(cls.source, [instance], signal, changed)
+            return
 
-                key = 'propscache_%s_%s' % (repr(target_model), repr(model))
+        with metrics.QueryCounter() as counter:
+            propagate_changes(cls.source, [instance], signal, changed)
+        metrics.record(collectors, metrics.QUERIES, cls.source,
+                       signal == post_save and 'post_save' or 'pre_delete',
+                       counter.count)
+
+
+def update_dependents(source):
+    """Return handler of signals of source model"""
+    return type('UpdateDependentsHandler', (UpdateDependentsHandlerBase,),
+                {'source': source})
+
+
+def register_model(model):
+    """Add dependencies of cached properties declared by PropertiesCache
+    configuration of model to dependency graph and connect handlers of
+    their source models"""
+    config = getattr(model, 'PropertiesCache', None)
+    if config is None or not hasattr(config, 'cached_properties') or \
+            model in REGISTERED:
+        return
+    logger.debug("Initializing PropertiesCache for %r", model)
+    REGISTERED.add(model)
+
+    # parse configuration and setup signals
+    config.update_self = setup_self_handler(model, config.cached_properties)
+
+    # iterate over PropertiesCache class
+    # and get all update handler functions
+    sources = []
+    for attr, val in config.__dict__.iteritems():
+        if not callable(val) or not hasattr(val, 'config'):
+            continue
+
+        check_config(val.config)
+        GRAPH.add(val.config['model'], model, val,
+                  val.config['properties'],
+                  val.config.get('fields'),
+                  val.config.get('select_related'))
+        sources.append(val.config['model'])
+    GRAPH.check_cycles()
+    check_policies(model)
+
+    # content types of models are loaded at once when the first is needed
+    content_types.register_model(model)
+
+    # add create/update/delete listeners, one per source model
+    for source in sources:
+        key = 'propscache_%s' % repr(source)
+        post_save.connect(update_dependents(source), sender=source,
+                          weak=False, dispatch_uid=key)
+        pre_delete.connect(update_dependents(source), sender=source,
+                           weak=False, dispatch_uid='%s_del' % key)
+
+        # remember values of fields when instance is loaded
+        # to skip updates which don't change them
+        if GRAPH.get_tracked_fields(source):
+            post_init.connect(take_snapshot, sender=source,
+                              weak=False, dispatch_uid='%s_init' % key)
+
+
+def model_prepared(sender, **kwargs):
+    register_model(sender)
+
+
+def setup_lazy_signals():
+    """Register models declaring PropertiesCache when their classes are
+    prepared instead of importing all installed models at once, models
+    prepared already are registered immediately"""
+    for models in app_cache.app_models.values():
+        for model in models.values():
+            register_model(model)
+
+    class_prepared.connect(model_prepared,
+                           dispatch_uid='properties_cache.register')
+
+
+def setup_signals(base_class=None):
+    """Setup signals based from PropertiesCache configuration in any
+    installed model, dependency graph is built again from scratch"""
+    global GRAPH
+
+    GRAPH = DependencyGraph()
+    REGISTERED.clear()
 
-                # add create/update/delete listeners
-                post_save.connect(
-                    update_properties_set(upd_func, target_props),
-                    sender=target_model,
-                    dispatch_uid='propscache_%s' % key)
+    # go trough all models and find out PropertiesCache configs
+    for model in get_models():
+        register_model(model)
 
-                pre_delete.connect(
-                    update_properties_set(upd_func,
-                        target_props),
-                    sender=target_model,
-                    dispatch_uid='propscache_del_%s' % key)
 
-                INSTALLED_METHODS.append(pair)
+def get_dependency_graph():
+    """Return compiled graph of dependencies between models"""
+    return GRAPH
 
 
 def get_installed_methods():
-    """Return list of methods/models with added cache listeners"""
-    return INSTALLED_METHODS
+    """Return list of (model, source model, properties) with added
+    cache listeners"""
+    return [(edge.dependent, edge.source, edge.props)
+                                    for edge in GRAPH.get_edges()]
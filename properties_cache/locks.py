@@ -0,0 +1,99 @@
+import threading
+
+from properties_cache.cache import get_shared_cache
+from properties_cache.conf import get_setting
+
+
+__all__ = ('get_locks', 'LocalLocks', 'CacheLocks', 'lock_key')
+
+
+LOCKS = {}
+
+
+def lock_key(content_type, object_pk, name):
+    return 'properties_cache:lock:%d:%s:%s' % (content_type.pk,
+                                                object_pk, name)
+
+
+class LocalLocks(object):
+    """Locks of properties held by threads of current process, used when
+    shared cache isn't configured and in tests"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held = set()
+        self.reruns = set()
+
+    def acquire(self, keys):
+        """Acquire free locks and return their keys, properties which locks
+        are held by others are recomputed by holders once more"""
+        acquired, busy = [], []
+        with self.lock:
+            for key in keys:
+                if key in self.held:
+                    busy.append(key)
+                else:
+                    acquired.append(key)
+                    self.held.add(key)
+            self.reruns.update(busy)
+        return acquired
+
+    def release(self, keys):
+        """Release locks and return keys of properties which should
+        be recomputed once more"""
+        with self.lock:
+            self.held.difference_update(keys)
+            reruns = [key for key in keys if key in self.reruns]
+            self.reruns.difference_update(reruns)
+        return reruns
+
+
+class CacheLocks(object):
+    """Locks of properties stored in shared cache, so only one process
+    recomputes a property at once. Locks are acquired with atomic
+    `cache.add` and expire after `timeout` seconds if holder dies."""
+
+    def __init__(self, cache, timeout):
+        self.cache = cache
+        self.timeout = timeout
+
+    def acquire(self, keys):
+        acquired, busy = [], []
+        for key in keys:
+            if self.cache.add(key, 1, self.timeout):
+                acquired.append(key)
+            else:
+                busy.append(key)
+
+        if busy:
+            self.cache.set_many(dict([('%s:rerun' % key, 1)
+                                      for key in busy]), self.timeout)
+            # holders which released locks before reruns were requested
+            # didn't see the requests, so locks are free now
+            for key in busy:
+                if self.cache.add(key, 1, self.timeout):
+                    acquired.append(key)
+        return acquired
+
+    def release(self, keys):
+        # release locks first, so others either acquire them
+        # or request rerun which is seen below
+        self.cache.delete_many(keys)
+
+        reruns = self.cache.get_many(['%s:rerun' % key for key in keys])
+        if reruns:
+            self.cache.delete_many(reruns.keys())
+        return [key[:-len(':rerun')] for key in reruns]
+
+
+def get_locks():
+    """Return locks kept in shared cache if it's configured with
+    PROPERTIES_CACHE_CACHE setting, in-process locks otherwise"""
+    backend = get_setting('CACHE')
+    if backend not in LOCKS:
+        if backend:
+            LOCKS[backend] = CacheLocks(get_shared_cache(),
+                                        get_setting('LOCK_TIMEOUT'))
+        else:
+            LOCKS[backend] = LocalLocks()
+    return LOCKS[backend]
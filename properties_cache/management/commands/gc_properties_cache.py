@@ -0,0 +1,157 @@
+import time
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connections, router
+from django.db.models import IntegerField
+from django.contrib.contenttypes.models import ContentType
+
+from properties_cache import cache
+from properties_cache.routers import db_for_write
+from properties_cache.storage import STORAGES, _delete, _pk_field
+
+
+TEXT_TYPES = ('CharField', 'TextField', 'SlugField')
+INTEGER_TYPES = ('AutoField', 'IntegerField', 'BigIntegerField',
+                 'PositiveIntegerField', 'SmallIntegerField',
+                 'PositiveSmallIntegerField')
+
+# types of integers in CAST of databases which don't accept column types
+# there, e.g. MySQL accepts only SIGNED, UNSIGNED, CHAR and few others
+CAST_TYPES = {
+    'mysql': 'SIGNED',
+}
+
+
+def get_cast_type(pk_field, connection):
+    """Return type text of `object_pk` column is cast to when joined
+    with primary key, '' if it's joined without cast and None if no safe
+    cast is known for type of primary key"""
+    internal_type = pk_field.get_internal_type()
+    if internal_type in TEXT_TYPES:
+        return ''
+    if internal_type not in INTEGER_TYPES:
+        return None
+
+    if connection.vendor in CAST_TYPES:
+        return CAST_TYPES[connection.vendor]
+    # column types of other integer fields may contain constraints
+    if internal_type == 'BigIntegerField':
+        return pk_field.db_type(connection=connection)
+    return IntegerField().db_type(connection=connection)
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', default=1000, dest='batch_size',
+            type='int', help='Count of rows removed at once.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Only report orphaned rows without removing them.'),
+    )
+    help = "Remove properties cache of instances which don't exist anymore."
+
+    def get_missing(self, owner, rows, batch_size):
+        """Return batch of (pk, object_pk) of rows which owner doesn't
+        exist, owners are looked up by primary keys in their database"""
+        to_python = _pk_field(owner).to_python
+        while True:
+            batch = list(rows.values_list('pk', 'object_pk')[:batch_size])
+            if not batch:
+                return []
+
+            existing = set(owner._default_manager.filter(pk__in=[
+                            to_python(object_pk) for pk, object_pk in batch])\
+                                .values_list('pk', flat=True))
+            orphans = [(pk, object_pk) for pk, object_pk in batch
+                       if to_python(object_pk) not in existing]
+            if orphans:
+                return orphans
+            rows = rows.filter(pk__gt=batch[-1][0])
+
+    def get_orphans(self, model, content_type, last_pk, batch_size):
+        """Return batch of (pk, object_pk) of rows of model which owner
+        doesn't exist, rows are found with anti-join to table of owner"""
+        using = db_for_write(model)
+        rows = model.objects.using(using).filter(content_type=content_type,
+                                    pk__gt=last_pk).order_by('pk')
+
+        owner = content_type.model_class()
+        if owner is None:
+            # model is removed, so all its rows are orphaned
+            return list(rows.values_list('pk', 'object_pk')[:batch_size])
+
+        connection = connections[using]
+        pk_field = _pk_field(owner)
+        cast_type = get_cast_type(pk_field, connection)
+
+        # tables are in different databases, so they can't be joined,
+        # or stored text can't be cast to type of primary key
+        if router.db_for_read(owner) != using or cast_type is None:
+            return self.get_missing(owner, rows, batch_size)
+
+        qn = connection.ops.quote_name
+        object_pk = 'c.%s' % qn('object_pk')
+        # cast stored text to type of primary key of owner,
+        # so index of primary key is used by the join
+        if cast_type:
+            object_pk = 'CAST(%s AS %s)' % (object_pk, cast_type)
+
+        sql = "SELECT c.%(pk)s, c.%(object_pk)s FROM %(table)s c "\
+              "LEFT OUTER JOIN %(owner)s o ON o.%(owner_pk)s = %(join)s "\
+              "WHERE c.%(content_type)s = %%s AND c.%(pk)s > %%s "\
+              "AND o.%(owner_pk)s IS NULL "\
+              "ORDER BY c.%(pk)s LIMIT %%s" % {
+            'pk': qn(model._meta.pk.column),
+            'object_pk': qn('object_pk'),
+            'table': qn(model._meta.db_table),
+            'owner': qn(pk_field.model._meta.db_table),
+            'owner_pk': qn(pk_field.column),
+            'join': object_pk,
+            'content_type': qn('content_type_id'),
+        }
+
+        cursor = connection.cursor()
+        cursor.execute(sql, [content_type.pk, last_pk, batch_size])
+        return cursor.fetchall()
+
+    def handle_noargs(self, **options):
+        dry_run = options['dry_run']
+        batch_size = options['batch_size']
+
+        models = []
+        for storage in STORAGES.values():
+            if storage.model not in models:
+                models.append(storage.model)
+
+        total, started = 0, time.time()
+        for model in models:
+            ctype_ids = model.objects.using(db_for_write(model))\
+                            .values_list('content_type', flat=True).distinct()
+            for content_type in ContentType.objects.filter(
+                                                pk__in=list(ctype_ids)):
+                count, last_pk = 0, 0
+                while True:
+                    orphans = self.get_orphans(model, content_type,
+                                               last_pk, batch_size)
+                    if not orphans:
+                        break
+
+                    last_pk = orphans[-1][0]
+                    count += len(orphans)
+                    if not dry_run:
+                        _delete(model, [pk for pk, object_pk in orphans])
+                        cache.invalidate(content_type, [object_pk \
+                                        for pk, object_pk in orphans])
+
+                if count:
+                    self.stdout.write("%s.%s: %s %d orphaned rows of %s\n" % (
+                            content_type.app_label, content_type.model,
+                            dry_run and 'found' or 'removed', count,
+                            model._meta.object_name))
+                total += count
+
+        self.stdout.write("Total: %s %d orphaned rows in %.2fs\n" % (
+                          dry_run and 'found' or 'removed', total,
+                          time.time() - started))
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from properties_cache.backends import get_backend, Worker
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--pool', default='thread', dest='pool',
+            choices=['thread', 'process', 'inline'],
+            help='Run jobs in pool of threads, processes or inline.'),
+        make_option('--workers', default=None, dest='workers', type='int',
+            help='Count of workers in pool, defaults to '
+                 'PROPERTIES_CACHE_WORKERS setting.'),
+        make_option('--burst', action='store_true', dest='burst',
+            default=False,
+            help='Exit when the queue is empty.'),
+    )
+    help = "Run worker which recomputes properties cache queued "\
+           "by QueueBackend."
+
+    def handle_noargs(self, **options):
+        queue = getattr(get_backend(), 'queue', None)
+        if queue is None:
+            raise CommandError("PROPERTIES_CACHE_BACKEND setting "
+                               "doesn't use queue")
+        if not getattr(queue, 'shared', True):
+            raise CommandError("Queue configured with PROPERTIES_CACHE_QUEUE "
+                               "setting isn't shared between processes, its "
+                               "jobs are run by processes which queue them. "
+                               "Configure shared queue to run worker.")
+
+        worker = Worker(queue, pool=options['pool'],
+                        workers=options['workers'])
+        try:
+            if options['burst']:
+                count = worker.drain()
+                self.stdout.write("Updated %d instances\n" % count)
+            else:
+                worker.run()
+        finally:
+            worker.close()
@@ -0,0 +1,175 @@
+import os
+import time
+
+from multiprocessing.pool import Pool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.db.models import get_models, get_model
+from django.utils import simplejson
+
+from properties_cache.listeners import compute_properties, \
+                                       store_properties, load_items
+from properties_cache.content_types import get_content_type
+from properties_cache.storage import next_version
+
+
+def compute_chunk(job):
+    """Compute properties of chunk of instances, job is tuple
+    (app label, model name, list of primary keys, list of properties).
+    Return last primary key of chunk, version and computed values."""
+    app_label, model_name, pks, props = job
+    model = get_model(app_label, model_name)
+
+    version = next_version()
+    items = load_items(model, pks, props).values()
+    values = {}
+    for model_values in compute_properties(items, props).itervalues():
+        values.update(model_values)
+    return pks[-1], version, values
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', action='append', dest='models', default=[],
+            help='Rebuild properties of app_label.ModelName only '
+                 '(use multiple --model to rebuild several models).'),
+        make_option('--property', action='append', dest='properties',
+            default=[],
+            help='Rebuild this property only (use multiple --property '
+                 'to rebuild several properties).'),
+        make_option('--chunk-size', default=1000, dest='chunk_size',
+            type='int', help='Count of instances processed at once.'),
+        make_option('--workers', default=1, dest='workers', type='int',
+            help='Count of processes computing properties, properties '
+                 'are computed in current process if it is 1.'),
+        make_option('--checkpoint', default=None, dest='checkpoint',
+            help='File with progress of rebuild, interrupted rebuild '
+                 'is resumed from it.'),
+    )
+    help = "Rebuild properties cache of models in chunks of primary keys."
+
+    def get_models(self, labels):
+        models = [model for model in get_models() \
+                    if hasattr(model, 'PropertiesCache') and \
+                       hasattr(model.PropertiesCache, 'cached_properties')]
+        if not labels:
+            return models
+
+        selected = []
+        for label in labels:
+            try:
+                app_label, model_name = label.split('.', 1)
+            except ValueError:
+                raise CommandError("Model should be specified as "
+                                   "app_label.ModelName: %s" % label)
+
+            model = get_model(app_label, model_name)
+            if model not in models:
+                raise CommandError("Unknown model with properties "
+                                   "cache: %s" % label)
+            selected.append(model)
+        return selected
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return {}
+        checkpoint = open(path)
+        try:
+            return simplejson.load(checkpoint)
+        finally:
+            checkpoint.close()
+
+    def write_checkpoint(self, path, progress):
+        if not path:
+            return
+        # write to temporary file first to not break checkpoint
+        # if rebuild is interrupted while writing
+        checkpoint = open('%s.tmp' % path, 'w')
+        try:
+            simplejson.dump(progress, checkpoint)
+        finally:
+            checkpoint.close()
+        os.rename('%s.tmp' % path, path)
+
+    def get_jobs(self, model, props, last_pk, chunk_size):
+        """Generate jobs with chunks of primary keys greater than last_pk"""
+        opts = model._meta
+        queryset = model._default_manager.order_by('pk')
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            pks = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return
+
+            last_pk = pks[-1]
+            yield (opts.app_label, opts.object_name, pks, props)
+
+    def handle_noargs(self, **options):
+        checkpoint = options['checkpoint']
+        progress = self.read_checkpoint(checkpoint)
+
+        pool = None
+        if options['workers'] > 1:
+            # forked processes shouldn't share database connection
+            connection.close()
+            pool = Pool(options['workers'])
+
+        total, started = 0, time.time()
+        try:
+            for model in self.get_models(options['models']):
+                opts = model._meta
+                label = '%s.%s' % (opts.app_label, opts.object_name)
+
+                props = model.PropertiesCache.cached_properties
+                if options['properties']:
+                    props = [p for p in props if p in options['properties']]
+                if not props:
+                    continue
+
+                state = progress.get(label, {})
+                if state.get('done'):
+                    self.stdout.write("%s: already rebuilt\n" % label)
+                    continue
+
+                jobs = self.get_jobs(model, props, state.get('last_pk'),
+                                     options['chunk_size'])
+                if pool is None:
+                    results = (compute_chunk(job) for job in jobs)
+                else:
+                    results = pool.imap(compute_chunk, jobs)
+
+                count, model_started = 0, time.time()
+                content_type = get_content_type(model)
+                for last_pk, version, values in results:
+                    store_properties(content_type, values, version)
+
+                    count += len(values)
+                    state['last_pk'] = last_pk
+                    progress[label] = state
+                    self.write_checkpoint(checkpoint, progress)
+
+                state['done'] = True
+                progress[label] = state
+                self.write_checkpoint(checkpoint, progress)
+
+                elapsed = time.time() - model_started
+                total += count
+                self.stdout.write("%s: rebuilt %d rows in %.2fs "
+                                  "(%.1f rows/s)\n" % (label, count,
+                                  elapsed, count / max(elapsed, 1e-6)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - started
+        self.stdout.write("Total: rebuilt %d rows in %.2fs (%.1f rows/s)\n" % (
+                          total, elapsed, total / max(elapsed, 1e-6)))
+
+        # rebuild is finished, so checkpoint isn't needed anymore
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
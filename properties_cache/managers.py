@@ -1,46 +1,398 @@
-from django.db.models.query import QuerySet
-from django.contrib.contenttypes.models import ContentType
+import time
+import weakref
+
+from itertools import islice
+
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet, ITER_CHUNK_SIZE
+from django.db.models.signals import post_save, pre_delete
 
 from model_utils.managers import PassThroughManager
 
-from properties_cache.models import PropertyCache
+from properties_cache import cache, metrics
+from properties_cache.content_types import get_content_type
+from properties_cache.policies import get_policies, is_expired, \
+                                      refresh_ahead
+from properties_cache.routers import reads_written_db
+from properties_cache.storage import get_storage, VERSIONS, \
+                                     PKS_CHUNK_SIZE, _chunks
 
 
 __all__ = ('PropertiesCacheManager', 'PropertiesCacheQuerySet',
-           'fill_properties_cache')
+           'PropertiesPrefetch', 'fill_properties_cache',
+           'load_properties_cache', 'prefetch_properties',
+           'get_default_properties')
+
+
+# number of instances filled with properties cache at once
+# when iterating over PropertiesCacheQuerySet.properties()
+PROPERTIES_CHUNK_SIZE = ITER_CHUNK_SIZE
+
+
+def get_default_properties(model):
+    """Return names of properties loaded unless names are given, large
+    properties listed in `large_properties` of PropertiesCache
+    configuration are loaded only when they are asked for"""
+    config = model.PropertiesCache
+    large = getattr(config, 'large_properties', ())
+    return [name for name in config.cached_properties if name not in large]
+
 
+def load_properties_cache(model, pks, names=None):
+    """Load cached properties of model instances with given primary keys
+    and return them as dictionary {pk: {name: value}}. Only properties
+    with given names are loaded, default properties if names are None.
+    Versions of properties of models with policies are loaded too."""
+    ctype = get_content_type(model)
+    versions = bool(get_policies(model))
+    default = get_default_properties(model)
+    if names is None:
+        names = default
+    large = [name for name in names if name not in default]
+    storage = get_storage(model)
+    # values read from replica may be older than values invalidated in
+    # cache tiers already, so they're kept in identity map only
+    tiers = reads_written_db(storage.model)
 
-CACHED_TYPES = {}
+    # entries of cache tiers hold at least all default properties
+    # and large properties loaded after them
+    cached = cache.get_many(ctype, pks)
+    missing = [pk for pk in pks if pk not in cached]
+    complete = not [name for name in default if name not in names]
 
+    if missing:
+        # no need to filter properties when all of them are loaded
+        if complete and \
+                len(names) == len(model.PropertiesCache.cached_properties):
+            loaded = storage.load(ctype, missing, versions=versions)
+        else:
+            loaded = storage.load(ctype, missing, names, versions)
 
-def fill_properties_cache(model, queryset):
-    """Fill some generic queryset for specific model with properties cache"""
-    # cache content type if it's not cached already
-    if model not in CACHED_TYPES:
-        CACHED_TYPES[model] = ContentType.objects.get_for_model(model)
+        # partially loaded properties aren't cached
+        if complete:
+            cache.set_many(ctype, loaded, tiers)
+        cached.update(loaded)
 
-    ctype = CACHED_TYPES[model]
-    pks = [obj.pk for obj in queryset]
-    pcache = PropertyCache.objects.filter(content_type=ctype,
-                                          object_pk__in=pks)\
-                                  .defer('object_pk', 'name', 'value')
+    if large:
+        partial = [pk for pk in pks if pk not in missing and \
+                   [name for name in large if name not in cached[pk]]]
+        if partial:
+            loaded = storage.load(ctype, partial, large, versions)
+            for pk in partial:
+                props = dict(cached[pk], **loaded[pk])
+                if versions:
+                    props[VERSIONS] = dict(cached[pk].get(VERSIONS, {}),
+                                           **loaded[pk][VERSIONS])
+                cached[pk] = props
+            cache.set_many(ctype, dict([(pk, cached[pk])
+                                        for pk in partial]), tiers)
 
-    attrs = model.PropertiesCache.cached_properties
+    return cached
 
-    for obj in queryset:
-        cached_props = {}
-        [cached_props.update({prop.name: prop.value})\
-            for prop in pcache if prop.object_pk == obj.pk]
 
-        for attr in attrs:
+def fill_properties_cache(model, queryset, names=None):
+    """Fill some generic queryset or list of instances for specific model
+    with properties cache, only properties with given names are loaded
+    (see load_properties_cache). Expired properties with `ttl` policy
+    are recomputed on first access, expired properties with
+    `refresh_ahead` policy are read and recomputed in background."""
+    objects = list(queryset)
+    if not objects:
+        return queryset
+
+    if names is None:
+        names = get_default_properties(model)
+    cached = load_properties_cache(model, set(obj.pk for obj in objects),
+                                   names)
+
+    policies = get_policies(model)
+    now, expired = time.time(), {}
+    for obj in objects:
+        cached_props = cached.get(obj.pk, {})
+        if policies:
+            cached_props = dict(cached_props)
+            versions = cached_props.pop(VERSIONS, {})
+            obj._pcache_versions = dict(obj.__dict__.get(
+                                    '_pcache_versions', ()), **versions)
+            for name, policy in policies.iteritems():
+                if name not in cached_props or \
+                        not is_expired(policy, versions.get(name), now):
+                    continue
+                if policy.get('refresh_ahead'):
+                    expired.setdefault(name, []).append(obj)
+                else:
+                    del cached_props[name]
+                    obj.__dict__.get('_pcache', {}).pop(name, None)
+
+        obj._pcache = dict(obj.__dict__.get('_pcache', ()), **cached_props)
+        obj._pcache_names = obj.__dict__.get('_pcache_names',
+                                             set()) | set(names)
+        for attr in names:
+            if attr not in cached_props:
+                obj._pcache.pop(attr, None)
             setattr(obj, '_pcache_%s' % attr, cached_props.get(attr))
 
+    for name, expired_objects in expired.iteritems():
+        refresh_ahead(expired_objects, [name])
+
+    collectors = metrics.get_collectors()
+    if collectors:
+        for attr in names:
+            hits = len([obj for obj in objects \
+                            if attr in cached.get(obj.pk, ())])
+            metrics.record(collectors, metrics.HIT, model, attr, hits)
+            metrics.record(collectors, metrics.MISS, model, attr,
+                           len(objects) - hits)
+
     return queryset
 
 
+class PropertiesPrefetch(object):
+    """Lookup of related objects filled with properties cache by
+    `prefetch_properties`, e.g. PropertiesPrefetch('test_models__parent').
+    Lists of objects of reverse relations are stored in `to_attr`
+    attribute of instances, it's `prefetched_<accessor name>` by default
+    for every relation of lookup."""
+
+    def __init__(self, lookup, to_attr=None):
+        self.lookup = lookup
+        self.to_attr = to_attr
+
+    def __repr__(self):
+        return "<PropertiesPrefetch %s>" % self.lookup
+
+
+def _get_relation(model, name):
+    """Return (field, direct) of relation of model with given name,
+    name of reverse relation is its query name or accessor name"""
+    opts = model._meta
+    try:
+        field, field_model, direct, m2m = opts.get_field_by_name(name)
+    except FieldDoesNotExist:
+        for related in opts.get_all_related_objects():
+            if related.get_accessor_name() == name:
+                field, direct, m2m = related, False, False
+                break
+        else:
+            raise ValueError(u"%s has no relation `%s`" % (
+                                                opts.object_name, name))
+
+    if m2m or (direct and not field.rel):
+        raise ValueError(u"Only foreign keys and their reverse relations "
+                         u"can be prefetched: %s" % name)
+    return field, direct
+
+
+def _prefetch_forward(objects, field):
+    """Load objects related with foreign key which aren't loaded already
+    (e.g. by select_related) with one query per chunk of keys and return
+    all of them"""
+    cache_name = field.get_cache_name()
+    missing = set([getattr(obj, field.attname) for obj in objects
+                   if cache_name not in obj.__dict__])
+    missing.discard(None)
+
+    loaded = {}
+    if missing:
+        to_field = field.rel.get_related_field()
+        for chunk in _chunks(missing, PKS_CHUNK_SIZE):
+            for related in field.rel.to._default_manager.filter(
+                        **{'%s__in' % to_field.name: chunk}):
+                loaded[getattr(related, to_field.attname)] = related
+
+    related_objects = []
+    for obj in objects:
+        if cache_name not in obj.__dict__:
+            setattr(obj, cache_name, loaded.get(getattr(obj,
+                                                        field.attname)))
+        related = obj.__dict__[cache_name]
+        if related is not None:
+            related_objects.append(related)
+    return related_objects
+
+
+def _prefetch_reverse(objects, related, to_attr):
+    """Load objects of reverse relation of all objects with one query per
+    chunk of objects, store them in `to_attr` attribute of objects and
+    return all of them"""
+    field = related.field
+    to_field = field.rel.get_related_field()
+    values = set([getattr(obj, to_field.attname) for obj in objects])
+
+    grouped, related_objects = {}, []
+    for chunk in _chunks(values, PKS_CHUNK_SIZE):
+        related_objects.extend(related.model._default_manager.filter(
+                                        **{'%s__in' % field.name: chunk}))
+    for obj in related_objects:
+        grouped.setdefault(getattr(obj, field.attname), []).append(obj)
+
+    unique = not field.rel.multiple
+    for obj in objects:
+        group = grouped.get(getattr(obj, to_field.attname), [])
+        if unique:
+            # reverse one-to-one relation is cached as usual
+            setattr(obj, related.get_cache_name(), group and group[0] or None)
+        else:
+            setattr(obj, to_attr or 'prefetched_%s' % \
+                                        related.get_accessor_name(), group)
+    return related_objects
+
+
+def prefetch_properties(objects, *lookups):
+    """Load related objects of list of instances and fill them with
+    properties cache. Lookups are names of relations separated by `__`
+    or PropertiesPrefetch instances. Related objects are loaded with one
+    query per relation and chunk of keys and properties cache of all related
+    objects of same model is loaded at once, however deep the lookups are."""
+    objects = list(objects)
+
+    found, done = {}, {}
+    for lookup in lookups:
+        if not isinstance(lookup, PropertiesPrefetch):
+            lookup = PropertiesPrefetch(lookup)
+
+        names = lookup.lookup.split('__')
+        level = objects
+        for index, name in enumerate(names):
+            if not level:
+                break
+
+            # relations shared by several lookups are loaded once
+            prefix = '__'.join(names[:index + 1])
+            if prefix in done:
+                level = done[prefix]
+                continue
+
+            field, direct = _get_relation(level[0].__class__, name)
+            to_attr = index == len(names) - 1 and lookup.to_attr or None
+            if direct:
+                level = _prefetch_forward(level, field)
+            else:
+                level = _prefetch_reverse(level, field, to_attr)
+            done[prefix] = level
+
+            for obj in level:
+                found.setdefault(obj.__class__, {})[obj.pk] = obj
+
+    for model, model_objects in found.iteritems():
+        config = getattr(model, 'PropertiesCache', None)
+        if hasattr(config, 'cached_properties'):
+            fill_properties_cache(model, model_objects.values())
+
+    return objects
+
+
 class PropertiesCacheQuerySet(QuerySet):
-    def properties(self):
-        return fill_properties_cache(self.model, self)
+    def __init__(self, *args, **kwargs):
+        super(PropertiesCacheQuerySet, self).__init__(*args, **kwargs)
+        self._fill_properties = False
+        self._properties_names = None
+        self._prefetch_lookups = ()
+
+    def properties(self, *names):
+        """Return lazy copy of queryset which fills properties cache of
+        results chunk by chunk while they are fetched from database,
+        only properties with given names are loaded if they're given"""
+        for name in names:
+            if name not in self.model.PropertiesCache.cached_properties:
+                raise ValueError(u"Property `%s` isn't cached" % name)
+        return self._clone(_fill_properties=True,
+                           _properties_names=names and list(names) or None)
+
+    def prefetch_properties(self, *lookups):
+        """Return lazy copy of queryset which loads related objects and
+        their properties cache chunk by chunk (see prefetch_properties)"""
+        return self._clone(_prefetch_lookups=self._prefetch_lookups + \
+                                                                lookups)
+
+    def iterator(self):
+        iterator = super(PropertiesCacheQuerySet, self).iterator()
+        return self._properties_iterator(iterator)
+
+    def _properties_iterator(self, iterator):
+        from properties_cache.models import PropertyCacheAbstract
+
+        # instances of source models using this manager don't have
+        # cached properties, so they aren't batched and stay picklable
+        batched = issubclass(self.model, PropertyCacheAbstract) and \
+                  hasattr(getattr(self.model, 'PropertiesCache', None),
+                          'cached_properties')
+        while True:
+            chunk = list(islice(iterator, PROPERTIES_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            # remember instances fetched together, so properties which
+            # aren't filled are loaded for whole chunk on first access
+            # (see properties_cache.models.CachedProperties)
+            if batched:
+                batch = [weakref.ref(obj) for obj in chunk]
+                for obj in chunk:
+                    obj._pcache_batch = batch
+
+            if self._fill_properties:
+                fill_properties_cache(self.model, chunk,
+                                      self._properties_names)
+
+            if self._prefetch_lookups:
+                prefetch_properties(chunk, *self._prefetch_lookups)
+
+            for obj in chunk:
+                yield obj
+
+    def _propagate(self, pks, signal, changed=None):
+        """Propagate changes of instances with given primary keys to their
+        cached properties and properties of dependent models, instances
+        are loaded and processed chunk by chunk"""
+        from properties_cache.listeners import propagate_changes
+
+        pks = list(pks)
+        for offset in range(0, len(pks), PROPERTIES_CHUNK_SIZE):
+            chunk = pks[offset:offset + PROPERTIES_CHUNK_SIZE]
+            instances = list(self.model._default_manager.using(self.db)\
+                                                .filter(pk__in=chunk))
+            propagate_changes(self.model, instances, signal, changed,
+                              loaded=True)
+
+    def update(self, **kwargs):
+        """Update rows and recompute their properties in bulk, only
+        properties depending on updated fields are recomputed"""
+        pks = list(self.values_list('pk', flat=True))
+        rows = super(PropertiesCacheQuerySet, self).update(**kwargs)
+        self._propagate(pks, post_save, set(kwargs))
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        """Delete rows and remove their properties in bulk instead of
+        handling pre_delete signal of every row"""
+        from properties_cache.listeners import skip_handlers
+
+        assert self.query.can_filter(), \
+                "Cannot use 'limit' or 'offset' with delete."
+
+        pks = list(self.values_list('pk', flat=True))
+        self._propagate(pks, pre_delete)
+        with skip_handlers(self.model, pks):
+            super(PropertiesCacheQuerySet, self).delete()
+    delete.alters_data = True
+
+    if hasattr(QuerySet, 'bulk_create'):
+        def bulk_create(self, objs, *args, **kwargs):
+            """Create rows and compute their properties in bulk, objects
+            which primary keys aren't set by database are skipped"""
+            objs = super(PropertiesCacheQuerySet, self).bulk_create(objs,
+                                                        *args, **kwargs)
+            self._propagate([obj.pk for obj in objs if obj.pk is not None],
+                            post_save)
+            return objs
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_fill_properties', self._fill_properties)
+        kwargs.setdefault('_properties_names', self._properties_names)
+        kwargs.setdefault('_prefetch_lookups', self._prefetch_lookups)
+        return super(PropertiesCacheQuerySet, self)._clone(klass=klass,
+                                                setup=setup, **kwargs)
 
 
 class PropertiesCacheManager(PassThroughManager):
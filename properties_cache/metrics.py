@@ -0,0 +1,114 @@
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.dispatch import Signal
+
+from properties_cache.conf import get_setting
+
+
+__all__ = ('get_collectors', 'add_collector', 'remove_collector', 'record',
+           'QueryCounter', 'MemoryCollector', 'SignalExporter',
+           'metric_recorded', 'HIT', 'MISS', 'RECOMPUTE', 'FAN_OUT',
+           'QUERIES')
+
+
+# names of metrics, every metric is recorded for model and name which is
+# name of property (HIT, MISS, RECOMPUTE), names of update functions
+# (FAN_OUT) or name of signal (QUERIES)
+# value is count of instances filled with properties cache
+# which have (HIT) or don't have (MISS) cached property
+HIT = 'hit'
+MISS = 'miss'
+# value is time of computation in seconds, count is count of instances
+RECOMPUTE = 'recompute'
+# value is count of dependent instances found by update functions
+FAN_OUT = 'fan_out'
+# value is count of queries issued while signal was handled
+QUERIES = 'queries'
+
+# sent by SignalExporter for every recorded metric, sender is model
+metric_recorded = Signal(providing_args=['metric', 'name', 'value', 'count'])
+
+LOADED = {}
+ADDED = []
+
+
+def get_collectors():
+    """Return collectors configured with PROPERTIES_CACHE_METRICS setting
+    and added with `add_collector`, metrics aren't computed at all if
+    the list is empty"""
+    paths = tuple(get_setting('METRICS'))
+    if paths not in LOADED:
+        from properties_cache.backends import import_class
+        LOADED[paths] = [import_class(path)() for path in paths]
+
+    if ADDED:
+        return LOADED[paths] + ADDED
+    return LOADED[paths]
+
+
+def add_collector(collector):
+    ADDED.append(collector)
+
+
+def remove_collector(collector):
+    ADDED.remove(collector)
+
+
+def record(collectors, metric, model, name, value, count=1):
+    for collector in collectors:
+        collector.record(metric, model, name, value, count)
+
+
+class QueryCounter(object):
+    """Count queries issued by all connections inside `with` block,
+    queries are recorded only while the block is executed"""
+
+    def __enter__(self):
+        self.started = []
+        for connection in connections.all():
+            self.started.append((connection, connection.use_debug_cursor,
+                                 len(connection.queries)))
+            connection.use_debug_cursor = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.count = 0
+        for connection, use_debug_cursor, start in self.started:
+            self.count += len(connection.queries) - start
+            connection.use_debug_cursor = use_debug_cursor
+            # don't keep queries which wouldn't be recorded otherwise
+            if not settings.DEBUG and not use_debug_cursor:
+                del connection.queries[start:]
+
+
+class MemoryCollector(object):
+    """Keep metrics in memory as {(metric, model, name): [count, total]}"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def record(self, metric, model, name, value, count=1):
+        with self.lock:
+            data = self.data.setdefault((metric, model, name), [0, 0])
+            data[0] += count
+            data[1] += value
+
+    def get(self, metric, model, name):
+        """Return (count, total value) of metric"""
+        return tuple(self.data.get((metric, model, name), (0, 0)))
+
+    def reset(self):
+        with self.lock:
+            self.data.clear()
+
+
+class SignalExporter(object):
+    """Send `metric_recorded` signal for every metric, so metrics can be
+    exported to any monitoring system by its receivers"""
+
+    def record(self, metric, model, name, value, count=1):
+        metric_recorded.send(sender=model, metric=metric, name=name,
+                             value=value, count=count)
@@ -0,0 +1,33 @@
+from django.core.signals import request_finished
+
+from properties_cache.cache import identity_map, clear_identity_maps
+
+
+__all__ = ('IdentityMapMiddleware',)
+
+
+class IdentityMapMiddleware(object):
+    """Keep properties loaded while request is handled in identity map,
+    so properties of same instance are loaded once per request.
+    Add 'properties_cache.middleware.IdentityMapMiddleware' to
+    MIDDLEWARE_CLASSES to enable it."""
+
+    def process_request(self, request):
+        request._properties_identity_map = identity_map()
+        request._properties_identity_map.__enter__()
+
+    def process_response(self, request, response):
+        block = getattr(request, '_properties_identity_map', None)
+        if block is not None:
+            del request._properties_identity_map
+            block.__exit__(None, None, None)
+        return response
+
+
+def clear_identity_maps_handler(sender, **kwargs):
+    # map is dropped even if process_response wasn't called
+    # because of exception raised by other middleware
+    clear_identity_maps()
+
+request_finished.connect(clear_identity_maps_handler,
+                         dispatch_uid='properties_cache.identity_map')
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+    """Tables created by first releases, installations which already have
+    them start with `migrate properties_cache 0001 --fake`"""
+
+    def forwards(self, orm):
+        db.create_table('properties_cache_propertycache', (
+            ('id', self.gf('django.db.models.fields.AutoField')(
+                                                        primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(
+                                                        max_length=64)),
+            ('value', self.gf('picklefield.fields.PickledObjectField')()),
+            ('content_type', self.gf(
+                'django.db.models.fields.related.ForeignKey')(
+                    related_name='urls',
+                    to=orm['contenttypes.ContentType'])),
+            ('object_pk', self.gf(
+                'django.db.models.fields.PositiveIntegerField')()),
+        ))
+        db.send_create_signal('properties_cache', ['PropertyCache'])
+
+        db.create_unique('properties_cache_propertycache',
+                         ['content_type_id', 'object_pk', 'name'])
+
+    def backwards(self, orm):
+        db.delete_unique('properties_cache_propertycache',
+                         ['content_type_id', 'object_pk', 'name'])
+        db.delete_table('properties_cache_propertycache')
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)",
+                     'unique_together': "(('app_label', 'model'),)",
+                     'object_name': 'ContentType',
+                     'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [],
+                          {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [],
+                      {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [],
+                     {'max_length': '100'})
+        },
+        'properties_cache.propertycache': {
+            'Meta': {'unique_together': "(('content_type', 'object_pk', "
+                                        "'name'),)",
+                     'object_name': 'PropertyCache'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [],
+                             {'related_name': "'urls'",
+                              'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [],
+                     {'max_length': '64'}),
+            'object_pk': ('django.db.models.fields.PositiveIntegerField',
+                          [], {}),
+            'value': ('picklefield.fields.PickledObjectField', [], {})
+        }
+    }
+
+    complete_apps = ['properties_cache']
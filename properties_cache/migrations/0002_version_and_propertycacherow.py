@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+    """Versions of cached values and table of wide-row storage"""
+
+    def forwards(self, orm):
+        db.add_column('properties_cache_propertycache', 'version',
+                      self.gf('django.db.models.fields.BigIntegerField')(
+                                                            default=0),
+                      keep_default=False)
+
+        db.create_table('properties_cache_propertycacherow', (
+            ('id', self.gf('django.db.models.fields.AutoField')(
+                                                        primary_key=True)),
+            ('value', self.gf(
+                'properties_cache.fields.CompactValueField')()),
+            ('versions', self.gf(
+                'properties_cache.fields.CompactValueField')(default={})),
+            ('version', self.gf('django.db.models.fields.BigIntegerField')(
+                                                            default=0)),
+            ('content_type', self.gf(
+                'django.db.models.fields.related.ForeignKey')(
+                    related_name='+', db_index=False,
+                    to=orm['contenttypes.ContentType'])),
+            ('object_pk', self.gf('django.db.models.fields.CharField')(
+                                                        max_length=64)),
+        ))
+        db.send_create_signal('properties_cache', ['PropertyCacheRow'])
+
+        db.create_unique('properties_cache_propertycacherow',
+                         ['content_type_id', 'object_pk'])
+
+    def backwards(self, orm):
+        db.delete_unique('properties_cache_propertycacherow',
+                         ['content_type_id', 'object_pk'])
+        db.delete_table('properties_cache_propertycacherow')
+        db.delete_column('properties_cache_propertycache', 'version')
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)",
+                     'unique_together': "(('app_label', 'model'),)",
+                     'object_name': 'ContentType',
+                     'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [],
+                          {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [],
+                      {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [],
+                     {'max_length': '100'})
+        },
+        'properties_cache.propertycache': {
+            'Meta': {'unique_together': "(('content_type', 'object_pk', "
+                                        "'name'),)",
+                     'object_name': 'PropertyCache'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [],
+                             {'related_name': "'urls'",
+                              'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [],
+                     {'max_length': '64'}),
+            'object_pk': ('django.db.models.fields.PositiveIntegerField',
+                          [], {}),
+            'value': ('properties_cache.fields.CompactValueField', [], {}),
+            'version': ('django.db.models.fields.BigIntegerField', [],
+                        {'default': '0'})
+        },
+        'properties_cache.propertycacherow': {
+            'Meta': {'unique_together': "(('content_type', 'object_pk'),)",
+                     'object_name': 'PropertyCacheRow'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [],
+                             {'related_name': "'+'", 'db_index': 'False',
+                              'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'object_pk': ('django.db.models.fields.CharField', [],
+                          {'max_length': '64'}),
+            'value': ('properties_cache.fields.CompactValueField', [], {}),
+            'version': ('django.db.models.fields.BigIntegerField', [],
+                        {'default': '0'}),
+            'versions': ('properties_cache.fields.CompactValueField', [],
+                         {'default': '{}'})
+        }
+    }
+
+    complete_apps = ['properties_cache']
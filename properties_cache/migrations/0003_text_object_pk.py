@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+    """Primary keys of any type stored as text, content type is indexed
+    only as first column of unique index"""
+
+    def forwards(self, orm):
+        db.alter_column('properties_cache_propertycache', 'object_pk',
+                        self.gf('django.db.models.fields.CharField')(
+                                                        max_length=64))
+        db.delete_index('properties_cache_propertycache',
+                        ['content_type_id'])
+
+    def backwards(self, orm):
+        db.create_index('properties_cache_propertycache',
+                        ['content_type_id'])
+        db.alter_column('properties_cache_propertycache', 'object_pk',
+                        self.gf(
+                            'django.db.models.fields.PositiveIntegerField')())
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)",
+                     'unique_together': "(('app_label', 'model'),)",
+                     'object_name': 'ContentType',
+                     'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [],
+                          {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [],
+                      {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [],
+                     {'max_length': '100'})
+        },
+        'properties_cache.propertycache': {
+            'Meta': {'unique_together': "(('content_type', 'object_pk', "
+                                        "'name'),)",
+                     'object_name': 'PropertyCache'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [],
+                             {'related_name': "'urls'", 'db_index': 'False',
+                              'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [],
+                     {'max_length': '64'}),
+            'object_pk': ('django.db.models.fields.CharField', [],
+                          {'max_length': '64'}),
+            'value': ('properties_cache.fields.CompactValueField', [], {}),
+            'version': ('django.db.models.fields.BigIntegerField', [],
+                        {'default': '0'})
+        },
+        'properties_cache.propertycacherow': {
+            'Meta': {'unique_together': "(('content_type', 'object_pk'),)",
+                     'object_name': 'PropertyCacheRow'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [],
+                             {'related_name': "'+'", 'db_index': 'False',
+                              'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'object_pk': ('django.db.models.fields.CharField', [],
+                          {'max_length': '64'}),
+            'value': ('properties_cache.fields.CompactValueField', [], {}),
+            'version': ('django.db.models.fields.BigIntegerField', [],
+                        {'default': '0'}),
+            'versions': ('properties_cache.fields.CompactValueField', [],
+                         {'default': '{}'})
+        }
+    }
+
+    complete_apps = ['properties_cache']
@@ -1,18 +1,27 @@
 from django.db import models
 from django.contrib.contenttypes import generic
 
-from picklefield import PickledObjectField
+from properties_cache.fields import CompactValueField
 
-from listeners import setup_signals
+from listeners import setup_lazy_signals
 
 
 class PropertyCache(models.Model):
     name = models.CharField(max_length=64)
-    value = PickledObjectField()
+    value = CompactValueField()
+    # version of value, values computed earlier never overwrite
+    # values computed later (see properties_cache.storage.next_version),
+    # it's time of computation in microseconds, so it's used as timestamp
+    # of value by policies (see properties_cache.policies)
+    version = models.BigIntegerField(default=0)
 
+    # content type is first column of unique index below,
+    # so separate index of foreign key isn't needed
     content_type = models.ForeignKey('contenttypes.ContentType',
-                    related_name='urls', verbose_name='content type')
-    object_pk = models.PositiveIntegerField()
+                    related_name='urls', verbose_name='content type',
+                    db_index=False)
+    # primary key of any type (integer, UUID, string) stored as text
+    object_pk = models.CharField(max_length=64)
     content_object = generic.GenericForeignKey('content_type', 'object_pk')
 
     def __unicode__(self):
@@ -20,28 +29,148 @@ class PropertyCache(models.Model):
                 self.name, unicode(self.content_object))
 
     class Meta:
-        # one property cache for one model instance
+        # one property cache for one model instance, columns are ordered
+        # for lookups by content type and list of primary keys, so
+        # the index is used by all reads, writes and deletes
         unique_together = ('content_type', 'object_pk', 'name')
 
 
-class PropertyCacheAbstract(models.Model):
-    _props = {}
-    '''
-    # try to get property from cache if its available
+class PropertyCacheRow(models.Model):
+    """All cached properties of one instance, used by models with
+    `storage = 'wide'` in PropertiesCache config"""
+    value = CompactValueField()
+    # versions of properties {name: version} and version of the row
+    # which is increased by every write
+    versions = CompactValueField(default=dict)
+    version = models.BigIntegerField(default=0)
+
+    content_type = models.ForeignKey('contenttypes.ContentType',
+                    related_name='+', verbose_name='content type',
+                    db_index=False)
+    object_pk = models.CharField(max_length=64)
+    content_object = generic.GenericForeignKey('content_type', 'object_pk')
+
+    def __unicode__(self):
+        return "Properties cache for %s" % unicode(self.content_object)
+
+    class Meta:
+        # one row for one model instance
+        unique_together = ('content_type', 'object_pk')
+
+
+class CachedProperties(object):
+    """Accessor of cached properties of model instance, e.g.
+    `obj.cached.get_absolute_url`. Missing properties are loaded for all
+    instances fetched together with this one and if property isn't cached
+    at all, it's computed and stored."""
+    __slots__ = ('_instance',)
+
+    def __init__(self, instance):
+        self._instance = instance
+
     def __getattr__(self, name):
-        # return property from chache if property available
-        if name in self._props_cache:
-            return self._props_cache[name]
+        instance = self._instance
+        if name not in instance.PropertiesCache.cached_properties:
+            raise AttributeError(u"Property `%s` isn't cached" % name)
+
+        cached = instance.__dict__.get('_pcache')
+        if cached is None or name not in cached:
+            cached = self._load(name)
+
+        return cached[name]
+
+    def _load(self, name):
+        from properties_cache.managers import fill_properties_cache, \
+                                              get_default_properties
+
+        instance = self._instance
+        cached = instance.__dict__.get('_pcache')
+        loaded = instance.__dict__.get('_pcache_names', ())
+
+        # load properties of whole batch of instances at once
+        if cached is None or name not in loaded:
+            batch = [ref() for ref in instance.__dict__.get(
+                                                '_pcache_batch', [])]
+            batch = [obj for obj in batch if obj is not None and \
+                    name not in obj.__dict__.get('_pcache_names', ())]
+            if instance not in batch:
+                batch.append(instance)
+
+            # default properties which aren't loaded yet are loaded with it
+            names = [n for n in get_default_properties(instance.__class__)
+                     if n not in loaded]
+            if name not in names:
+                names.append(name)
+
+            fill_properties_cache(instance.__class__, batch, names)
+            cached = instance._pcache
+
+        if name not in cached:
+            self._compute(name)
+
+        return cached
+
+    def _compute(self, name):
+        from properties_cache.listeners import store_properties
+        from properties_cache.content_types import get_content_type
+        from properties_cache.storage import next_version
+
+        instance = self._instance
+        version = next_version()
+        value = getattr(instance, name, None)
+        if callable(value):
+            value = value()
+
+        if instance.pk is not None:
+            store_properties(get_content_type(instance.__class__),
+                             {(instance.pk, name): value}, version)
+
+        instance._pcache[name] = value
+        instance.__dict__.setdefault('_pcache_versions', {})[name] = version
+        setattr(instance, '_pcache_%s' % name, value)
+
+
+class CachedPropertiesDescriptor(object):
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return CachedProperties(instance)
+
+
+class PropertyCacheAbstract(models.Model):
+    cached = CachedPropertiesDescriptor()
 
-        # return default
-        return models.Model.__getattribute__(self, name)
-    '''
     def set_cached_properties(self, properties):
+        cached = self.__dict__.setdefault('_pcache', {})
+        loaded = self.__dict__.setdefault('_pcache_names', set())
         for prop in properties:
-            self._props[prop.name] = prop.value
+            cached[prop.name] = prop.value
+            loaded.add(prop.name)
+            setattr(self, '_pcache_%s' % prop.name, prop.value)
+
+    def __reduce__(self):
+        # instances fetched together are referenced by weak references
+        # which can't be pickled, loaded properties are kept
+        reduced = super(PropertyCacheAbstract, self).__reduce__()
+        if '_pcache_batch' not in reduced[2]:
+            return reduced
+        data = dict(reduced[2])
+        del data['_pcache_batch']
+        return reduced[:2] + (data,) + reduced[3:]
+
+    def get_cached_age(self, name):
+        """Return age of cached value of property in seconds or None if
+        it isn't known, ages of loaded values are known for models with
+        policies (see properties_cache.policies)"""
+        from properties_cache.policies import get_age
+
+        version = self.__dict__.get('_pcache_versions', {}).get(name)
+        if version is None:
+            return None
+        return get_age(version)
 
     class Meta:
         abstract = True
 
 
-setup_signals(PropertyCacheAbstract)
\ No newline at end of file
+setup_lazy_signals()
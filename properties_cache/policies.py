@@ -0,0 +1,58 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from properties_cache.backends import get_backend
+
+
+__all__ = ('get_policies', 'get_eager_properties', 'get_age',
+           'is_expired', 'check_policies', 'refresh_ahead')
+
+
+def get_policies(model):
+    """Return policies of properties declared by `policies` of
+    PropertiesCache configuration as {name: policy}, e.g.
+
+        policies = {
+            # recomputed on read when older than 10 seconds
+            'get_count': {'ttl': 10},
+            # stale value is read and recomputed in background
+            'get_summary': {'ttl': 60, 'refresh_ahead': True},
+        }
+
+    properties without policy are recomputed eagerly by signals"""
+    return getattr(model.PropertiesCache, 'policies', None) or {}
+
+
+def check_policies(model):
+    """Raise ImproperlyConfigured if policies of model are invalid"""
+    for name, policy in get_policies(model).iteritems():
+        if name not in model.PropertiesCache.cached_properties:
+            raise ImproperlyConfigured(u"Policy of `%s` which isn't "
+                                       u"cached property" % name)
+        if not policy.get('ttl'):
+            raise ImproperlyConfigured(u"Policy of `%s` needs "
+                                       u"`ttl`" % name)
+
+
+def get_eager_properties(model, props):
+    """Return properties recomputed when instances are changed"""
+    policies = get_policies(model)
+    if not policies:
+        return props
+    return [prop for prop in props if prop not in policies]
+
+
+def get_age(version, now=None):
+    """Return age of value of given version in seconds"""
+    return (now or time.time()) - version / 1000000.0
+
+
+def is_expired(policy, version, now=None):
+    return version is None or get_age(version, now) > policy['ttl']
+
+
+def refresh_ahead(items, props):
+    """Recompute expired properties of items by backend configured with
+    PROPERTIES_CACHE_REFRESH_BACKEND setting"""
+    get_backend('REFRESH_BACKEND').refresh(items, props)
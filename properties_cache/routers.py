@@ -0,0 +1,85 @@
+import threading
+import time
+
+from django.core.signals import request_finished
+from django.db import router
+
+from properties_cache.conf import get_setting
+
+
+__all__ = ('PropertiesCacheRouter', 'db_for_read', 'db_for_write',
+           'reads_written_db', 'pin', 'unpin')
+
+
+# time till which reads of current thread go to database
+# properties were written to, see pin
+_pinned = threading.local()
+
+
+def _is_cache_model(model):
+    from properties_cache.models import PropertyCache, PropertyCacheRow
+    return model in (PropertyCache, PropertyCacheRow)
+
+
+def db_for_write(model):
+    """Return alias of database properties are written to, configured
+    with PROPERTIES_CACHE_WRITE_DB setting or chosen by routers"""
+    return get_setting('WRITE_DB') or router.db_for_write(model)
+
+
+def db_for_read(model):
+    """Return alias of database properties are read from, configured with
+    PROPERTIES_CACHE_READ_DB setting (e.g. replica) or chosen by routers.
+    Threads which wrote properties read them from database they were
+    written to, so they see their own writes."""
+    if getattr(_pinned, 'until', 0) > time.time():
+        return db_for_write(model)
+    return get_setting('READ_DB') or router.db_for_read(model)
+
+
+def reads_written_db(model):
+    """Return True if properties are read from database they're written
+    to, values read from other databases (e.g. lagging replica) may be
+    stale"""
+    return db_for_read(model) == db_for_write(model)
+
+
+def pin():
+    """Read properties from database they're written to for
+    PROPERTIES_CACHE_STICKY_TIMEOUT seconds or till end of request"""
+    _pinned.until = time.time() + get_setting('STICKY_TIMEOUT')
+
+
+def unpin(**kwargs):
+    _pinned.until = 0
+
+request_finished.connect(unpin, dispatch_uid='properties_cache.unpin')
+
+
+class PropertiesCacheRouter(object):
+    """Route queries of properties cache tables to databases configured
+    with PROPERTIES_CACHE_READ_DB and PROPERTIES_CACHE_WRITE_DB settings,
+    add it to DATABASE_ROUTERS to keep the tables in dedicated database.
+    Tables are created only in database properties are written to."""
+
+    def db_for_read(self, model, **hints):
+        if _is_cache_model(model):
+            return get_setting('READ_DB') or get_setting('WRITE_DB')
+        return None
+
+    def db_for_write(self, model, **hints):
+        if _is_cache_model(model):
+            return get_setting('WRITE_DB')
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # properties cache refers to content types of any database
+        if _is_cache_model(obj1.__class__) or \
+                _is_cache_model(obj2.__class__):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if _is_cache_model(model) and get_setting('WRITE_DB'):
+            return db == get_setting('WRITE_DB')
+        return None
@@ -6,7 +6,15 @@ from django.conf import settings
 
 if not settings.configured:
     settings.configure(
-        DATABASE_ENGINE='sqlite3',
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+            },
+            # replica or dedicated database of properties cache
+            'other': {
+                'ENGINE': 'django.db.backends.sqlite3',
+            },
+        },
         INSTALLED_APPS=[
             'django.contrib.contenttypes',
             'properties_cache',
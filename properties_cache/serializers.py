@@ -0,0 +1,162 @@
+import zlib
+
+from base64 import b64encode, b64decode
+from binascii import a2b_base64, b2a_base64
+try:
+    from cPickle import loads, dumps
+except ImportError:
+    from pickle import loads, dumps
+
+from django.utils import simplejson
+
+from picklefield.fields import dbsafe_decode
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from properties_cache.conf import get_setting
+
+
+__all__ = ('encode', 'decode', 'is_encoded')
+
+
+# all encoded values start with this character, values without it
+# are pickles written by PickledObjectField
+PREFIX = u'\x01'
+
+NONE, TRUE, FALSE = u'n', u'1', u'0'
+INT, FLOAT, UNICODE, STR = u'i', u'f', u'u', u's'
+JSON, MSGPACK, PICKLE, COMPRESSED = u'j', u'm', u'p', u'z'
+
+PICKLE_PROTOCOL = 2
+
+
+def _is_plain(value):
+    """Return True if value consists of types which are encoded by
+    JSON or msgpack without loss"""
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return True
+    if isinstance(value, str):
+        try:
+            value.decode('ascii')
+        except UnicodeDecodeError:
+            return False
+        return True
+    if isinstance(value, list):
+        for item in value:
+            if not _is_plain(item):
+                return False
+        return True
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            if not isinstance(key, basestring) or not _is_plain(key) or \
+                                                   not _is_plain(item):
+                return False
+        return True
+    return False
+
+
+def _encode(value):
+    # fast path for scalar values, most common types are checked first
+    kind = type(value)
+    if kind is int or kind is long:
+        return INT + unicode(value)
+    if kind is unicode:
+        return UNICODE + value
+    if value is None:
+        return NONE
+    if value is True:
+        return TRUE
+    if value is False:
+        return FALSE
+    if kind is float:
+        return FLOAT + repr(value).decode('ascii')
+    if kind is str:
+        try:
+            return STR + value.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+
+    codec = get_setting('CODEC')
+    if codec != 'pickle' and _is_plain(value):
+        if codec == 'msgpack' and msgpack is not None:
+            return MSGPACK + b64encode(msgpack.packb(value)).decode('ascii')
+        return JSON + simplejson.dumps(value, separators=(',', ':'))
+
+    return PICKLE + b2a_base64(dumps(value, PICKLE_PROTOCOL))[:-1]\
+                                                        .decode('ascii')
+
+
+def encode(value):
+    """Encode value to unicode string, codec of values which aren't scalars
+    is set by PROPERTIES_CACHE_CODEC setting (json, msgpack or pickle)"""
+    data = _encode(value)
+
+    min_length = get_setting('COMPRESS_MIN_LENGTH')
+    if min_length and len(data) >= min_length:
+        compressed = COMPRESSED + b64encode(
+                        zlib.compress(data.encode('utf-8'))).decode('ascii')
+        if len(compressed) < len(data):
+            data = compressed
+
+    return PREFIX + data
+
+
+def _decode_str(payload):
+    return payload.encode('utf-8')
+
+
+def _decode_msgpack(payload):
+    if msgpack is None:
+        raise ValueError(u"msgpack is required to decode value")
+    return msgpack.unpackb(b64decode(payload))
+
+
+def _decode_pickle(payload):
+    return loads(a2b_base64(payload))
+
+
+def _decode_compressed(payload):
+    return _decode(zlib.decompress(b64decode(payload)).decode('utf-8'))
+
+
+# decoders of payloads by tag, tags of constants are decoded by CONSTANTS
+DECODERS = {
+    INT: int,
+    UNICODE: unicode,
+    STR: _decode_str,
+    FLOAT: float,
+    JSON: simplejson.loads,
+    MSGPACK: _decode_msgpack,
+    PICKLE: _decode_pickle,
+    COMPRESSED: _decode_compressed,
+}
+CONSTANTS = {NONE: None, TRUE: True, FALSE: False}
+
+
+def _decode(data, start=0):
+    tag = data[start:start + 1]
+    decoder = DECODERS.get(tag)
+    if decoder is not None:
+        return decoder(data[start + 1:])
+    if tag in CONSTANTS:
+        return CONSTANTS[tag]
+    raise ValueError(u"Unknown type of encoded value: %s" % repr(tag))
+
+
+def decode(value):
+    """Decode value encoded with `encode` or pickled by
+    PickledObjectField"""
+    if value[:1] != PREFIX:
+        return dbsafe_decode(value)
+    # common types are decoded without calling _decode
+    decoder = DECODERS.get(value[1:2])
+    if decoder is not None:
+        return decoder(value[2:])
+    return _decode(value, 1)
+
+
+def is_encoded(value):
+    return isinstance(value, basestring) and value.startswith(PREFIX)
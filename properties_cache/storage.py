@@ -0,0 +1,448 @@
+import threading
+import time
+
+from django.db import connections, transaction, IntegrityError
+from django.db.models.query import QuerySet
+from django.db.models.sql.subqueries import DeleteQuery
+
+from properties_cache.content_types import get_model
+from properties_cache.fields import EncodedValue
+from properties_cache.policies import get_policies
+from properties_cache.routers import db_for_read, db_for_write, pin
+
+
+__all__ = ('get_storage', 'next_version', 'RowStorage', 'WideRowStorage',
+           'VERSIONS')
+
+
+# maximum number of primary keys passed to one `object_pk__in` lookup,
+# keeps queries below the bound parameters limit of SQLite (999)
+PKS_CHUNK_SIZE = 500
+
+# maximum number of rows written by one bulk statement
+WRITE_CHUNK_SIZE = 300
+
+# count of attempts to write values changed by others meanwhile
+WRITE_ATTEMPTS = 3
+
+# key of versions of properties {name: version} in properties
+# of instance loaded with versions
+VERSIONS = '__versions__'
+
+_version_lock = threading.Lock()
+_last_version = [0]
+
+
+def next_version():
+    """Return version of values computed from now on, versions are
+    microseconds since epoch increasing within process"""
+    with _version_lock:
+        version = max(int(time.time() * 1000000), _last_version[0] + 1)
+        _last_version[0] = version
+    return version
+
+
+def _chunks(seq, size):
+    seq = list(seq)
+    for offset in range(0, len(seq), size):
+        yield seq[offset:offset + size]
+
+
+def _pk_field(model):
+    """Return field of primary key values of model"""
+    field = model._meta.pk
+    # primary key of inherited model is relation to parent model
+    while field.rel:
+        field = field.rel.get_related_field()
+    return field
+
+
+def _pk_to_python(content_type):
+    """Return function converting primary keys stored as text
+    in `object_pk` columns to primary keys of model of content type"""
+    return _pk_field(get_model(content_type)).to_python
+
+
+def _check_pks(model, pks):
+    """Raise ValueError if primary key doesn't fit `object_pk` column,
+    databases would truncate or reject it"""
+    max_length = model._meta.get_field('object_pk').max_length
+    for pk in pks:
+        if len(unicode(pk)) > max_length:
+            raise ValueError("Primary key %r is longer than %d characters "
+                             "of properties cache" % (pk, max_length))
+
+
+def _bulk_insert(connection, model, rows):
+    """Insert list of new instances of model with one statement"""
+    if hasattr(QuerySet, 'bulk_create'):
+        model.objects.db_manager(connection.alias).bulk_create(rows)
+        return
+
+    # old versions of Django don't have bulk_create,
+    # so insert all rows with single executemany
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [f for f in opts.local_fields if f != opts.pk]
+
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(opts.db_table),
+                ", ".join([qn(f.column) for f in fields]),
+                ", ".join(["%s"] * len(fields)))
+    params = [[f.get_db_prep_save(f.pre_save(row, True),
+                                  connection=connection) for f in fields]
+                                                        for row in rows]
+    connection.cursor().executemany(sql, params)
+
+
+def _bulk_update(connection, model, rows, compare):
+    """Update rows with one statement per chunk, rows is list of
+    (primary key, {field name: value}, version), all rows have same fields.
+    Row is updated only if its `version` column compared with given
+    version by `compare` operator is true, return count of updated rows."""
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [opts.get_field(name) for name in sorted(rows[0][1])]
+    version_field = opts.get_field('version')
+
+    updated = 0
+    for chunk in _chunks(rows, WRITE_CHUNK_SIZE):
+        params, columns = [], []
+        for field in fields:
+            for pk, values, version in chunk:
+                params.extend([pk, field.get_db_prep_save(values[field.name],
+                                                connection=connection)])
+            columns.append("%s = CASE %s %s END" % (qn(field.column),
+                    qn(opts.pk.column),
+                    " ".join(["WHEN %s THEN %s"] * len(chunk))))
+        params.extend([pk for pk, values, version in chunk])
+        for pk, values, version in chunk:
+            params.extend([pk, version])
+
+        sql = "UPDATE %(table)s SET %(columns)s WHERE %(pk)s IN (%(pks)s) "\
+              "AND %(version)s %(compare)s CASE %(pk)s %(cases)s END" % {
+            'table': qn(opts.db_table),
+            'columns': ", ".join(columns),
+            'pk': qn(opts.pk.column),
+            'pks': ", ".join(["%s"] * len(chunk)),
+            'version': qn(version_field.column),
+            'compare': compare,
+            'cases': " ".join(["WHEN %s THEN %s"] * len(chunk)),
+        }
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        updated += cursor.rowcount
+    return updated
+
+
+def _write(model, new_rows, changed_rows, compare):
+    """Insert new rows and update changed ones (see _bulk_update), return
+    True if all rows are written and False if some of them were written
+    by others meanwhile"""
+    if not new_rows and not changed_rows:
+        return True
+
+    using = db_for_write(model)
+    connection = connections[using]
+
+    # rows are written in transaction of caller if there is one, so
+    # they're committed or rolled back together with its changes
+    written = True
+    if new_rows:
+        sid = transaction.savepoint(using=using)
+        try:
+            _bulk_insert(connection, model, new_rows)
+        except IntegrityError:
+            # some rows were inserted by others meanwhile
+            transaction.savepoint_rollback(sid, using=using)
+            written = False
+        else:
+            transaction.savepoint_commit(sid, using=using)
+    if changed_rows:
+        updated = _bulk_update(connection, model, changed_rows, compare)
+        written = written and updated == len(changed_rows)
+    transaction.commit_unless_managed(using=using)
+    pin()
+    return written
+
+
+def _delete(model, pks):
+    """Delete rows with given primary keys without loading instances"""
+    if not pks:
+        return
+
+    using = db_for_write(model)
+    DeleteQuery(model).delete_batch(pks, using)
+    transaction.commit_unless_managed(using=using)
+    pin()
+
+
+def _delete_query(queryset):
+    """Return DELETE query of rows selected by queryset, which should
+    filter only by columns of its own table"""
+    query = DeleteQuery(queryset.model)
+    query.tables = [queryset.model._meta.db_table]
+    query.where = queryset.query.where
+    return query
+
+
+def _delete_where(queryset):
+    """Delete rows selected by queryset with one DELETE statement without
+    loading them, return count of deleted rows"""
+    using = db_for_write(queryset.model)
+    query = _delete_query(queryset)
+    cursor = query.get_compiler(using).execute_sql(None)
+    transaction.commit_unless_managed(using=using)
+    pin()
+    return cursor.rowcount
+
+
+class RowStorage(object):
+    """Store every property of instance in separate PropertyCache row"""
+
+    @property
+    def model(self):
+        from properties_cache.models import PropertyCache
+        return PropertyCache
+
+    def load(self, content_type, pks, names=None, versions=False):
+        """Return properties of instances as dictionary {pk: {name: value}},
+        if `versions` is True, versions of properties are returned under
+        VERSIONS key of properties"""
+        to_python = self.model._meta.get_field('value').to_python
+        pk_to_python = _pk_to_python(content_type)
+
+        loaded = dict([(pk, {}) for pk in pks])
+        if versions:
+            for props in loaded.itervalues():
+                props[VERSIONS] = {}
+
+        using = db_for_read(self.model)
+        for chunk in _chunks(pks, PKS_CHUNK_SIZE):
+            rows = self.model.objects.using(using).filter(
+                            content_type=content_type, object_pk__in=chunk)
+            if names is not None:
+                rows = rows.filter(name__in=names)
+
+            # values_list returns raw database values, so decode them here
+            for object_pk, name, value, version in rows.values_list(
+                            'object_pk', 'name', 'value', 'version'):
+                props = loaded[pk_to_python(object_pk)]
+                props[name] = to_python(value)
+                if versions:
+                    props[VERSIONS][name] = version
+
+        return loaded
+
+    def store(self, content_type, values, version=None):
+        """Write properties of instances in bulk, values is dictionary
+        {(object_pk, property name): value}. Existing rows are read with
+        one query, new rows are inserted with one statement and changed
+        rows are updated with one statement. Rows with unchanged values
+        and rows with values of newer version are skipped."""
+        if version is None:
+            version = next_version()
+        _check_pks(self.model, set([object_pk for object_pk, name in values]))
+
+        for attempt in range(WRITE_ATTEMPTS):
+            new_rows, changed_rows = self._prepare(content_type, values,
+                                                   version)
+            # rows with newer versions written meanwhile aren't updated,
+            # they are skipped after reading them again
+            if _write(self.model, new_rows, changed_rows, '<'):
+                return
+
+    def _prepare(self, content_type, values, version):
+        field = self.model._meta.get_field('value')
+        pk_to_python = _pk_to_python(content_type)
+        names = set([name for object_pk, name in values])
+        # versions of properties with policies are their timestamps,
+        # so they're written even if values aren't changed
+        policies = get_policies(get_model(content_type))
+
+        # rows are read from database they're written to, so versions
+        # compared by writes are up to date
+        using = db_for_write(self.model)
+        existing = {}
+        for pks in _chunks(set([object_pk for object_pk, name in values]),
+                           WRITE_CHUNK_SIZE):
+            rows = self.model.objects.using(using).filter(
+                                             content_type=content_type,
+                                             object_pk__in=pks,
+                                             name__in=names)\
+                                     .values_list('pk', 'object_pk',
+                                                  'name', 'value', 'version')
+            for pk, object_pk, name, raw_value, row_version in rows:
+                existing[(pk_to_python(object_pk), name)] = (pk, raw_value,
+                                                             row_version)
+
+        new_rows, changed_rows = [], []
+        for (object_pk, name), value in values.iteritems():
+            # values are encoded once, so they're compared with stored
+            # values and written without being decoded again
+            value = EncodedValue(field.get_db_prep_value(value))
+            if (object_pk, name) not in existing:
+                new_rows.append(self.model(content_type=content_type,
+                                           object_pk=object_pk,
+                                           name=name,
+                                           value=value,
+                                           version=version))
+                continue
+
+            pk, raw_value, row_version = existing[(object_pk, name)]
+            # value of newer version is stored already
+            if row_version >= version:
+                continue
+            # skip rows which are not changed
+            if name not in policies and value == raw_value:
+                continue
+
+            changed_rows.append((pk, {'value': value, 'version': version},
+                                 version))
+
+        return new_rows, changed_rows
+
+    def delete(self, content_type, pks, names):
+        """Remove properties of instances with one DELETE statement
+        per chunk of primary keys"""
+        for chunk in _chunks(pks, PKS_CHUNK_SIZE):
+            _delete_where(self.model.objects.filter(
+                                    content_type=content_type,
+                                    object_pk__in=chunk,
+                                    name__in=names))
+
+
+class WideRowStorage(object):
+    """Store all properties of instance in one PropertyCacheRow row"""
+
+    @property
+    def model(self):
+        from properties_cache.models import PropertyCacheRow
+        return PropertyCacheRow
+
+    def _read(self, content_type, pks, using):
+        """Return rows of instances in given database as dictionary
+        {pk: (row pk, properties, versions of properties, row version)}"""
+        value_to_python = self.model._meta.get_field('value').to_python
+        versions_to_python = self.model._meta.get_field('versions').to_python
+        pk_to_python = _pk_to_python(content_type)
+
+        rows = {}
+        for chunk in _chunks(pks, PKS_CHUNK_SIZE):
+            for pk, object_pk, value, versions, version in \
+                        self.model.objects.using(using).filter(
+                                content_type=content_type,
+                                object_pk__in=chunk)\
+                                .values_list('pk', 'object_pk', 'value',
+                                             'versions', 'version'):
+                rows[pk_to_python(object_pk)] = (pk, value_to_python(value),
+                                    versions_to_python(versions), version)
+        return rows
+
+    def load(self, content_type, pks, names=None, versions=False):
+        """Return properties of instances as dictionary {pk: {name: value}}
+        (see RowStorage.load)"""
+        loaded = dict([(pk, {}) for pk in pks])
+        for object_pk, row in self._read(content_type, pks,
+                                         db_for_read(self.model)).iteritems():
+            props = row[1]
+            if names is not None:
+                props = dict([(name, value) for name, value \
+                               in props.iteritems() if name in names])
+            if versions:
+                props[VERSIONS] = dict([(name, row[2].get(name))
+                                        for name in props])
+            loaded[object_pk] = props
+
+        if versions:
+            for props in loaded.itervalues():
+                props.setdefault(VERSIONS, {})
+        return loaded
+
+    def store(self, content_type, values, version=None):
+        """Merge properties into rows of instances and write them in bulk,
+        values is dictionary {(object_pk, property name): value}. Properties
+        of newer versions aren't overwritten, rows changed by others while
+        they are merged are merged again."""
+        if version is None:
+            version = next_version()
+
+        props = {}
+        for (object_pk, name), value in values.iteritems():
+            props.setdefault(object_pk, {})[name] = value
+        _check_pks(self.model, props)
+        policies = get_policies(get_model(content_type))
+
+        for attempt in range(WRITE_ATTEMPTS):
+            existing = self._read(content_type, props.keys(),
+                                  db_for_write(self.model))
+
+            new_rows, changed_rows = [], []
+            for object_pk, object_props in props.iteritems():
+                if object_pk not in existing:
+                    new_rows.append(self.model(content_type=content_type,
+                            object_pk=object_pk, value=object_props,
+                            versions=dict([(name, version) \
+                                           for name in object_props]),
+                            version=version))
+                    continue
+
+                pk, stored, versions, row_version = existing[object_pk]
+                merged, merged_versions = dict(stored), dict(versions)
+                refreshed = False
+                for name, value in object_props.iteritems():
+                    # value of newer version is stored already
+                    if versions.get(name, 0) > version:
+                        continue
+                    merged[name] = value
+                    merged_versions[name] = version
+                    # versions of properties with policies are timestamps
+                    refreshed = refreshed or name in policies
+
+                if merged != stored or refreshed:
+                    changed_rows.append((pk, {
+                        'value': merged,
+                        'versions': merged_versions,
+                        'version': max(row_version + 1, version),
+                    }, row_version))
+
+            # rows are updated only if their version isn't changed
+            # since they were read
+            if _write(self.model, new_rows, changed_rows, '='):
+                return
+
+    def delete(self, content_type, pks, names):
+        for attempt in range(WRITE_ATTEMPTS):
+            existing = self._read(content_type, pks,
+                                  db_for_write(self.model))
+
+            deleted, changed_rows = [], []
+            for object_pk, (pk, stored, versions, row_version) \
+                                                in existing.iteritems():
+                remaining = dict([(name, value) for name, value \
+                                  in stored.iteritems() if name not in names])
+                if not remaining:
+                    deleted.append(pk)
+                elif remaining != stored:
+                    changed_rows.append((pk, {
+                        'value': remaining,
+                        'versions': dict([(name, v) for name, v \
+                                in versions.iteritems() if name in remaining]),
+                        'version': row_version + 1,
+                    }, row_version))
+
+            _delete(self.model, deleted)
+            if _write(self.model, [], changed_rows, '='):
+                return
+
+
+STORAGES = {
+    'rows': RowStorage(),
+    'wide': WideRowStorage(),
+}
+
+
+def get_storage(model):
+    """Return storage of properties cache of model selected with
+    `storage` attribute of its PropertiesCache config"""
+    config = getattr(model, 'PropertiesCache', None)
+    return STORAGES[getattr(config, 'storage', 'rows')]
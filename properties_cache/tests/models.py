@@ -4,7 +4,8 @@ from properties_cache.models import PropertyCacheAbstract
 from properties_cache.managers import PropertiesCacheManager
 
 
-__all__ = ('PCRootModel', 'PCTestModel', 'PCTestChildModel')
+__all__ = ('PCRootModel', 'PCTestModel', 'PCTestChildModel',
+           'PCStringPkModel', 'PCPlainModel')
 
 
 class PCRootModel(models.Model):
@@ -42,6 +43,9 @@ class PCTestChildModel(PropertyCacheAbstract):
         'test_method',
         ]
 
+        # own fields which cached properties depend on
+        fields = ['name', 'test_model']
+
         def update_on_pcrootmodel_change(instance):
             """This method shoudl return queryset of instances which should
             be updated or None"""
@@ -51,6 +55,7 @@ class PCTestChildModel(PropertyCacheAbstract):
         update_on_pcrootmodel_change.config = {
             'model': PCRootModel,
             'properties': ['get_absolute_url'],
+            'fields': ['name'],
         }
 
         def update_on_pctestmodel_change(instance):
@@ -61,3 +66,29 @@ class PCTestChildModel(PropertyCacheAbstract):
             'model': PCTestModel,
             'properties': ['get_absolute_url', 'test_method'],
         }
+
+
+class PCStringPkModel(PropertyCacheAbstract):
+    code = models.CharField(max_length=36, primary_key=True)
+    name = models.CharField(max_length=255)
+
+    objects = PropertiesCacheManager()
+
+    def get_label(self):
+        return "%s: %s" % (self.code, self.name)
+
+    def get_html(self):
+        return "<p>%s</p>" % self.name * 100
+
+    class PropertiesCache:
+        cached_properties = ['get_label', 'get_html']
+
+        # loaded only when asked for by name
+        large_properties = ['get_html']
+
+
+class PCPlainModel(models.Model):
+    """Model without properties cache using manager of properties cache"""
+    name = models.CharField(max_length=255)
+
+    objects = PropertiesCacheManager()
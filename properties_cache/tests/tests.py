@@ -3,6 +3,7 @@
 from django import test
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.signals import post_save, pre_delete
+from django.db.models.sql.subqueries import DeleteQuery
 
 from properties_cache.listeners import setup_signals, get_installed_methods
 from properties_cache.models import PropertyCacheAbstract, PropertyCache
@@ -184,7 +185,7 @@ class PropertiesManagerTests(PropertiesCacheTestsBase):
                 property_key = '_pcache_%s' % prop
                 try:
                     cached_prop = [cp.value for cp in properties if \
-                                cp.object_pk == obj.pk and cp.name == prop][0]
+                                cp.object_pk == unicode(obj.pk) and cp.name == prop][0]
                 except:
                     raise AssertionError("Can't find value `%s` for `%d`" % (
                     prop, obj.pk))
@@ -202,9 +203,1811 @@ class PropertiesManagerTests(PropertiesCacheTestsBase):
                 property_key = '_pcache_%s' % prop
                 try:
                     cached_prop = [cp.value for cp in properties if \
-                                cp.object_pk == obj.pk and cp.name == prop][0]
+                                cp.object_pk == unicode(obj.pk) and cp.name == prop][0]
                 except:
                     raise AssertionError("Can't find value `%s` for `%d`" % (
                     prop, obj.pk))
 
                 self.assertEqual(getattr(obj, property_key), cached_prop)
+
+    def test_fill_cache_list(self):
+        """Test filling of properties cache for list of instances"""
+        objs = list(PCTestChildModel.objects.all())
+        fill_properties_cache(PCTestChildModel, objs)
+
+        for obj in objs:
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+            self.assertEqual(obj._pcache_test_method, obj.test_method())
+
+    def test_fill_cache_num_queries(self):
+        """Test that properties cache loaded with one query regardless
+        of count of instances"""
+        from properties_cache import managers
+        managers.get_content_type(PCTestChildModel)
+
+        for i in range(20):
+            PCTestChildModel.objects.create(name='extra-%d' % i,
+                                            test_model=self.first_level[0])
+
+        for size in (1, 5, 25):
+            objs = list(PCTestChildModel.objects.all()[:size])
+            self.assertNumQueries(1, fill_properties_cache,
+                                  PCTestChildModel, objs)
+
+    def test_fill_cache_chunks(self):
+        """Test splitting of large list of primary keys into chunks"""
+        from properties_cache import managers
+        managers.get_content_type(PCTestChildModel)
+
+        from properties_cache import storage
+
+        chunk_size = storage.PKS_CHUNK_SIZE
+        storage.PKS_CHUNK_SIZE = 2
+        try:
+            objs = list(PCTestChildModel.objects.all())
+            self.assertNumQueries(3, fill_properties_cache,
+                                  PCTestChildModel, objs)
+        finally:
+            storage.PKS_CHUNK_SIZE = chunk_size
+
+        for obj in objs:
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+
+    def test_manager_lazy(self):
+        """Test that properties() doesn't evaluate queryset"""
+        self.assertNumQueries(0, lambda: PCTestChildModel.objects.all()\
+                                                    .properties())
+
+    def test_manager_chaining(self):
+        """Test chaining of properties() with other queryset methods"""
+        objs = PCTestChildModel.objects.properties()\
+                                .filter(name__in=['test-1', 'test-2'])\
+                                .order_by('-name')
+
+        self.assertEqual([obj.name for obj in objs], ['test-2', 'test-1'])
+        for obj in objs:
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+
+        obj = PCTestChildModel.objects.properties().order_by('name')[3]
+        self.assertEqual(obj._pcache_test_method, obj.test_method())
+
+        obj = PCTestChildModel.objects.properties().get(name='test-4')
+        self.assertEqual(obj._pcache_test_method, obj.test_method())
+
+    def test_manager_iterator_chunks(self):
+        """Test filling of properties cache per chunk of results"""
+        from properties_cache import managers
+        managers.get_content_type(PCTestChildModel)
+
+        chunk_size = managers.PROPERTIES_CHUNK_SIZE
+        managers.PROPERTIES_CHUNK_SIZE = 2
+        try:
+            objs = PCTestChildModel.objects.all().properties()
+            # one query for instances and one per each chunk of results
+            self.assertNumQueries(4, lambda: list(objs.iterator()))
+
+            for obj in objs.iterator():
+                self.assertEqual(obj._pcache_get_absolute_url,
+                                 obj.get_absolute_url())
+        finally:
+            managers.PROPERTIES_CHUNK_SIZE = chunk_size
+
+
+class PropertiesBulkUpdateTests(PropertiesCacheTestsBase):
+    def get_cached(self, obj, name):
+        return PropertyCache.objects.get(
+            content_type=ContentType.objects.get_for_model(obj.__class__),
+            object_pk=obj.pk, name=name).value
+
+    def test_fan_out_update(self):
+        """Test update of dependent items on parent change"""
+        root = self.root_objects[0]
+        children = [PCTestChildModel.objects.create(name='child-%d' % i,
+                                            test_model=self.first_level[0])
+                                            for i in range(10)]
+        root.name = 'changed-root'
+        root.save()
+
+        for child in children:
+            url = self.get_cached(child, 'get_absolute_url')
+            self.assertEqual(url, 'changed-root/test-0/%s' % child.name)
+
+    def test_fan_out_num_queries(self):
+        """Test that count of write queries doesn't depend on fan-out"""
+        from properties_cache import managers
+        from properties_cache.listeners import update_properties_set
+        for i in range(20):
+            PCTestChildModel.objects.create(name='child-%d' % i,
+                                            test_model=self.first_level[0])
+
+        managers.get_content_type(PCTestChildModel)
+        PropertyCache.objects.all().delete()
+        instance = self.first_level[0]
+
+        def upd_func(instance):
+            return list(PCTestChildModel.objects.select_related(
+                            'test_model__parent').filter(test_model=instance))
+
+        handler = update_properties_set(upd_func, ['get_absolute_url',
+                                                   'test_method'])
+        # one query to get items, one to read existing rows
+        # and one to insert new rows
+        self.assertNumQueries(3, handler, sender=PCTestModel,
+                            instance=instance, created=False,
+                            signal=post_save)
+
+        PropertyCache.objects.filter(name='test_method')\
+                             .update(value=u'stale')
+        # one query to get items, one to read existing rows
+        # and one to update changed rows
+        self.assertNumQueries(3, handler, sender=PCTestModel,
+                            instance=instance, created=False,
+                            signal=post_save)
+
+        # values aren't changed, so nothing to write
+        self.assertNumQueries(2, handler, sender=PCTestModel,
+                            instance=instance, created=False,
+                            signal=post_save)
+
+        for child in PCTestChildModel.objects.filter(test_model=instance):
+            self.assertEqual(self.get_cached(child, 'test_method'),
+                             child.test_method())
+
+
+class PropertiesDeferredUpdateTests(PropertiesCacheTestsBase):
+    def get_cached(self, obj, name):
+        return PropertyCache.objects.get(
+            content_type=ContentType.objects.get_for_model(obj.__class__),
+            object_pk=obj.pk, name=name).value
+
+    def test_deferred_coalescing(self):
+        """Test that dependent items recomputed once per transaction"""
+        from properties_cache import listeners
+        from properties_cache.deferred import deferred_updates
+
+        calls = []
+        refresh_properties = listeners.refresh_properties
+
+        def counting_refresh(items, props):
+            calls.append([item.pk for item in items])
+            return refresh_properties(items, props)
+
+        listeners.refresh_properties = counting_refresh
+        try:
+            root = self.root_objects[0]
+            with deferred_updates():
+                for i in range(10):
+                    root.name = 'root-%d' % i
+                    root.save()
+                self.assertEqual(calls, [])
+        finally:
+            listeners.refresh_properties = refresh_properties
+
+        self.assertEqual(calls, [[self.second_level[0].pk]])
+        self.assertEqual(self.get_cached(self.second_level[0],
+                                         'get_absolute_url'),
+                         'root-9/test-0/test-0')
+
+    def test_deferred_rollback(self):
+        """Test that dirty set dropped on rollback"""
+        from properties_cache.deferred import deferred_updates, is_deferred
+
+        @deferred_updates
+        def rename(root):
+            root.name = 'rolled-back'
+            root.save()
+            raise ValueError
+
+        self.assertRaises(ValueError, rename, self.root_objects[1])
+        self.assertFalse(is_deferred())
+        self.assertEqual(self.get_cached(self.second_level[1],
+                                         'get_absolute_url'),
+                         'test-1/test-1/test-1')
+
+    def test_deferred_queries(self):
+        """Test that dependents are reloaded with their relations"""
+        from django.db import connection
+        from properties_cache.deferred import deferred_updates
+
+        root, parent = self.root_objects[0], self.first_level[0]
+        for i in range(20):
+            PCTestChildModel.objects.create(name='child-%d' % i,
+                                            test_model=parent)
+
+        def save():
+            with deferred_updates():
+                root.name = 'renamed'
+                root.save()
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            save()
+            count = len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = None
+        self.assertTrue(count < 10, count)
+        self.assertEqual(self.get_cached(self.second_level[0],
+                                         'get_absolute_url'),
+                         'renamed/test-0/test-0')
+
+    def test_deferred_delete(self):
+        """Test removal of properties of deleted instances on flush"""
+        from properties_cache.deferred import deferred_updates
+
+        obj = self.second_level[2]
+        properties = PropertyCache.objects.filter(object_pk=obj.pk,
+            content_type=ContentType.objects.get_for_model(PCTestChildModel))
+
+        with deferred_updates():
+            obj.delete()
+            self.assertEqual(properties.count(), 2)
+
+        self.assertEqual(properties.count(), 0)
+
+
+class PropertiesBackendTests(PropertiesCacheTestsBase):
+    def setUp(self):
+        from django.conf import settings
+        from properties_cache import backends
+
+        super(PropertiesBackendTests, self).setUp()
+        settings.PROPERTIES_CACHE_BACKEND = \
+                                'properties_cache.backends.QueueBackend'
+        # jobs are run by tests
+        settings.PROPERTIES_CACHE_LOCAL_WORKER = False
+        self.queue = backends.get_backend().queue
+
+    def tearDown(self):
+        from django.conf import settings
+        from properties_cache import backends
+
+        del settings.PROPERTIES_CACHE_BACKEND
+        del settings.PROPERTIES_CACHE_LOCAL_WORKER
+        del backends.BACKENDS['properties_cache.backends.QueueBackend']
+
+        super(PropertiesBackendTests, self).tearDown()
+
+    def get_url(self, obj):
+        return PropertyCache.objects.get(
+            content_type=ContentType.objects.get_for_model(obj.__class__),
+            object_pk=obj.pk, name='get_absolute_url').value
+
+    def test_queue_backend(self):
+        """Test recomputation of properties by worker"""
+        from properties_cache.backends import Worker
+
+        root = self.root_objects[0]
+        root.name = 'queued-root'
+        root.save()
+
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.get_url(self.second_level[0]),
+                         'test-0/test-0/test-0')
+
+        worker = Worker(self.queue, pool='inline')
+        self.assertEqual(worker.drain(), 1)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.get_url(self.second_level[0]),
+                         'queued-root/test-0/test-0')
+
+    def test_run_job_queries(self):
+        """Test that jobs load instances with their relations"""
+        from django.db import connection
+        from properties_cache.backends import run_job
+
+        parent = self.first_level[0]
+        pks = [PCTestChildModel.objects.create(name='child-%d' % i,
+                                               test_model=parent).pk
+               for i in range(20)]
+
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            self.assertEqual(run_job(('tests', 'PCTestChildModel', pks,
+                                      ['get_absolute_url'])), 20)
+            count = len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = None
+        self.assertTrue(count < 10, count)
+
+    def test_local_worker(self):
+        """Test that jobs of local queue are run by thread of process
+        and worker command refuses to drain it"""
+        import time
+        from django.conf import settings
+        from django.core.management.base import CommandError
+        from properties_cache import backends
+        from properties_cache.management.commands import \
+                                                properties_cache_worker
+
+        self.assertRaises(CommandError,
+                          properties_cache_worker.Command().handle_noargs,
+                          pool='inline', workers=None, burst=True)
+
+        jobs = []
+        run_job = backends.run_job
+        backends.run_job = lambda job: jobs.append(job) or 1
+        settings.PROPERTIES_CACHE_LOCAL_WORKER = True
+        try:
+            backend = backends.QueueBackend()
+            backend.refresh(self.second_level[:1], ['get_absolute_url'])
+            for i in range(100):
+                if jobs:
+                    break
+                time.sleep(0.01)
+        finally:
+            backends.run_job = run_job
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(len(backend.queue), 0)
+
+    def test_thread_pool(self):
+        """Test running of jobs in pool of threads"""
+        from properties_cache import backends
+
+        jobs = []
+        run_job = backends.run_job
+        backends.run_job = lambda job: jobs.append(job) or 1
+        try:
+            for obj in self.second_level:
+                obj.name = 'renamed-%d' % obj.pk
+                obj.save()
+
+            worker = backends.Worker(self.queue, pool='thread', workers=2)
+            self.assertEqual(worker.drain(), 5)
+            worker.close()
+        finally:
+            backends.run_job = run_job
+
+        self.assertEqual(sorted([job[2] for job in jobs]),
+                         sorted([[obj.pk] for obj in self.second_level]))
+
+
+class PropertiesReadCacheTests(PropertiesCacheTestsBase):
+    def setUp(self):
+        from django.conf import settings
+
+        super(PropertiesReadCacheTests, self).setUp()
+        settings.PROPERTIES_CACHE_LOCAL_SIZE = 100
+        settings.PROPERTIES_CACHE_CACHE = 'locmem://'
+
+    def tearDown(self):
+        from django.conf import settings
+        from properties_cache import cache
+
+        cache.get_shared_cache().clear()
+        del settings.PROPERTIES_CACHE_LOCAL_SIZE
+        del settings.PROPERTIES_CACHE_CACHE
+        cache.LOCAL_CACHE.clear()
+
+        super(PropertiesReadCacheTests, self).tearDown()
+
+    def test_read_through(self):
+        """Test reading of properties from cache tiers"""
+        from properties_cache import cache
+
+        objs = list(PCTestChildModel.objects.all())
+        fill_properties_cache(PCTestChildModel, objs)
+
+        # all properties are in local cache now
+        self.assertNumQueries(0, fill_properties_cache,
+                              PCTestChildModel, objs)
+
+        # and in shared cache too
+        cache.get_local_cache().clear()
+        self.assertNumQueries(0, fill_properties_cache,
+                              PCTestChildModel, objs)
+
+        for obj in objs:
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+
+    def test_partial_load(self):
+        """Test that partially loaded properties aren't cached and large
+        properties are added to cached entries"""
+        from properties_cache.tests.models import PCStringPkModel
+
+        objs = list(PCTestChildModel.objects.all())
+        with self.assertNumQueries(1):
+            fill_properties_cache(PCTestChildModel, objs, ['test_method'])
+        with self.assertNumQueries(1):
+            fill_properties_cache(PCTestChildModel, objs)
+        with self.assertNumQueries(0):
+            fill_properties_cache(PCTestChildModel, objs, ['test_method'])
+
+        obj = PCStringPkModel.objects.create(code='1', name='one')
+        with self.assertNumQueries(1):
+            fill_properties_cache(PCStringPkModel, [obj])
+        with self.assertNumQueries(1):
+            fill_properties_cache(PCStringPkModel, [obj], ['get_html'])
+        with self.assertNumQueries(0):
+            fill_properties_cache(PCStringPkModel, [obj],
+                                  ['get_label', 'get_html'])
+        self.assertEqual(obj._pcache_get_html, obj.get_html())
+
+    def test_invalidation(self):
+        """Test that writes invalidate cache tiers"""
+        objs = list(PCTestChildModel.objects.all())
+        fill_properties_cache(PCTestChildModel, objs)
+
+        root = self.root_objects[0]
+        root.name = 'changed-root'
+        root.save()
+
+        objs = list(PCTestChildModel.objects.all())
+        fill_properties_cache(PCTestChildModel, objs)
+        self.assertEqual(objs[0]._pcache_get_absolute_url,
+                         'changed-root/test-0/test-0')
+
+        PCTestChildModel.objects.get(pk=objs[1].pk).delete()
+        fill_properties_cache(PCTestChildModel, objs[1:2])
+        self.assertEqual(objs[1]._pcache_get_absolute_url, None)
+
+    def test_lru(self):
+        """Test eviction and expiration of in-process cache entries"""
+        from properties_cache.cache import LRUCache
+
+        lru = LRUCache(2)
+        lru.set_many({'a': 1, 'b': 2})
+        lru.get_many(['a'])
+        lru.set_many({'c': 3})
+        self.assertEqual(lru.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+        lru = LRUCache(2, ttl=-1)
+        lru.set_many({'a': 1})
+        self.assertEqual(lru.get_many(['a']), {})
+
+
+class PropertiesAccessorTests(PropertiesCacheTestsBase):
+    def test_accessor(self):
+        """Test access to cached properties filled by queryset"""
+        objs = list(PCTestChildModel.objects.properties())
+        for obj in objs:
+            self.assertNumQueries(0, lambda: obj.cached.get_absolute_url)
+            self.assertEqual(obj.cached.get_absolute_url,
+                             obj.get_absolute_url())
+            self.assertEqual(obj.cached.test_method, obj.test_method())
+
+        self.assertRaises(AttributeError, lambda: objs[0].cached.name)
+
+    def test_accessor_batch(self):
+        """Test loading of properties for whole batch on first access"""
+        from properties_cache import managers
+        managers.get_content_type(PCTestChildModel)
+
+        objs = list(PCTestChildModel.objects.all())
+        self.assertNumQueries(1, lambda: objs[0].cached.get_absolute_url)
+        for obj in objs:
+            self.assertNumQueries(0, lambda: obj.cached.test_method)
+            self.assertEqual(obj.cached.test_method, obj.test_method())
+
+    def test_accessor_compute(self):
+        """Test computation and storing of missing properties"""
+        PropertyCache.objects.all().delete()
+
+        obj = PCTestChildModel.objects.get(pk=self.second_level[0].pk)
+        self.assertEqual(obj.cached.get_absolute_url, 'test-0/test-0/test-0')
+        self.assertEqual(PropertyCache.objects.get(
+                    content_type=ContentType.objects.get_for_model(obj),
+                    object_pk=obj.pk, name='get_absolute_url').value,
+                    'test-0/test-0/test-0')
+
+        obj = PCTestChildModel.objects.get(pk=self.second_level[0].pk)
+        self.assertNumQueries(1, lambda: obj.cached.get_absolute_url)
+
+
+class PropertiesGraphTests(PropertiesCacheTestsBase):
+    def test_graph_plan(self):
+        """Test edges followed on change of source model"""
+        from properties_cache.listeners import get_dependency_graph
+
+        graph = get_dependency_graph()
+        self.assertEqual([(edge.source, edge.dependent, edge.props)
+                          for edge in graph.plan(PCRootModel)],
+                         [(PCRootModel, PCTestChildModel,
+                           ['get_absolute_url'])])
+
+    def test_graph_multi_hop(self):
+        """Test chains of dependencies and cycles detection"""
+        from django.core.exceptions import ImproperlyConfigured
+        from properties_cache.graph import DependencyGraph
+
+        class A(object): pass
+        class B(object): pass
+        class C(object): pass
+
+        graph = DependencyGraph()
+        graph.add(A, B, None, ['b'])
+        graph.add(B, C, None, ['c'])
+        graph.add(C, C, None, ['c'])
+        graph.add(A, C, None, ['a'])
+        graph.compile()
+
+        self.assertEqual([(edge.source, edge.dependent)
+                          for edge in graph.plan(A)],
+                         [(A, B), (A, C), (B, C)])
+        self.assertEqual([(edge.source, edge.dependent)
+                          for edge in graph.plan(C)], [(C, C)])
+
+        graph.add(C, A, None, ['c'])
+        self.assertRaises(ImproperlyConfigured, graph.compile)
+
+    def test_merged_fan_out(self):
+        """Test merging of update functions into one fan-out query"""
+        from properties_cache.graph import Edge
+
+        edge = Edge(PCTestModel, PCTestChildModel)
+        edge.add(lambda instance: PCTestChildModel.objects.filter(
+                                    test_model=instance), ['test_method'])
+        edge.add(lambda instance: PCTestChildModel.objects.filter(
+                                    name=instance.name), ['get_absolute_url'])
+
+        self.assertEqual(edge.props, ['test_method', 'get_absolute_url'])
+
+        items = []
+        self.assertNumQueries(1, lambda: items.extend(
+                                edge.fan_out(self.first_level[:2])))
+        self.assertEqual(sorted([item.pk for item in items]),
+                         sorted([obj.pk for obj in self.second_level[:2]]))
+
+
+    def test_fan_out_related(self):
+        """Test that relations of dependents are loaded with fan-out query
+        and changed instance is shared by all of them"""
+        from properties_cache.graph import find_path
+        from properties_cache.listeners import get_dependency_graph
+
+        self.assertEqual(find_path(PCTestChildModel, PCRootModel),
+                         ['test_model', 'parent'])
+        self.assertEqual(find_path(PCRootModel, PCTestChildModel), None)
+
+        root = self.root_objects[0]
+        edge = get_dependency_graph().plan(PCRootModel)[0]
+        self.assertEqual(edge.get_related(), ['test_model'])
+
+        items = []
+        with self.assertNumQueries(1):
+            items.extend(edge.fan_out([root], load_related=True))
+            for item in items:
+                self.assertTrue(item.test_model.parent is root)
+                item.get_absolute_url()
+
+    def test_fan_out_queries(self):
+        """Test that count of queries of recomputation doesn't depend
+        on count of dependents"""
+        from django.db import connection
+
+        def save(obj):
+            connection.use_debug_cursor = True
+            try:
+                start = len(connection.queries)
+                obj.save()
+                return len(connection.queries) - start
+            finally:
+                connection.use_debug_cursor = None
+
+        self.root_objects[0].name = 'renamed'
+        one = save(self.root_objects[0])
+        for i in range(5):
+            PCTestChildModel.objects.create(name='more-%d' % i,
+                                            test_model=self.first_level[1])
+        self.root_objects[1].name = 'renamed'
+        self.assertEqual(save(self.root_objects[1]), one)
+
+        for obj in PCTestChildModel.objects.filter(
+                        test_model=self.first_level[1]).properties():
+            self.assertTrue(obj._pcache_get_absolute_url.startswith('renamed'))
+
+
+    def test_lazy_signals(self):
+        """Test that models are registered when their classes are prepared"""
+        from django.db import models
+        from properties_cache.listeners import get_dependency_graph, \
+                                                REGISTERED
+
+        self.assertTrue(PCTestChildModel in REGISTERED)
+        self.assertFalse(PCRootModel in REGISTERED)
+
+        class PCLazyModel(PropertyCacheAbstract):
+            name = models.CharField(max_length=255)
+
+            class PropertiesCache:
+                cached_properties = ['__unicode__']
+
+            class Meta:
+                app_label = 'tests'
+
+        self.assertTrue(PCLazyModel in REGISTERED)
+        self.assertEqual([(edge.source, edge.dependent) for edge in
+                          get_dependency_graph().plan(PCLazyModel)],
+                         [(PCLazyModel, PCLazyModel)])
+
+    def test_content_types(self):
+        """Test that content types of registered models are loaded
+        with one query"""
+        from properties_cache.content_types import get_content_type, \
+                                        get_model, clear_content_types
+        from properties_cache.tests.models import PCStringPkModel
+
+        clear_content_types()
+        with self.assertNumQueries(1):
+            content_type = get_content_type(PCTestChildModel)
+            get_content_type(PCStringPkModel)
+        self.assertEqual(content_type,
+                ContentType.objects.get_for_model(PCTestChildModel))
+        self.assertTrue(get_model(content_type) is PCTestChildModel)
+
+
+class PropertiesChangeTrackingTests(PropertiesCacheTestsBase):
+    def test_tracked_attnames(self):
+        """Test that attributes of tracked fields are computed once
+        and computed again when graph is changed"""
+        from properties_cache.listeners import get_dependency_graph
+
+        graph = get_dependency_graph()
+        attnames = graph.get_tracked_attnames(PCTestChildModel)
+        self.assertEqual(attnames, [('name', 'name'),
+                                    ('test_model', 'test_model_id')])
+        self.assertTrue(graph.get_tracked_attnames(PCTestChildModel) \
+                        is attnames)
+
+        graph.add(PCRootModel, PCTestChildModel, lambda instance: None,
+                  ['get_absolute_url'], ['name'])
+        self.assertFalse(PCTestChildModel in graph.tracked)
+
+    def test_unchanged_fields(self):
+        """Test that saves which don't change tracked fields
+        don't update dependent properties"""
+        from properties_cache import listeners
+
+        calls = []
+        process_items = listeners.process_items
+
+        def counting_process(items, props, signal):
+            calls.append(props)
+            return process_items(items, props, signal)
+
+        listeners.process_items = counting_process
+        try:
+            root = PCRootModel.objects.get(pk=self.root_objects[0].pk)
+            root.save()
+            self.assertEqual(calls, [])
+
+            # saves with update_fields don't change other fields
+            root.name = 'changed-root'
+            post_save.send(sender=PCRootModel, instance=root,
+                           created=False, update_fields=frozenset())
+            self.assertEqual(calls, [])
+
+            # PCTestModel doesn't declare tracked fields
+            self.first_level[0].save()
+            self.assertEqual(len(calls), 1)
+
+            root.save()
+            self.assertEqual(len(calls), 2)
+
+            # snapshot is updated on save
+            root.save()
+            self.assertEqual(len(calls), 2)
+        finally:
+            listeners.process_items = process_items
+
+        self.assertEqual(PropertyCache.objects.get(name='get_absolute_url',
+                content_type=ContentType.objects.get_for_model(
+                                                    PCTestChildModel),
+                object_pk=self.second_level[0].pk).value,
+                'changed-root/test-0/test-0')
+
+
+class PropertiesRebuildTests(PropertiesCacheTestsBase):
+    def rebuild(self, **options):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        stdout = StringIO()
+        call_command('rebuild_properties_cache', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_rebuild(self):
+        """Test rebuild of properties cache in chunks"""
+        PropertyCache.objects.all().delete()
+
+        output = self.rebuild(models=['tests.PCTestChildModel'],
+                              properties=['get_absolute_url'],
+                              chunk_size=2)
+        self.assertTrue('rebuilt 5 rows' in output, output)
+
+        for obj in self.second_level:
+            self.assertEqual(PropertyCache.objects.get(object_pk=obj.pk,
+                    content_type=ContentType.objects.get_for_model(obj),
+                    name='get_absolute_url').value, obj.get_absolute_url())
+        self.assertEqual(PropertyCache.objects.filter(
+                                        name='test_method').count(), 0)
+
+    def test_rebuild_related(self):
+        """Test relations of properties are loaded with chunk of instances"""
+        from properties_cache.listeners import get_dependency_graph
+        from properties_cache.management.commands.rebuild_properties_cache \
+                                                    import compute_chunk
+
+        self.assertEqual(get_dependency_graph().get_related(
+                                                    PCTestChildModel),
+                         ['test_model', 'test_model__parent'])
+        self.assertEqual(get_dependency_graph().get_related(
+                                PCTestChildModel, ['test_method']),
+                         ['test_model'])
+
+        pks = [obj.pk for obj in self.second_level]
+        with self.assertNumQueries(1):
+            last_pk, version, values = compute_chunk(('tests',
+                'PCTestChildModel', pks, ['get_absolute_url', 'test_method']))
+        self.assertEqual(len(values), len(pks) * 2)
+
+    def test_rebuild_checkpoint(self):
+        """Test resuming of interrupted rebuild from checkpoint"""
+        import os
+        import tempfile
+        from django.utils import simplejson
+
+        PropertyCache.objects.all().delete()
+
+        fd, checkpoint = tempfile.mkstemp()
+        os.write(fd, simplejson.dumps({'tests.PCTestChildModel': {
+                                'last_pk': self.second_level[2].pk}}))
+        os.close(fd)
+
+        self.rebuild(models=['tests.PCTestChildModel'],
+                     checkpoint=checkpoint, chunk_size=1)
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(sorted(set(map(int, PropertyCache.objects.values_list(
+                                            'object_pk', flat=True)))),
+                         [obj.pk for obj in self.second_level[3:]])
+
+
+class PropertiesSerializerTests(test.TestCase):
+    values = [None, True, False, 0, -12, 10 ** 20, 1.5, float('inf'),
+              u'\u0443\u0440\u043b', 'url', '\xff\xfe', [1, u'a', None],
+              {'a': [1, 2], u'b': {u'c': 1.5}}, (1, 2), set([1]),
+              u'x' * 5000]
+
+    def test_roundtrip(self):
+        """Test encoding and decoding of values"""
+        from properties_cache.serializers import encode, decode
+
+        for value in self.values:
+            decoded = decode(encode(value))
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded), type(value))
+
+    def test_codecs(self):
+        """Test values encoded with JSON codec are decoded with any codec"""
+        from django.conf import settings
+        from properties_cache.serializers import encode, decode
+
+        settings.PROPERTIES_CACHE_CODEC = 'json'
+        try:
+            encoded = [encode(value) for value in self.values]
+            self.assertEqual(encode({'a': [1, 2]}), u'\x01j{"a":[1,2]}')
+        finally:
+            del settings.PROPERTIES_CACHE_CODEC
+
+        for value, data in zip(self.values, encoded):
+            decoded = decode(data)
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded), type(value))
+
+    def test_compact(self):
+        """Test that scalars are stored as text and large
+        values are compressed"""
+        from picklefield.fields import dbsafe_encode
+        from properties_cache.serializers import encode
+
+        self.assertEqual(encode(u'a/b/c'), u'\x01ua/b/c')
+        self.assertEqual(encode(12), u'\x01i12')
+        self.assertTrue(encode(u'x' * 5000).startswith(u'\x01z'))
+
+        for value in self.values:
+            if isinstance(value, unicode):
+                self.assertTrue(len(encode(value)) < \
+                                len(dbsafe_encode(value)), repr(value))
+
+        self.assertTrue(sum([len(encode(value)) for value in self.values]) < \
+                    sum([len(dbsafe_encode(value)) for value in self.values]))
+
+    def test_legacy_rows(self):
+        """Test reading of values pickled by PickledObjectField"""
+        from picklefield.fields import dbsafe_encode
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        PropertyCache.objects.create(content_type=content_type,
+                                     object_pk=100, name='legacy',
+                                     value=u'placeholder')
+        PropertyCache.objects.filter(name='legacy').update(
+                    value=dbsafe_encode({'url': u'a/b/c'}))
+
+        self.assertEqual(PropertyCache.objects.get(name='legacy').value,
+                         {'url': u'a/b/c'})
+
+    def test_string_values(self):
+        """Test strings looking like pickled or encoded values are stored
+        as strings"""
+        from properties_cache.storage import STORAGES
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        values = {(100, 'pickled'): u'STQyCi4=', (100, 'encoded'): u'\x01i5'}
+        for storage in STORAGES.values():
+            storage.store(content_type, values)
+            self.assertEqual(storage.load(content_type, [100]),
+                             {100: {'pickled': u'STQyCi4=',
+                                    'encoded': u'\x01i5'}})
+
+        self.assertEqual(PropertyCache.objects.get(name='pickled').value,
+                         u'STQyCi4=')
+
+
+class PropertiesWideStorageTests(PropertiesCacheTestsBase):
+    def setUp(self):
+        PCTestChildModel.PropertiesCache.storage = 'wide'
+        super(PropertiesWideStorageTests, self).setUp()
+
+    def tearDown(self):
+        del PCTestChildModel.PropertiesCache.storage
+        super(PropertiesWideStorageTests, self).tearDown()
+
+    def test_wide_rows(self):
+        """Test storing of all properties of instance in one row"""
+        from properties_cache.models import PropertyCacheRow
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        self.assertEqual(PropertyCache.objects.filter(
+                                content_type=content_type).count(), 0)
+        self.assertEqual(PropertyCacheRow.objects.count(), 5)
+
+        obj = self.second_level[0]
+        self.assertEqual(PropertyCacheRow.objects.get(
+                                object_pk=obj.pk).value, {
+                            'get_absolute_url': obj.get_absolute_url(),
+                            'test_method': obj.test_method()})
+
+        root = self.root_objects[0]
+        root.name = 'changed-root'
+        root.save()
+
+        objs = list(PCTestChildModel.objects.properties())
+        self.assertEqual(objs[0].cached.get_absolute_url,
+                         'changed-root/test-0/test-0')
+        self.assertEqual(objs[0].cached.test_method, obj.test_method())
+
+    def test_wide_rows_subset(self):
+        """Test reading and removal of subset of properties"""
+        from properties_cache.listeners import delete_properties
+        from properties_cache.models import PropertyCacheRow
+        from properties_cache.storage import get_storage
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        pks = [obj.pk for obj in self.second_level[:2]]
+        storage = get_storage(PCTestChildModel)
+
+        loaded = storage.load(content_type, pks, ['test_method'])
+        self.assertEqual(loaded[pks[0]], {
+                    'test_method': self.second_level[0].test_method()})
+
+        delete_properties(content_type, pks, ['test_method'])
+        self.assertEqual(storage.load(content_type, pks)[pks[0]].keys(),
+                         ['get_absolute_url'])
+
+        delete_properties(content_type, pks, ['get_absolute_url'])
+        self.assertEqual(PropertyCacheRow.objects.filter(
+                                        object_pk__in=pks).count(), 0)
+
+
+class PropertiesQuerySetTests(PropertiesCacheTestsBase):
+    def count_queries(self, fnc):
+        """Return count of queries to properties cache table,
+        queries done by computed properties themselves aren't counted"""
+        from django.db import connection
+
+        # DEBUG is switched off by test runner
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            fnc()
+            return len([q for q in connection.queries[start:] \
+                    if PropertyCache._meta.db_table in q['sql']])
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_update(self):
+        """Test recomputation of properties after QuerySet.update()"""
+        PCTestChildModel.objects.filter(name__in=['test-0', 'test-1'])\
+                                .update(name='updated')
+
+        objs = PCTestChildModel.objects.filter(name='updated').properties()
+        self.assertEqual(len(objs), 2)
+        for obj in objs:
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+            self.assertTrue(obj._pcache_get_absolute_url.endswith('updated'))
+
+    def test_update_queries(self):
+        """Test that count of queries doesn't depend on count of rows"""
+        one = self.count_queries(lambda: PCTestChildModel.objects.filter(
+                        pk=self.second_level[0].pk).update(name='one'))
+        many = self.count_queries(lambda: PCTestChildModel.objects.exclude(
+                        pk=self.second_level[0].pk).update(name='many'))
+        self.assertEqual(one, many)
+
+    def test_delete(self):
+        """Test removal of properties by QuerySet.delete()"""
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        pks = [obj.pk for obj in self.second_level[:2]]
+
+        one = self.count_queries(lambda: PCTestChildModel.objects.filter(
+                                        pk=self.second_level[4].pk).delete())
+        many = self.count_queries(lambda: PCTestChildModel.objects.filter(
+                                        pk__in=pks).delete())
+        self.assertEqual(one, many)
+
+        self.assertEqual(PropertyCache.objects.filter(
+                content_type=content_type, object_pk__in=pks).count(), 0)
+        self.assertEqual(PropertyCache.objects.filter(
+                content_type=content_type).count(), 4)
+
+
+    def test_pickle(self):
+        """Test pickling of instances fetched by PropertiesCacheQuerySet"""
+        import pickle
+
+        obj = PCTestChildModel.objects.all()[0]
+        self.assertEqual(pickle.loads(pickle.dumps(obj)), obj)
+
+        objs = list(PCTestChildModel.objects.properties())
+        loaded = pickle.loads(pickle.dumps(objs))
+        self.assertEqual(loaded, objs)
+        self.assertEqual(loaded[0]._pcache, objs[0]._pcache)
+        self.assertFalse('_pcache_batch' in loaded[0].__dict__)
+
+        # instances of models without properties cache aren't batched
+        from properties_cache.tests.models import PCPlainModel
+        PCPlainModel.objects.create(name='plain')
+        objs = list(PCPlainModel.objects.all())
+        self.assertEqual(pickle.loads(pickle.dumps(objs)), objs)
+
+    def test_properties_names(self):
+        """Test loading of properties with given names only"""
+        objs = []
+        self.assertEqual(self.count_queries(lambda: objs.extend(
+            PCTestChildModel.objects.properties('get_absolute_url'))), 1)
+        for obj in objs:
+            self.assertEqual(obj._pcache.keys(), ['get_absolute_url'])
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+
+        # other properties are loaded for whole chunk on first access
+        self.assertEqual(self.count_queries(lambda: [obj.cached.test_method
+                                                     for obj in objs]), 1)
+        self.assertEqual(objs[0].cached.test_method, objs[0].test_method())
+
+        self.assertRaises(ValueError, PCTestChildModel.objects.properties,
+                          'missing')
+
+    def test_large_properties(self):
+        """Test that large properties are loaded only when asked for"""
+        from properties_cache.tests.models import PCStringPkModel
+
+        PCStringPkModel.objects.create(code='1', name='one')
+        PCStringPkModel.objects.create(code='2', name='two')
+
+        objs = list(PCStringPkModel.objects.order_by('code').properties())
+        self.assertEqual(objs[0]._pcache, {'get_label': u'1: one'})
+
+        html = []
+        self.assertEqual(self.count_queries(lambda: html.extend(
+                            [obj.cached.get_html for obj in objs])), 1)
+        self.assertEqual(html, [obj.get_html() for obj in objs])
+
+        objs = list(PCStringPkModel.objects.order_by('code')\
+                                           .properties('get_html'))
+        self.assertEqual(objs[1]._pcache, {'get_html': objs[1].get_html()})
+
+
+class PropertiesPrefetchTests(PropertiesCacheTestsBase):
+    def setUp(self):
+        from properties_cache import managers
+
+        super(PropertiesPrefetchTests, self).setUp()
+        managers.get_content_type(PCTestChildModel)
+        # one more child of the first parent
+        PCTestChildModel.objects.create(name='test-extra',
+                                        test_model=self.first_level[0])
+
+    def test_reverse(self):
+        """Test filling of children of list of parents"""
+        from properties_cache.managers import prefetch_properties, \
+                                              PropertiesPrefetch
+
+        # parents, children and their properties
+        with self.assertNumQueries(3):
+            parents = prefetch_properties(PCTestModel.objects.order_by('pk'),
+                                          PropertiesPrefetch('test_models'))
+
+        with self.assertNumQueries(0):
+            for parent in parents:
+                for child in parent.prefetched_test_models:
+                    self.assertEqual(child.cached.test_method,
+                                     u"Parent model: %s, current model: %s" \
+                                     % (parent.name, child.name))
+        self.assertEqual(len(parents[0].prefetched_test_models), 2)
+
+    def test_deep(self):
+        """Test filling of objects through several relations"""
+        from properties_cache.managers import prefetch_properties, \
+                                              PropertiesPrefetch
+
+        with self.assertNumQueries(4):
+            roots = prefetch_properties(PCRootModel.objects.all(), 'children',
+                    PropertiesPrefetch('children__test_models', to_attr='kids'))
+
+        children = [child for root in roots
+                          for parent in root.prefetched_children
+                          for child in parent.kids]
+        self.assertEqual(len(children), 6)
+        self.assertNumQueries(0, lambda: [child.cached.get_absolute_url
+                                          for child in children])
+
+    def test_forward(self):
+        """Test loading of parents of children chunk by chunk"""
+        with self.assertNumQueries(3):
+            objs = list(PCTestChildModel.objects.prefetch_properties(
+                                                    'test_model__parent'))
+        with self.assertNumQueries(0):
+            for obj in objs:
+                obj.get_absolute_url()
+
+        # objects loaded by select_related aren't loaded again
+        objs = PCTestChildModel.objects.select_related('test_model')\
+                                    .prefetch_properties('test_model__parent')
+        self.assertNumQueries(2, lambda: list(objs))
+
+    def test_chunks(self):
+        """Test that keys are looked up in chunks"""
+        from properties_cache import managers
+
+        parents = list(PCTestModel.objects.order_by('pk'))
+        children = list(PCTestChildModel.objects.order_by('pk'))
+        chunk_size, managers.PKS_CHUNK_SIZE = managers.PKS_CHUNK_SIZE, 2
+        try:
+            # chunks of parents and properties of children
+            with self.assertNumQueries((len(parents) + 1) // 2 + 1):
+                managers.prefetch_properties(parents, 'test_models')
+            with self.assertNumQueries((len(parents) + 1) // 2):
+                managers.prefetch_properties(children, 'test_model')
+        finally:
+            managers.PKS_CHUNK_SIZE = chunk_size
+
+        self.assertTrue(len(parents) > 2)
+        self.assertEqual(sum([len(parent.prefetched_test_models)
+                              for parent in parents]), len(children))
+        for child in children:
+            self.assertEqual(child._test_model_cache.pk,
+                             child.test_model_id)
+
+    def test_unknown_relation(self):
+        from properties_cache.managers import prefetch_properties
+
+        self.assertRaises(ValueError, prefetch_properties,
+                          PCTestModel.objects.all(), 'name')
+        self.assertRaises(ValueError, prefetch_properties,
+                          PCTestModel.objects.all(), 'unknown')
+
+
+class PropertiesConcurrencyTests(PropertiesCacheTestsBase):
+    def get_value(self, obj, name='get_absolute_url'):
+        return PropertyCache.objects.get(object_pk=obj.pk, name=name).value
+
+    def test_versions(self):
+        """Test that values of older versions don't overwrite newer ones"""
+        from properties_cache.listeners import store_properties
+        from properties_cache.storage import next_version
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        obj = self.second_level[0]
+
+        old, new = next_version(), next_version()
+        self.assertTrue(new > old)
+
+        store_properties(content_type, {(obj.pk, 'get_absolute_url'): 'new'},
+                         new)
+        store_properties(content_type, {(obj.pk, 'get_absolute_url'): 'old'},
+                         old)
+        self.assertEqual(self.get_value(obj), 'new')
+
+        PCTestChildModel.PropertiesCache.storage = 'wide'
+        try:
+            store_properties(content_type, {(obj.pk, 'test_method'): 'new'},
+                             new)
+            store_properties(content_type, {
+                                (obj.pk, 'test_method'): 'old',
+                                (obj.pk, 'get_absolute_url'): 'url'}, old)
+            self.assertEqual(PCTestChildModel.objects.properties()\
+                                    .get(pk=obj.pk)._pcache, {
+                    'test_method': 'new', 'get_absolute_url': 'url'})
+        finally:
+            del PCTestChildModel.PropertiesCache.storage
+
+    def test_concurrent_insert(self):
+        """Test writing of rows inserted by others meanwhile"""
+        from properties_cache import storage
+        from properties_cache.listeners import store_properties
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        obj = self.second_level[0]
+        PropertyCache.objects.filter(object_pk=obj.pk).delete()
+
+        bulk_insert = storage._bulk_insert
+        def racing_insert(connection, model, rows):
+            # other process inserts the row first
+            storage._bulk_insert = bulk_insert
+            PropertyCache.objects.create(content_type=content_type,
+                        object_pk=obj.pk, name='get_absolute_url',
+                        value='other')
+            bulk_insert(connection, model, rows)
+
+        storage._bulk_insert = racing_insert
+        try:
+            store_properties(content_type, {
+                            (obj.pk, 'get_absolute_url'): 'url'})
+        finally:
+            storage._bulk_insert = bulk_insert
+
+        self.assertEqual(self.get_value(obj), 'url')
+
+    def test_local_locks(self):
+        """Test that locked properties are recomputed by holder of lock"""
+        from properties_cache import listeners
+        from properties_cache.locks import get_locks, lock_key
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        obj = self.second_level[0]
+        key = lock_key(content_type, obj.pk, 'get_absolute_url')
+
+        # property locked by other worker isn't computed
+        locks = get_locks()
+        self.assertEqual(locks.acquire([key]), [key])
+        PCTestChildModel.objects.filter(pk=obj.pk).update(name='changed')
+        self.assertEqual(self.get_value(obj), 'test-0/test-0/test-0')
+        self.assertEqual(locks.release([key]), [key])
+        self.assertEqual(locks.release([key]), [])
+
+        # change made while property is computed is computed again
+        computed = []
+        compute_properties = listeners.compute_properties
+        def compute_and_change(items, props):
+            computed.append(props)
+            values = compute_properties(items, props)
+            if len(computed) == 1:
+                PCTestChildModel.objects.filter(pk=obj.pk)\
+                                        .update(name='renamed')
+            return values
+
+        listeners.compute_properties = compute_and_change
+        try:
+            listeners.refresh_properties([obj], ['get_absolute_url'])
+        finally:
+            listeners.compute_properties = compute_properties
+
+        # other properties are computed by the update itself
+        self.assertEqual(computed, [['get_absolute_url'], ['test_method'],
+                                    ['get_absolute_url']])
+        self.assertEqual(self.get_value(obj), 'test-0/test-0/renamed')
+
+    def test_cache_locks(self):
+        """Test locks kept in shared cache"""
+        from django.core.cache import get_cache
+        from properties_cache.locks import CacheLocks
+
+        cache = get_cache('locmem://')
+        first, second = CacheLocks(cache, 10), CacheLocks(cache, 10)
+        try:
+            self.assertEqual(first.acquire(['a', 'b']), ['a', 'b'])
+            self.assertEqual(second.acquire(['b', 'c']), ['c'])
+            self.assertEqual(first.release(['a', 'b']), ['b'])
+            self.assertEqual(second.acquire(['b']), ['b'])
+        finally:
+            cache.clear()
+
+    def test_cache_locks_release(self):
+        """Test that rerun isn't lost when lock is released after it's
+        found busy and before rerun is requested"""
+        from django.core.cache import get_cache
+        from properties_cache.locks import CacheLocks
+
+        cache = get_cache('locmem://')
+        first = CacheLocks(cache, 10)
+
+        class ReleasingCache(object):
+            def set_many(self, *args):
+                self.released = first.release(['a'])
+                cache.set_many(*args)
+
+            def __getattr__(self, name):
+                return getattr(cache, name)
+
+        releasing = ReleasingCache()
+        second = CacheLocks(releasing, 10)
+        try:
+            self.assertEqual(first.acquire(['a']), ['a'])
+            # lock is released meanwhile, so it's acquired by second
+            self.assertEqual(second.acquire(['a']), ['a'])
+            self.assertEqual(releasing.released, [])
+            # and it's computed once more by second
+            self.assertEqual(second.release(['a']), ['a'])
+            self.assertEqual(cache.get('a:rerun'), None)
+        finally:
+            cache.clear()
+
+
+class PropertiesMetricsTests(PropertiesCacheTestsBase):
+    def setUp(self):
+        from properties_cache.metrics import MemoryCollector, add_collector
+
+        super(PropertiesMetricsTests, self).setUp()
+        self.collector = MemoryCollector()
+        add_collector(self.collector)
+
+    def tearDown(self):
+        from properties_cache.metrics import remove_collector
+
+        remove_collector(self.collector)
+        super(PropertiesMetricsTests, self).tearDown()
+
+    def test_hits(self):
+        """Test hit and miss counts of filled properties"""
+        from properties_cache.metrics import HIT, MISS
+
+        PropertyCache.objects.filter(object_pk=self.second_level[0].pk,
+                                     name='test_method').delete()
+        list(PCTestChildModel.objects.properties())
+
+        get = self.collector.get
+        self.assertEqual(get(HIT, PCTestChildModel, 'get_absolute_url'),
+                         (1, 5))
+        self.assertEqual(get(MISS, PCTestChildModel, 'get_absolute_url'),
+                         (1, 0))
+        self.assertEqual(get(HIT, PCTestChildModel, 'test_method'), (1, 4))
+        self.assertEqual(get(MISS, PCTestChildModel, 'test_method'), (1, 1))
+
+    def test_update(self):
+        """Test recompute, fan-out and queries metrics of signals"""
+        from properties_cache.metrics import RECOMPUTE, FAN_OUT, QUERIES
+
+        root = self.root_objects[0]
+        root.name = 'changed'
+        root.save()
+
+        get = self.collector.get
+        count, total = get(RECOMPUTE, PCTestChildModel, 'get_absolute_url')
+        self.assertEqual(count, 1)
+        self.assertTrue(total >= 0)
+        self.assertEqual(get(FAN_OUT, PCTestChildModel,
+                             'update_on_pcrootmodel_change'), (1, 1))
+
+        count, queries = get(QUERIES, PCRootModel, 'post_save')
+        self.assertEqual(count, 1)
+        self.assertTrue(queries > 0)
+
+    def test_signal_exporter(self):
+        """Test export of metrics with signals"""
+        from properties_cache.metrics import SignalExporter, \
+                                             metric_recorded, record, HIT
+
+        received = []
+        def receiver(sender, metric, name, value, count, **kwargs):
+            received.append((sender, metric, name, value, count))
+
+        metric_recorded.connect(receiver)
+        try:
+            record([SignalExporter()], HIT, PCTestChildModel, 'test_method',
+                   5)
+        finally:
+            metric_recorded.disconnect(receiver)
+
+        self.assertEqual(received, [(PCTestChildModel, HIT, 'test_method',
+                                     5, 1)])
+
+
+class PropertiesGarbageCollectionTests(PropertiesCacheTestsBase):
+    def gc(self, **options):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        stdout = StringIO()
+        call_command('gc_properties_cache', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_pre_delete_handler(self):
+        """Test removal of properties of dependent items on pre_delete"""
+        from properties_cache import managers
+        from properties_cache.listeners import update_properties_set
+
+        managers.get_content_type(PCTestChildModel)
+        instance = self.first_level[0]
+        handler = update_properties_set(lambda instance: list(
+                    PCTestChildModel.objects.filter(test_model=instance)),
+                                        ['get_absolute_url', 'test_method'])
+
+        # one query to get items and one to delete their properties
+        self.assertNumQueries(2, handler, sender=PCTestModel,
+                              instance=instance, signal=pre_delete)
+        self.assertEqual(PropertyCache.objects.filter(
+                    object_pk=self.second_level[0].pk).count(), 0)
+        self.assertEqual(PropertyCache.objects.count(), 8)
+
+    def test_gc(self):
+        """Test removal of properties of deleted instances"""
+        pks = [obj.pk for obj in self.second_level[:2]]
+        # remove instances without signals to leave orphaned rows
+        DeleteQuery(PCTestChildModel).delete_batch(pks, 'default')
+        self.assertEqual(PropertyCache.objects.count(), 10)
+
+        output = self.gc(dry_run=True)
+        self.assertTrue('found 4 orphaned rows' in output, output)
+        self.assertEqual(PropertyCache.objects.count(), 10)
+
+        output = self.gc(batch_size=3)
+        self.assertTrue('removed 4 orphaned rows' in output, output)
+        self.assertEqual(sorted(set(map(int, PropertyCache.objects\
+                                    .values_list('object_pk', flat=True)))),
+                         [obj.pk for obj in self.second_level[2:]])
+
+        output = self.gc()
+        self.assertTrue('Total: removed 0 orphaned rows' in output, output)
+
+    def test_gc_cast_types(self):
+        """Test casts of stored primary keys in joins of gc"""
+        from django.db import connection, models
+        from properties_cache.management.commands.gc_properties_cache \
+                                                    import get_cast_type
+        from properties_cache.tests.models import PCStringPkModel
+
+        class MySQLConnection(object):
+            vendor = 'mysql'
+
+        pk_field = PCTestChildModel._meta.pk
+        self.assertEqual(get_cast_type(pk_field, MySQLConnection()),
+                         'SIGNED')
+        self.assertEqual(get_cast_type(pk_field, connection), 'integer')
+        self.assertEqual(get_cast_type(PCStringPkModel._meta.pk,
+                                       connection), '')
+        # unknown types are looked up by primary keys instead
+        self.assertEqual(get_cast_type(models.DateField(), connection), None)
+
+
+class PropertiesIndexTests(test.TransactionTestCase):
+    # sqlite3 module commits open transaction before EXPLAIN statement,
+    # so these tests can't run inside of transaction of TestCase
+
+    def explain(self, query):
+        from django.db import connection
+
+        sql, params = query.get_compiler(connection=connection).as_sql()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN %s" % sql, params)
+        return " ".join([row[-1] for row in cursor.fetchall()])
+
+    def test_query_plans(self):
+        """Test lookups of properties cache use unique index"""
+        from properties_cache.storage import _delete_query
+
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        rows = PropertyCache.objects.filter(content_type=content_type,
+                                            object_pk__in=[1, 2, 3])
+
+        plan = self.explain(rows.values_list('object_pk', 'name',
+                                             'value').query)
+        self.assertTrue('USING INDEX' in plan, plan)
+        self.assertFalse('SCAN' in plan, plan)
+
+        # existence of rows is checked with index only
+        plan = self.explain(rows.filter(name__in=['test_method'])\
+                                .values_list('pk', flat=True).query)
+        self.assertTrue('USING COVERING INDEX' in plan, plan)
+
+        plan = self.explain(_delete_query(rows.filter(
+                                            name__in=['test_method'])))
+        self.assertTrue('USING INDEX' in plan, plan)
+        self.assertFalse('SCAN' in plan, plan)
+
+
+class PropertiesTransactionTests(test.TransactionTestCase):
+    def setUp(self):
+        from properties_cache.content_types import clear_content_types
+
+        # content types are created again when database is flushed
+        clear_content_types()
+        ContentType.objects.clear_cache()
+        setup_signals(PropertyCacheAbstract)
+
+    def test_rollback(self):
+        """Test that writes of properties cache don't commit unfinished
+        transaction of caller"""
+        from django.db import transaction
+
+        root = PCRootModel.objects.create(name='a')
+        parent = PCTestModel.objects.create(name='parent', parent=root)
+        child = PCTestChildModel.objects.create(name='child',
+                                                test_model=parent)
+
+        def save():
+            with transaction.commit_on_success():
+                root.name = 'b'
+                root.save()
+                raise ValueError
+        self.assertRaises(ValueError, save)
+
+        self.assertEqual(PCRootModel.objects.get(pk=root.pk).name, 'a')
+        self.assertEqual(PropertyCache.objects.get(object_pk=child.pk,
+                            name='get_absolute_url').value, 'a/parent/child')
+
+    def test_deferred_managed(self):
+        """Test that deferred block doesn't commit managed transaction
+        of caller"""
+        from django.db import transaction
+        from properties_cache.deferred import deferred_updates
+
+        root = PCRootModel.objects.create(name='a')
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            PCRootModel.objects.filter(pk=root.pk).update(name='b')
+            with deferred_updates():
+                pass
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+
+        self.assertEqual(PCRootModel.objects.get(pk=root.pk).name, 'a')
+
+    def test_deferred_nested_rollback(self):
+        """Test that nested deferred block is rolled back with outer one"""
+        from properties_cache.deferred import deferred_updates
+
+        root = PCRootModel.objects.create(name='a')
+        parent = PCTestModel.objects.create(name='p', parent=root)
+        child = PCTestChildModel.objects.create(name='c', test_model=parent)
+
+        def save():
+            with deferred_updates():
+                with deferred_updates():
+                    root.name = 'inner'
+                    root.save()
+                raise ValueError
+        self.assertRaises(ValueError, save)
+
+        self.assertEqual(PCRootModel.objects.get(pk=root.pk).name, 'a')
+        self.assertEqual(PropertyCache.objects.get(object_pk=child.pk,
+                            name='get_absolute_url').value, 'a/p/c')
+
+
+class PropertiesStringPkTests(PropertiesCacheTestsBase):
+    def test_string_pk(self):
+        """Test properties cache of model with string primary key"""
+        from properties_cache.tests.models import PCStringPkModel
+
+        obj = PCStringPkModel.objects.create(code='0042', name='answer')
+        other = PCStringPkModel.objects.create(code='42', name='other')
+
+        objs = list(PCStringPkModel.objects.order_by('name').properties())
+        self.assertEqual([o.cached.get_label for o in objs],
+                         [u'0042: answer', u'42: other'])
+        self.assertEqual(sorted(PropertyCache.objects.filter(
+                    name='get_label').values_list('object_pk', flat=True)),
+                         [u'0042', u'42'])
+
+        other.delete()
+        obj = list(PCStringPkModel.objects.properties())[0]
+        self.assertEqual(obj._pcache, {'get_label': u'0042: answer'})
+
+    def test_long_pk(self):
+        """Test primary keys longer than object_pk aren't truncated"""
+        from properties_cache.storage import STORAGES
+        from properties_cache.tests.models import PCStringPkModel
+
+        content_type = ContentType.objects.get_for_model(PCStringPkModel)
+        for storage in STORAGES.values():
+            self.assertRaises(ValueError, storage.store, content_type,
+                              {('x' * 65, 'get_label'): u'x'})
+            self.assertFalse(storage.model.objects.filter(
+                                    content_type=content_type).exists())
+
+
+class PropertiesIdentityMapTests(PropertiesCacheTestsBase):
+    def count_queries(self, fnc):
+        from django.db import connection
+
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            fnc()
+            return len([q for q in connection.queries[start:] \
+                    if PropertyCache._meta.db_table in q['sql']])
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_identity_map(self):
+        """Test that properties are loaded once inside identity map"""
+        from properties_cache.cache import identity_map, get_identity_map
+
+        load = lambda: list(PCTestChildModel.objects.properties())
+        with identity_map() as identity:
+            self.assertEqual(self.count_queries(load), 1)
+            self.assertEqual(self.count_queries(load), 0)
+            self.assertEqual(len(identity), 5)
+
+            # nested block shares map of outer block
+            with identity_map() as nested:
+                self.assertTrue(nested is identity)
+            self.assertTrue(get_identity_map() is identity)
+        self.assertEqual(get_identity_map(), None)
+        self.assertEqual(self.count_queries(load), 1)
+
+        # empty map of outer block is shared too
+        with identity_map() as identity:
+            with identity_map() as nested:
+                self.assertTrue(nested is identity)
+                self.assertEqual(self.count_queries(load), 1)
+            self.assertEqual(len(identity), 5)
+
+    def test_identity_map_writes(self):
+        """Test that saved properties update identity map and deleted
+        instances are removed from it"""
+        from properties_cache.cache import identity_map
+
+        obj = self.second_level[0]
+        content_type = ContentType.objects.get_for_model(PCTestChildModel)
+        with identity_map() as identity:
+            list(PCTestChildModel.objects.properties())
+            obj.name = 'renamed'
+            obj.save()
+            self.assertTrue(identity[(content_type.pk, obj.pk)]\
+                            ['get_absolute_url'].endswith('renamed'))
+
+            obj = PCTestChildModel.objects.properties().get(pk=obj.pk)
+            self.assertTrue(obj._pcache_get_absolute_url.endswith('renamed'))
+
+            pk = obj.pk
+            obj.delete()
+            self.assertFalse((content_type.pk, pk) in identity)
+
+    def test_middleware(self):
+        """Test that identity map is dropped when request is finished"""
+        from django.core.signals import request_finished
+        from django.http import HttpRequest, HttpResponse
+        from properties_cache.cache import get_identity_map
+        from properties_cache.middleware import IdentityMapMiddleware
+
+        middleware, request = IdentityMapMiddleware(), HttpRequest()
+        middleware.process_request(request)
+        self.assertEqual(get_identity_map(), {})
+        response = HttpResponse()
+        self.assertTrue(middleware.process_response(request, response) \
+                        is response)
+        self.assertEqual(get_identity_map(), None)
+
+        # map isn't left behind if response wasn't processed
+        middleware.process_request(request)
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(get_identity_map(), None)
+
+
+class PropertiesPolicyTests(PropertiesCacheTestsBase):
+    def setUp(self):
+        from django.conf import settings
+
+        super(PropertiesPolicyTests, self).setUp()
+        settings.PROPERTIES_CACHE_REFRESH_BACKEND = \
+                                    'properties_cache.backends.SyncBackend'
+        PCTestChildModel.PropertiesCache.policies = {
+            'test_method': {'ttl': 10},
+        }
+
+    def tearDown(self):
+        from django.conf import settings
+
+        del settings.PROPERTIES_CACHE_REFRESH_BACKEND
+        del PCTestChildModel.PropertiesCache.policies
+        super(PropertiesPolicyTests, self).tearDown()
+
+    def expire(self, name):
+        import time
+
+        PropertyCache.objects.filter(name=name).update(
+                        version=int((time.time() - 60) * 1000000))
+
+    def test_ttl(self):
+        """Test that properties with ttl are recomputed on read
+        when they're expired"""
+        parent = self.first_level[0]
+        parent.name = 'renamed'
+        parent.save()
+
+        # value isn't recomputed by signals and it's fresh enough
+        obj = PCTestChildModel.objects.properties().get(
+                                            pk=self.second_level[0].pk)
+        self.assertNotEqual(obj._pcache_test_method, obj.test_method())
+        self.assertTrue(obj._pcache_get_absolute_url.startswith('test-0/'
+                                                                'renamed'))
+        self.assertTrue(0 <= obj.get_cached_age('test_method') < 10)
+
+        self.expire('test_method')
+        obj = PCTestChildModel.objects.properties().get(pk=obj.pk)
+        self.assertEqual(obj._pcache_test_method, None)
+        self.assertTrue(obj.get_cached_age('test_method') > 10)
+        self.assertEqual(obj.cached.test_method, obj.test_method())
+        self.assertEqual(PropertyCache.objects.get(name='test_method',
+                            object_pk=obj.pk).value, obj.test_method())
+        self.assertTrue(obj.get_cached_age('test_method') < 10)
+
+    def test_ttl_unchanged_value(self):
+        """Test that recomputed properties with policies aren't expired
+        even if their values aren't changed"""
+        import time
+        from properties_cache.content_types import get_content_type
+        from properties_cache.storage import STORAGES, next_version
+
+        self.expire('test_method')
+        obj = PCTestChildModel.objects.properties().get(
+                                            pk=self.second_level[0].pk)
+        self.assertEqual(obj.cached.test_method, obj.test_method())
+
+        obj = PCTestChildModel.objects.properties().get(pk=obj.pk)
+        self.assertEqual(obj._pcache_test_method, obj.test_method())
+        self.assertTrue(obj.get_cached_age('test_method') < 10)
+
+        content_type = get_content_type(PCTestChildModel)
+        values = {(obj.pk, 'test_method'): obj.test_method()}
+        for storage in STORAGES.values():
+            storage.store(content_type, values,
+                          int((time.time() - 60) * 1000000))
+            storage.store(content_type, values, next_version())
+            loaded = storage.load(content_type, [obj.pk], versions=True)
+            self.assertTrue(time.time() - loaded[obj.pk]['__versions__']\
+                                ['test_method'] / 1000000.0 < 10)
+
+    def test_refresh_ahead(self):
+        """Test that stale values are read and recomputed by backend"""
+        PCTestChildModel.PropertiesCache.policies['test_method'] \
+                                                ['refresh_ahead'] = True
+        parent = self.first_level[0]
+        parent.name = 'renamed'
+        parent.save()
+        self.expire('test_method')
+
+        obj = PCTestChildModel.objects.properties().get(
+                                            pk=self.second_level[0].pk)
+        self.assertNotEqual(obj._pcache_test_method, obj.test_method())
+        self.assertEqual(PropertyCache.objects.get(name='test_method',
+                            object_pk=obj.pk).value, obj.test_method())
+
+    def test_check_policies(self):
+        """Test validation of policies"""
+        from django.core.exceptions import ImproperlyConfigured
+        from properties_cache.policies import check_policies
+
+        PCTestChildModel.PropertiesCache.policies = {'test_method': {}}
+        self.assertRaises(ImproperlyConfigured, check_policies,
+                          PCTestChildModel)
+        PCTestChildModel.PropertiesCache.policies = {'missing': {'ttl': 1}}
+        self.assertRaises(ImproperlyConfigured, check_policies,
+                          PCTestChildModel)
+
+
+class PropertiesRoutingTests(PropertiesCacheTestsBase):
+    multi_db = True
+
+    def tearDown(self):
+        from django.conf import settings
+        from properties_cache.routers import unpin
+
+        for name in ('READ_DB', 'WRITE_DB'):
+            if hasattr(settings, 'PROPERTIES_CACHE_%s' % name):
+                delattr(settings, 'PROPERTIES_CACHE_%s' % name)
+        unpin()
+        super(PropertiesRoutingTests, self).tearDown()
+
+    def test_replica_reads(self):
+        """Test that properties are read from replica unless they were
+        written by current thread during request"""
+        from django.conf import settings
+        from django.core.signals import request_finished
+        from django.db import connections
+
+        settings.PROPERTIES_CACHE_READ_DB = 'other'
+
+        # properties were written by setUp, so they're read from primary
+        objs = list(PCTestChildModel.objects.properties())
+        self.assertEqual(objs[0]._pcache_get_absolute_url,
+                         objs[0].get_absolute_url())
+
+        request_finished.send(sender=self.__class__)
+        replica = connections['other']
+        replica.use_debug_cursor = True
+        try:
+            start = len(replica.queries)
+            objs = list(PCTestChildModel.objects.properties())
+            self.assertEqual(len(replica.queries) - start, 1)
+        finally:
+            replica.use_debug_cursor = None
+        # replica doesn't have them
+        self.assertEqual(objs[0]._pcache, {})
+
+    def test_replica_cache(self):
+        """Test that properties read from replica aren't put to cache
+        tiers, so they aren't served after replica catches up"""
+        from django.conf import settings
+        from django.core.signals import request_finished
+        from properties_cache import cache
+
+        settings.PROPERTIES_CACHE_READ_DB = 'other'
+        settings.PROPERTIES_CACHE_LOCAL_SIZE = 100
+        try:
+            request_finished.send(sender=self.__class__)
+            obj = PCTestChildModel.objects.properties().get(
+                                                pk=self.second_level[0].pk)
+            self.assertEqual(obj._pcache, {})
+
+            # replica catches up
+            PropertyCache.objects.using('other').create(object_pk=obj.pk,
+                content_type=ContentType.objects.get_for_model(obj),
+                name='get_absolute_url', value=obj.get_absolute_url())
+            obj = PCTestChildModel.objects.properties().get(pk=obj.pk)
+            self.assertEqual(obj._pcache_get_absolute_url,
+                             obj.get_absolute_url())
+        finally:
+            del settings.PROPERTIES_CACHE_LOCAL_SIZE
+            cache.LOCAL_CACHE.clear()
+
+    def test_dedicated_database(self):
+        """Test keeping properties cache in dedicated database"""
+        from django.conf import settings
+
+        settings.PROPERTIES_CACHE_READ_DB = 'other'
+        settings.PROPERTIES_CACHE_WRITE_DB = 'other'
+
+        obj = self.second_level[0]
+        obj.name = 'dedicated'
+        obj.save()
+
+        rows = PropertyCache.objects.filter(object_pk=obj.pk,
+                                            name='get_absolute_url')
+        self.assertTrue(rows.using('other').get().value.endswith('dedicated'))
+        self.assertFalse(rows.get().value.endswith('dedicated'))
+
+        obj = PCTestChildModel.objects.properties().get(pk=obj.pk)
+        self.assertTrue(obj._pcache_get_absolute_url.endswith('dedicated'))
+
+        pk = obj.pk
+        obj.delete()
+        self.assertFalse(PropertyCache.objects.using('other').filter(
+                                                object_pk=pk).exists())
+        self.assertTrue(PropertyCache.objects.filter(object_pk=pk).exists())
+
+    def test_router(self):
+        """Test routing of properties cache tables by router"""
+        from django.conf import settings
+        from properties_cache.routers import PropertiesCacheRouter
+
+        router = PropertiesCacheRouter()
+        self.assertEqual(router.db_for_read(PropertyCache), None)
+        self.assertEqual(router.allow_syncdb('default', PropertyCache), None)
+
+        settings.PROPERTIES_CACHE_WRITE_DB = 'other'
+        self.assertEqual(router.db_for_read(PropertyCache), 'other')
+        self.assertEqual(router.db_for_write(PropertyCache), 'other')
+        self.assertEqual(router.db_for_write(PCTestChildModel), None)
+        self.assertFalse(router.allow_syncdb('default', PropertyCache))
+        self.assertTrue(router.allow_syncdb('other', PropertyCache))
+        self.assertEqual(router.allow_syncdb('default', PCRootModel), None)